@@ -38,6 +38,30 @@ __url__ = 'http://henux.nor.fi/projects/ubuntuman.php'
  # 'http://supybot.com/Members/yourname/UbuntuMan/download'
 
 import config
+import snapshot
+reload(snapshot)
+import cache
+reload(cache)
+import pool
+reload(pool)
+import httpclient
+reload(httpclient)
+import index
+reload(index)
+import local
+reload(local)
+import stats
+reload(stats)
+import apropos
+reload(apropos)
+import fuzzy
+reload(fuzzy)
+import template
+reload(template)
+import throttle
+reload(throttle)
+import options
+reload(options)
 import plugin
 reload(plugin) # In case we're being reloaded.
 # Add more reloads here if you add third-party modules and want them to be
@@ -0,0 +1,230 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.log as log
+import supybot.utils as utils
+
+import os
+import re
+import math
+import heapq
+import threading
+
+import snapshot
+
+tokenRe = re.compile(r'[a-z0-9][a-z0-9_+.-]*')
+
+# Words of a question that say nothing about the command asked for.
+stopwords = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'by',
+    'can', 'command', 'commands', 'do', 'does', 'for', 'from', 'how', 'i',
+    'in', 'is', 'it', 'of', 'on', 'or', 'program', 'that', 'the', 'to',
+    'tool', 'what', 'which', 'with'))
+
+def stem(word):
+    """Strips the plural and the -ing and -ed endings of an English word,
+    so that 'compresses' and 'compressing' find 'compress'."""
+    if word.endswith('sses') or word.endswith('ches') or \
+       word.endswith('shes') or word.endswith('xes'):
+        word = word[:-2]
+    elif word.endswith('ies') and len(word) > 4:
+        word = word[:-3] + 'y'
+    elif word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+        word = word[:-1]
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text):
+    """Returns the set of the stemmed words of a text, without the
+    stopwords."""
+    tokens = set()
+    for word in tokenRe.findall(text.lower()):
+        word = word.rstrip('.-')
+        if word and word not in stopwords:
+            tokens.add(stem(word))
+    return tokens
+
+def splitWhatis(whatis):
+    """Returns the description part of a NAME line like 'gzip, gunzip -
+    compress or expand files'."""
+    for separator in (' - ', ' -- '):
+        idx = whatis.find(separator)
+        if idx > -1:
+            return whatis[idx + len(separator):].strip()
+    return whatis.strip()
+
+
+class AproposIndex:
+    """Inverted index of the NAME lines of the manual pages, per release and
+    language.  Each word of a NAME line, the command names included, points
+    to the commands whose line has it, so a search only looks at the
+    postings of the words asked for.
+
+    The NAME lines are written to the snapshot 'filename' by flush(); the
+    postings are rebuilt from them when loaded.  With 'background', the
+    snapshot is loaded by a WarmUp thread, and searches find the pages
+    loaded so far."""
+
+    def __init__(self, filename, background=False):
+        self.filename = filename
+        # (release, language) -> {command: (section, whatis)}
+        self.pages = {}
+        # (release, language) -> {token: set of commands}
+        self.postings = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.warmUp = None
+        if background and os.path.exists(filename):
+            self.warmUp = snapshot.WarmUp('UbuntuMan apropos warm-up',
+                                          filename, self.__loadSection)
+        else:
+            self.load()
+
+    def __len__(self):
+        return sum(map(len, self.pages.itervalues()))
+
+    def count(self, release, language):
+        return len(self.pages.get((release, language), ()))
+
+    def commands(self, release):
+        """Returns the set of the commands of a release, in any language."""
+        self.lock.acquire()
+        try:
+            commands = set()
+            for ((rel, language), pages) in self.pages.iteritems():
+                if rel == release:
+                    commands.update(pages)
+            return commands
+        finally:
+            self.lock.release()
+
+    def add(self, release, language, command, section, whatis):
+        """Adds the NAME line of a manual page, replacing the one the command
+        had."""
+        self.__add(release, language, command, section, whatis, False)
+
+    def __add(self, release, language, command, section, whatis, restore):
+        key = (release, language)
+        whatis = utils.str.normalizeWhitespace(whatis).strip()
+        self.lock.acquire()
+        try:
+            pages = self.pages.setdefault(key, {})
+            if pages.get(command) == (section, whatis):
+                return
+            if restore and command in pages:
+                # added while the snapshot was being loaded
+                return
+            postings = self.postings.setdefault(key, {})
+            if command in pages:
+                for token in tokenize(pages[command][1]):
+                    postings[token].discard(command)
+                    if not postings[token]:
+                        del postings[token]
+            pages[command] = (section, whatis)
+            for token in tokenize(whatis) | tokenize(command):
+                postings.setdefault(token, set()).add(command)
+            if not restore:
+                self.dirty = True
+        finally:
+            self.lock.release()
+
+    def search(self, release, language, query, limit=5):
+        """Returns the (command, section, description) tuples of the pages
+        best matching the words of 'query'.  The pages are ranked by the
+        rarity of the words they have, so 'compress files' puts the pages
+        about compressing before all those about files; a word that is the
+        command name itself counts double."""
+        key = (release, language)
+        words = tokenize(query)
+        self.lock.acquire()
+        try:
+            pages = self.pages.get(key, {})
+            postings = self.postings.get(key, {})
+            scores = {}
+            for word in words:
+                commands = postings.get(word)
+                if not commands:
+                    continue
+                idf = math.log(1 + len(pages) / float(len(commands)))
+                for command in commands:
+                    score = idf
+                    if stem(command) == word:
+                        score *= 2
+                    scores[command] = scores.get(command, 0) + score
+            ranked = heapq.nsmallest(limit, scores.iteritems(),
+                                     key=lambda x: (-x[1], x[0]))
+            L = []
+            for (command, score) in ranked:
+                (section, whatis) = pages[command]
+                L.append((command, section, splitWhatis(whatis)))
+            return L
+        finally:
+            self.lock.release()
+
+    def __loadSection(self, name, items):
+        for (release, language, command, section, whatis) in items:
+            self.__add(release, language, command, section, whatis, True)
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            if not snapshot.isSnapshot(self.filename):
+                log.warning('UbuntuMan: %s isn\'t an apropos index snapshot, '
+                            'starting with an empty index.', self.filename)
+                return
+            reader = snapshot.Reader(self.filename)
+            try:
+                for (name, items) in reader:
+                    self.__loadSection(name, items)
+            finally:
+                reader.close()
+        except Exception, e:
+            log.warning('UbuntuMan: Couldn\'t load the apropos index from '
+                        '%s: %s', self.filename, utils.exnToString(e))
+
+    def flush(self):
+        if self.warmUp is not None and not self.warmUp.isDone():
+            # Writing now would lose what hasn't been loaded yet.
+            return
+        if not self.dirty:
+            return
+        fd = utils.file.AtomicFile(self.filename, 'wb')
+        try:
+            self.lock.acquire()
+            try:
+                items = [(release, language, command, section, whatis)
+                         for ((release, language), commands)
+                         in self.pages.iteritems()
+                         for (command, (section, whatis))
+                         in commands.iteritems()]
+                self.dirty = False
+            finally:
+                self.lock.release()
+            snapshot.write(fd, [('pages', items)])
+        except Exception, e:
+            fd.rollback()
+            self.dirty = True
+            log.warning('UbuntuMan: Couldn\'t write the apropos index to %s: '
+                        '%s', self.filename, utils.exnToString(e))
+        else:
+            fd.close()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
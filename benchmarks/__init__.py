@@ -0,0 +1,25 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline benchmarks for the UbuntuMan plugin: a corpus of manual pages in the
+format of the Ubuntu Manpage Repository, an HTTP server standing in for the
+repository, and the bench.py script measuring the plugin against them.
+"""
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks the UbuntuMan plugin without network access.  The parsers are
+timed on the pages of a corpus, and the man command is run end to end in a
+bot talking to a FixtureServer serving the corpus.  The results are written
+as JSON, so that runs can be compared with --baseline."""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import optparse
+from cStringIO import StringIO
+
+import corpus
+import server
+
+# Registry of the bot the benchmark runs, like the one of supybot-test.
+REGISTRY = """
+supybot.directories.data: %(dirname)s/data
+supybot.directories.conf: %(dirname)s/conf
+supybot.directories.log: %(dirname)s/logs
+supybot.log.stdout: False
+supybot.log.level: WARNING
+supybot.protocols.irc.throttleTime: 0
+supybot.reply.whenAddressedBy.chars: @
+supybot.networks.bench.server: should.not.need.this
+supybot.nick: bench
+supybot.flush: False
+supybot.abuse.flood.command: False
+supybot.plugins.UbuntuMan.throttle.user: 0
+supybot.plugins.UbuntuMan.throttle.channel: 0
+supybot.plugins.UbuntuMan.throttle.upstream: 0
+"""
+
+PREFIX = 'user!user@host.domain.tld'
+
+# Reply formats the reply formatting is timed with.
+FORMATS = (
+    '$name | $synopsis | $description',
+    '$command',
+    '$url',
+    '$name',
+    '$description',
+    '$name | $url',
+    '$command: $description ($url)',
+    '${name} -- ${synopsis}',
+    '$synopsis | $description | $url',
+    '[$command] $name :: $synopsis :: $description',
+    '$name | $synopsis | $description | see $url',
+    'prefix | $name | $url | $description | $synopsis | subfix',
+)
+
+# Reply lengths the reply formatting is timed with.
+LENGTHS = (120, 300, 450)
+
+# Releases the summary cache is filled for.
+RELEASES = ('dapper', 'hardy', 'intrepid', 'jaunty', 'karmic')
+
+def percentile(values, p):
+    """Returns the p-th percentile of sorted values, by nearest rank."""
+    if not values:
+        return None
+    idx = int(round(p / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(idx, len(values) - 1))]
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+            'mean':sum(values) / float(len(values)),
+            'p50':percentile(values, 50),
+            'p90':percentile(values, 90),
+            'p99':percentile(values, 99),
+            'max':values[-1],
+           }
+
+def loadPlugin(dirname):
+    """Sets up a bot in 'dirname' and loads the plugin in it.  Returns the
+    (module, irc, callback) tuple."""
+    filename = os.path.join(dirname, 'bench.conf')
+    fd = open(filename, 'w')
+    fd.write(REGISTRY % {'dirname':dirname})
+    fd.close()
+    import supybot.registry as registry
+    registry.open(filename)
+    import supybot.conf as conf
+    import supybot.world as world
+    import supybot.irclib as irclib
+    import supybot.plugin as plugin
+    world.testing = False
+    # The plugin is loaded by its name, so its directory must be called
+    # UbuntuMan; link to it if the checkout isn't.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if os.path.basename(root) == 'UbuntuMan':
+        pluginsDir = os.path.dirname(root)
+    else:
+        pluginsDir = os.path.join(dirname, 'plugins')
+        os.mkdir(pluginsDir)
+        os.symlink(root, os.path.join(pluginsDir, 'UbuntuMan'))
+    conf.supybot.directories.plugins.setValue([pluginsDir])
+    irc = irclib.Irc('bench')
+    while irc.takeMsg():
+        pass
+    plugin.loadPluginClass(irc, plugin.loadPluginModule('Owner'))
+    module = plugin.loadPluginModule('UbuntuMan')
+    cb = plugin.loadPluginClass(irc, module)
+    return (module, irc, cb)
+
+def benchParsers(module, pages, release, iterations):
+    """Times the parser of each language on its pages of the corpus."""
+    import supybot.conf as conf
+    format = conf.supybot.plugins.UbuntuMan.format()
+    results = {}
+    byLanguage = {}
+    for (key, html) in pages.iteritems():
+        parts = corpus.split(key)
+        if parts is not None and parts[0] == release:
+            byLanguage.setdefault(parts[1], []).append((parts[3], html))
+    for name in dir(module.plugin):
+        if not name.startswith('UbuntuManParser_'):
+            continue
+        language = name[len('UbuntuManParser_'):]
+        parserClass = getattr(module.plugin, name)
+        L = byLanguage.get(language)
+        if not L:
+            sys.stderr.write('No pages for the %s parser in the corpus.\n' %
+                             language)
+            continue
+        (bytesRead, pageBytes, failures) = (0, 0, 0)
+        started = time.time()
+        for i in xrange(iterations):
+            for (command, html) in L:
+                fd = StringIO(html)
+                try:
+                    parserClass().parse(fd, command, format)
+                except module.plugin.UbuntuManError:
+                    failures += 1
+                bytesRead += fd.tell()
+                pageBytes += len(html)
+        elapsed = time.time() - started
+        count = iterations * len(L)
+        results[language] = {
+                             'pages':count,
+                             'failures':failures,
+                             'seconds':elapsed,
+                             'pagesPerSecond':count / elapsed,
+                             'megabytesPerSecond':
+                                bytesRead / elapsed / 1024 / 1024,
+                             'meanPageBytes':pageBytes / count,
+                             'meanBytesRead':bytesRead / count,
+                            }
+    return results
+
+def legacyFormat(utils, vars, format, keysParsed, length):
+    """The reply formatting as it was before the formats were compiled, to
+    compare with."""
+    def cut(s, limit):
+        idx = s[:limit - 3].rfind(' ')
+        return '%s ...' % s[:idx]
+    vars = vars.copy()
+    replace = lambda : utils.str.perlVariableSubstitute(vars, format)
+    msg = replace()
+    if len(msg) > length:
+        for var in keysParsed:
+            cutLength = len(msg) - length
+            vars[var] = cut(vars[var], - cutLength)
+            msg = replace()
+            break
+        if len(msg) > length:
+            msg = '%s ...' %(msg[:length - 4])
+    return msg
+
+def parseSummaries(module, pages, release):
+    """Returns the summaries of the English pages of the corpus, with all
+    the keywords."""
+    keys = module.plugin.KeywordsParser().keys
+    everything = ' '.join(['$' + name for name in keys])
+    summaries = []
+    for (key, html) in sorted(pages.iteritems()):
+        parts = corpus.split(key)
+        if parts is None or parts[:2] != (release, 'en'):
+            continue
+        parser = module.plugin.UbuntuManParser_en()
+        parser.parse(StringIO(html), parts[3], everything)
+        vars = {'url':'http://manpages.ubuntu.com/manpages' + key,
+                'command':parts[3], 'section':parts[2], 'language':'en'}
+        for name in keys:
+            vars[name] = getattr(parser, name)
+        summaries.append(vars)
+    return summaries
+
+def benchFormats(module, summaries, iterations):
+    """Times the formatting of the replies of the summaries with each of
+    FORMATS and LENGTHS, compiled and the way it was done before."""
+    import supybot.utils as utils
+    keys = module.plugin.KeywordsParser().keys
+    results = {}
+    (legacyTotal, compiledTotal) = (0.0, 0.0)
+    for (i, format) in enumerate(FORMATS):
+        keywords = module.plugin.KeywordsParser()
+        keywords.checkKeywords(format)
+        started = time.time()
+        compiled = module.template.Template(format, ('url', 'command') + keys,
+                                            keys)
+        compileTime = time.time() - started
+        count = iterations * len(LENGTHS) * len(summaries)
+        started = time.time()
+        for j in xrange(iterations):
+            for length in LENGTHS:
+                for vars in summaries:
+                    legacyFormat(utils, vars, format, keywords.keysParsed,
+                                 length)
+        legacy = time.time() - started
+        started = time.time()
+        for j in xrange(iterations):
+            for length in LENGTHS:
+                for vars in summaries:
+                    compiled.render(vars, length)
+        elapsed = time.time() - started
+        (legacyTotal, compiledTotal) = (legacyTotal + legacy,
+                                        compiledTotal + elapsed)
+        results['format%02d' % i] = {
+                                     'format':format,
+                                     'replies':count,
+                                     'compileUs':compileTime * 1e6,
+                                     'legacyUs':legacy * 1e6 / count,
+                                     'compiledUs':elapsed * 1e6 / count,
+                                     'speedup':legacy / elapsed,
+                                    }
+    results['speedup'] = legacyTotal / compiledTotal
+    return results
+
+def benchCache(module, summaries, count, seed):
+    """Fills a summary cache with 'count' summaries of RELEASES and measures
+    the memory it takes.  The summaries are made from those of the corpus,
+    for as many commands as needed; a fifth of the pages change from a
+    release to the next, the others are the same."""
+    rng = random.Random(seed)
+    store = module.cache.SummaryStore(lambda: 0, lambda: 0)
+    started = time.time()
+    n = 0
+    while n < count:
+        template = summaries[n % len(summaries)]
+        command = '%s%d' % (template['command'], n)
+        summary = dict(template, command=command,
+                       description='%s %s' % (command,
+                                              template['description']))
+        for release in RELEASES:
+            if rng.random() < 0.2:
+                summary = dict(summary, synopsis='%s %s' %
+                               (summary['synopsis'], release))
+            summary['url'] = 'http://manpages.ubuntu.com/manpages/%s/en/' \
+                             'man%s/%s.%s.html' % (release,
+                             summary['section'], command, summary['section'])
+            store.set(release, 'en', command, summary)
+            n += 1
+    elapsed = time.time() - started
+    (records, bodies, size) = store.memory()
+    return {
+            'summaries':records,
+            'distinctTexts':bodies,
+            'megabytes':size / 1024.0 / 1024,
+            'estimatedMegabytes':store.bytes / 1024.0 / 1024,
+            'bytesPerSummary':size / float(records),
+            'insertUs':elapsed * 1e6 / records,
+           }
+
+def workload(count, seed):
+    """Returns 'count' (command, language) lookups.  Popular commands and
+    English are asked for more often, and a few commands have no page."""
+    rng = random.Random(seed)
+    languages = sorted(corpus.LANGUAGES)
+    commands = [command for (command, sections) in corpus.COMMANDS]
+    # Zipf like weights, in the order of COMMANDS.
+    weights = [1.0 / (i + 1) for i in range(len(commands))]
+    total = sum(weights)
+    lookups = []
+    for i in xrange(count):
+        if rng.random() < 0.05:
+            command = 'nosuchcommand%d' % rng.randint(0, 999)
+        else:
+            x = rng.random() * total
+            for (command, weight) in zip(commands, weights):
+                x -= weight
+                if x <= 0:
+                    break
+        if rng.random() < 0.6:
+            language = 'en'
+        else:
+            language = rng.choice(languages)
+        lookups.append((command, language))
+    return lookups
+
+def lookup(irc, command, language, timeout=60):
+    """Runs the man command and returns the (seconds, reply) tuple."""
+    import supybot.ircmsgs as ircmsgs
+    msg = ircmsgs.privmsg(irc.nick, 'man %s --lang %s' % (command, language),
+                          prefix=PREFIX)
+    started = time.time()
+    irc.feedMsg(msg)
+    while time.time() - started < timeout:
+        m = irc.takeMsg()
+        if m is not None and m.command in ('PRIVMSG', 'NOTICE'):
+            return (time.time() - started, m.args[1])
+        time.sleep(0.0005)
+    return (time.time() - started, None)
+
+def benchLookups(irc, fixture, lookups):
+    """Runs the lookups one after another and measures their latency and
+    the number of requests each makes to the repository."""
+    (latencies, probes) = ([], [])
+    (found, missing, failed) = (0, 0, 0)
+    fixture.reset()
+    for (command, language) in lookups:
+        before = fixture.requests
+        (seconds, reply) = lookup(irc, command, language)
+        latencies.append(seconds * 1000)
+        probes.append(fixture.requests - before)
+        if reply is None or reply.startswith('Failed') or \
+           reply.startswith('Error'):
+            failed += 1
+        elif reply.startswith('No manual page'):
+            missing += 1
+        else:
+            found += 1
+    return {
+            'lookups':len(lookups),
+            'found':found,
+            'missing':missing,
+            'failed':failed,
+            'latencyMs':summarize(latencies),
+            'probesPerLookup':summarize(probes),
+            'requests':fixture.requests,
+            'bytes':fixture.bytes,
+            'downloads':fixture.downloads,
+           }
+
+def run(options):
+    if options.corpus:
+        pages = corpus.load(options.corpus)
+    else:
+        pages = corpus.generate((options.release, ), seed=options.seed)
+    dirname = tempfile.mkdtemp(prefix='ubuntuman-bench-')
+    fixture = server.FixtureServer(pages, options.latency / 1000.0,
+                                   options.jitter / 1000.0, options.notFound,
+                                   options.seed)
+    try:
+        (module, irc, cb) = loadPlugin(dirname)
+        import supybot.conf as conf
+        config = conf.supybot.plugins.UbuntuMan
+        results = {
+                   'options':{
+                              'corpus':options.corpus or 'generated',
+                              'pages':len(pages),
+                              'release':options.release,
+                              'iterations':options.iterations,
+                              'lookups':options.lookups,
+                              'latencyMs':options.latency,
+                              'jitterMs':options.jitter,
+                              'notFound':options.notFound,
+                              'cacheSummaries':options.cacheSummaries,
+                              'seed':options.seed,
+                             },
+                   'version':module.__version__,
+                   'python':sys.version.split()[0],
+                   'started':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  }
+        results['parser'] = benchParsers(module, pages, options.release,
+                                         options.iterations)
+        summaries = parseSummaries(module, pages, options.release)
+        results['formats'] = benchFormats(module, summaries,
+                                          options.iterations)
+        results['cache'] = benchCache(module, summaries,
+                                      options.cacheSummaries, options.seed)
+        config.baseurl.setValue(fixture.start())
+        config.release.setValue(options.release)
+        lookups = workload(options.lookups, options.seed)
+        scenarios = {}
+        # Every lookup goes to the repository.
+        config.cache.enable.setValue(False)
+        config.index.enable.setValue(False)
+        scenarios['uncached'] = benchLookups(irc, fixture, lookups)
+        # Only the sections the section index knows of are probed.
+        config.index.enable.setValue(True)
+        for language in corpus.LANGUAGES:
+            cb.indexes.store(options.release, language,
+                             corpus.sections(pages, options.release,
+                                             language))
+        scenarios['indexed'] = benchLookups(irc, fixture, lookups)
+        config.index.enable.setValue(False)
+        # The same lookups again once they have all been cached.
+        config.cache.enable.setValue(True)
+        cb.cache.clear()
+        benchLookups(irc, fixture, lookups)
+        scenarios['cached'] = benchLookups(irc, fixture, lookups)
+        results['lookups'] = scenarios
+        irc._reallyDie()
+    finally:
+        fixture.stop()
+        shutil.rmtree(dirname, ignore_errors=True)
+    return results
+
+def flatten(d, prefix=''):
+    """Returns the numbers of nested dictionaries as a flat dictionary with
+    'a.b.c' keys."""
+    L = {}
+    for (key, value) in d.iteritems():
+        if isinstance(value, dict):
+            L.update(flatten(value, '%s%s.' % (prefix, key)))
+        elif isinstance(value, (int, long, float)) and \
+             not isinstance(value, bool):
+            L['%s%s' % (prefix, key)] = value
+    return L
+
+def compare(baseline, results, out):
+    """Writes the relative change of every measurement from a baseline
+    run."""
+    (old, new) = (flatten(baseline), flatten(results))
+    for key in sorted(new):
+        if key.startswith('options.') or key not in old:
+            continue
+        if old[key]:
+            change = '%+.1f%%' % ((new[key] - old[key]) * 100.0 / old[key])
+        else:
+            change = 'n/a'
+        out.write('%-50s %12.3f %12.3f %9s\n' % (key, old[key], new[key],
+                                                 change))
+
+def main():
+    parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--corpus', dest='corpus', metavar='DIR',
+                      help='Reads the pages from a local mirror of the '
+                           'repository instead of generating them.')
+    parser.add_option('--release', dest='release', default='karmic',
+                      help='Release of the pages looked up.')
+    parser.add_option('--iterations', dest='iterations', type='int',
+                      default=20, help='Times each page is parsed.')
+    parser.add_option('--lookups', dest='lookups', type='int', default=200,
+                      help='Number of man commands run per scenario.')
+    parser.add_option('--latency', dest='latency', type='float', default=20,
+                      help='Milliseconds the server waits before answering.')
+    parser.add_option('--jitter', dest='jitter', type='float', default=10,
+                      help='Random milliseconds added to the latency.')
+    parser.add_option('--not-found', dest='notFound', type='float',
+                      default=0.05,
+                      help='Share of the existing pages answered 404.')
+    parser.add_option('--cache-summaries', dest='cacheSummaries', type='int',
+                      default=100000,
+                      help='Number of summaries the cache is filled with.')
+    parser.add_option('--seed', dest='seed', type='int', default=0)
+    parser.add_option('--output', dest='output', metavar='FILE',
+                      help='Writes the JSON results to FILE instead of the '
+                           'standard output.')
+    parser.add_option('--baseline', dest='baseline', metavar='FILE',
+                      help='Compares the results to those of an earlier run '
+                           'on the standard error.')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('No arguments expected.')
+    results = run(options)
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if options.output:
+        fd = open(options.output, 'w')
+        fd.write(text)
+        fd.close()
+    else:
+        sys.stdout.write(text)
+    if options.baseline:
+        fd = open(options.baseline)
+        try:
+            baseline = json.load(fd)
+        finally:
+            fd.close()
+        compare(baseline, results, sys.stderr)
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
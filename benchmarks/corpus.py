@@ -0,0 +1,216 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Corpus of manual pages for the benchmarks.  A corpus is a dictionary
+mapping the path of a page below the base URL of the repository, e.g.
+'/karmic/en/man1/grep.1.html', to its HTML.  It is either generated, with
+pages laid out like the ones of the Ubuntu Manpage Repository, or loaded
+from a local mirror of the repository."""
+
+import os
+import re
+import gzip
+import zlib
+import random
+
+# The NAME, SYNOPSIS and DESCRIPTION headings of every language the plugin
+# has a parser for (UbuntuManParser_*).
+LANGUAGES = {
+    'en': ('NAME', 'SYNOPSIS', 'DESCRIPTION'),
+    'es': ('NOMBRE', 'SINOPSIS', 'DESCRIPCI\xc3\x93N'),
+    'de': ('BEZEICHNUNG', '&Uuml;BERSICHT', 'BESCHREIBUNG'),
+    'fi': ('NIMI', 'YLEISKATSAUS', 'KUVAUS'),
+    'it': ('NOME', 'SINTASSI', 'DESCRIZIONE'),
+    'fr': ('NOM', 'SYNOPSIS', 'DESCRIPTION'),
+}
+
+# The commands of the corpus and the sections they have a page in, most
+# asked for first.
+COMMANDS = [
+    ('grep', ('1',)), ('ls', ('1',)), ('apt-get', ('8',)), ('sudo', ('8',)),
+    ('find', ('1',)), ('chmod', ('1',)), ('mount', ('8',)), ('tar', ('1',)),
+    ('ssh', ('1',)), ('fstab', ('5',)), ('bash', ('1',)), ('sed', ('1',)),
+    ('cp', ('1',)), ('rsync', ('1',)), ('passwd', ('1', '5')),
+    ('crontab', ('1', '5')), ('chown', ('1',)), ('ps', ('1',)),
+    ('kill', ('1',)), ('dpkg', ('1',)), ('aptitude', ('8',)),
+    ('sources.list', ('5',)), ('interfaces', ('5',)), ('fdisk', ('8',)),
+    ('cat', ('1',)), ('mv', ('1',)), ('rm', ('1',)), ('su', ('1',)),
+    ('less', ('1',)), ('top', ('1',)), ('gzip', ('1',)), ('wget', ('1',)),
+    ('ifconfig', ('8',)), ('iptables', ('8',)), ('useradd', ('8',)),
+    ('sudoers', ('5',)), ('hosts', ('5',)), ('resolv.conf', ('5',)),
+    ('modprobe', ('8',)), ('mkfs', ('8',)), ('ping', ('8',)),
+    ('netstat', ('8',)), ('lsof', ('8',)), ('awk', ('1',)), ('man', ('1',)),
+    ('nano', ('1',)), ('vim', ('1',)), ('curl', ('1',)), ('xz', ('1',)),
+    ('xorg.conf', ('5',)), ('grub-install', ('8',)), ('ln', ('1',)),
+    ('df', ('1',)), ('du', ('1',)), ('free', ('1',)), ('uname', ('1',)),
+    ('dmesg', ('1',)), ('lspci', ('8',)), ('lsusb', ('8',)),
+    ('shutdown', ('8',)),
+]
+
+# Share of the commands translated to the languages other than English.
+TRANSLATED = 0.6
+
+WORDS = ('the', 'file', 'files', 'is', 'are', 'of', 'to', 'a', 'and',
+         'input', 'output', 'option', 'options', 'each', 'when', 'is',
+         'given', 'standard', 'directory', 'line', 'lines', 'by', 'default',
+         'with', 'this', 'program', 'which', 'read', 'write', 'all', 'may',
+         'be', 'used', 'can', 'from', 'not', 'if', 'or', 'system', 'user',
+         'specified', 'command', 'name', 'that', 'as', 'in', 'for')
+
+HEAD = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">',
+        '<html>', '<head>', '<title>Ubuntu Manpage: %(command)s</title>'] + \
+       ['<meta name="keywords%d" content="%%(command)s">' % i
+        for i in range(32)] + \
+       ['<link rel="stylesheet" href="/manpages.css" type="text/css">',
+        '</head>', '<body>', '<div id="content">', '<pre>']
+
+def sentence(rng, words):
+    L = [rng.choice(WORDS) for i in xrange(words)]
+    return '%s.' % ' '.join(L).capitalize()
+
+def paragraph(rng, sentences, indent):
+    """Returns a paragraph wrapped at 78 columns, with some of the words
+    hyphenated across lines like the repository does."""
+    text = ' '.join([sentence(rng, rng.randint(5, 14))
+                     for i in xrange(sentences)])
+    (lines, ln) = ([], indent)
+    for word in text.split():
+        if len(ln) + len(word) > 78:
+            if len(word) > 5 and rng.random() < 0.2:
+                # A word hyphenated across lines, as U+2010.
+                lines.append('%s %s\xe2\x80\x90' % (ln, word[:3]))
+                word = word[3:]
+            else:
+                lines.append(ln)
+            ln = indent + word
+        elif ln.strip():
+            ln = '%s %s' % (ln, word)
+        else:
+            ln = indent + word
+    lines.append(ln)
+    return lines
+
+def page(command, section, language, rng):
+    """Returns the HTML of a manual page.  The pages get longer OPTIONS
+    sections the less often their command is asked for, like real ones."""
+    (name, synopsis, description) = LANGUAGES[language]
+    L = [ln % {'command':command} for ln in HEAD]
+    L.append('<h4><b>%s</b></h4>' % name)
+    L.append('       %s - %s' % (command, sentence(rng, 6)[:-1].lower()))
+    L.append('')
+    L.append('<h4><b>%s</b></h4>' % synopsis)
+    L.append('       <b>%s</b> [<u>OPTION</u>]... <u>FILE</u>...' % command)
+    L.append('')
+    L.append('<h4><b>%s</b></h4>' % description)
+    L.extend(paragraph(rng, rng.randint(2, 6), '       '))
+    L.append(' </pre>')
+    L.append('<pre>')
+    L.append('<h4><b>OPTIONS</b></h4>')
+    for i in xrange(rng.randint(5, 150)):
+        L.append('       <b>-%s</b>, <b>--%s</b>' %
+                 (rng.choice('abcdefghijklmnopqrstuvwxyz'),
+                  '-'.join(rng.sample(WORDS, 2))))
+        L.extend(paragraph(rng, rng.randint(1, 3), '              '))
+        L.append('')
+    L.append('<h4><b>SEE ALSO</b></h4>')
+    L.append('       <b>man</b>(1), <b>info</b>(1)')
+    L.append('</pre></div></body></html>')
+    return '\n'.join(L) + '\n'
+
+def path(release, language, command, section):
+    return '/%s/%s/man%s/%s.%s.html' % (release, language, section, command,
+                                        section)
+
+def generate(releases=('karmic', ), languages=None, seed=0):
+    """Generates a corpus.  English has all the COMMANDS, the other
+    languages a share of them.  The same seed always gives the same pages."""
+    if languages is None:
+        languages = sorted(LANGUAGES)
+    pages = {}
+    for release in releases:
+        for language in languages:
+            for (command, sections) in COMMANDS:
+                key = '%s/%s/%s/%s' % (seed, release, language, command)
+                rng = random.Random(zlib.crc32(key))
+                if language != 'en' and rng.random() > TRANSLATED:
+                    continue
+                for section in sections:
+                    pages[path(release, language, command, section)] = \
+                        page(command, section, language, rng)
+    return pages
+
+# Matches the path of a page in a mirror: <release>/<language>/man<section>/
+# <command>.<section>.html
+pathRe = re.compile(r'^/([^/]+)/([^/]+)/man([^/]+)/(.+)\.\3\.html$')
+
+def split(path):
+    """Returns the (release, language, section, command) of a page path, or
+    None if it is not the path of a page."""
+    m = pathRe.match(path)
+    if m is None:
+        return None
+    return m.groups()
+
+def load(dirname):
+    """Loads a corpus from a local mirror of the repository, laid out as
+    <release>/<language>/man<section>/<command>.<section>.html[.gz]."""
+    pages = {}
+    for (dirpath, dirnames, filenames) in os.walk(dirname):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            key = '/' + os.path.relpath(filepath, dirname).replace(os.sep, '/')
+            if key.endswith('.gz'):
+                (key, fd) = (key[:-3], gzip.open(filepath))
+            else:
+                fd = open(filepath, 'rb')
+            if split(key) is None:
+                fd.close()
+                continue
+            try:
+                pages[key] = fd.read()
+            finally:
+                fd.close()
+    return pages
+
+def write(pages, dirname):
+    """Writes a corpus to a directory in the layout load() reads, which is
+    also the layout supybot.plugins.UbuntuMan.index.mirror expects."""
+    for (key, html) in pages.iteritems():
+        filename = os.path.join(dirname, *key.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        fd = open(filename, 'wb')
+        try:
+            fd.write(html)
+        finally:
+            fd.close()
+
+def sections(pages, release, language):
+    """Returns the command -> sections mapping of a release and language,
+    as stored in a section index."""
+    commands = {}
+    for key in pages:
+        parts = split(key)
+        if parts is not None and parts[:2] == (release, language):
+            commands.setdefault(parts[3], []).append(parts[2])
+    for L in commands.itervalues():
+        L.sort()
+    return commands
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,221 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local HTTP server standing in for the Ubuntu Manpage Repository."""
+
+import re
+import time
+import zlib
+import gzip
+import random
+import urllib
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+import corpus
+
+# The byte ranges served: a single one, with both ends given.
+rangeRe = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+def injected(path, share):
+    """Whether the page at 'path' is one of the 'share' of the pages that
+    are answered 404 although they exist.  The choice only depends on the
+    path, so a page is missing or not for the whole run, like in a real
+    repository."""
+    return share > 0 and (zlib.crc32(path) & 0xffff) < share * 0x10000
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.fixture.handle(self, True)
+
+    def do_HEAD(self):
+        self.server.fixture.handle(self, False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FixtureServer:
+    """Serves a corpus over HTTP, with keep-alive and gzip like the real
+    repository, and the directory listings of the man<section> directories
+    that manindex reads.  'latency' seconds, plus a random share of 'jitter'
+    seconds, are waited before answering each request, and 'notFound' is the
+    share of the pages answered 404.  The pages have an ETag and a
+    Last-Modified date, and conditional requests for pages that haven't
+    changed are answered 304.  A request for a range of the bytes of a page
+    is answered 206, and the paths in 'redirects' are redirected to the
+    path they map to.  The body of the pages in 'stalled' stops after its
+    first bytes for as many seconds as they map to, and the connection is
+    then closed.
+    While 'failing' is true, every request is answered 503,
+    and while 'allowHead' is false, HEAD requests are answered 405.  The
+    requests are counted by status and by method, so the number of probes
+    of a lookup is known, and so are the pages sent whole."""
+
+    def __init__(self, pages, latency=0.0, jitter=0.0, notFound=0.0, seed=0):
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.notFound = notFound
+        self.failing = False
+        self.allowHead = True
+        self.redirects = {}
+        self.stalled = {}
+        self.modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                                      time.gmtime())
+        self.random = random.Random(seed)
+        self.compressed = {}
+        self.listings = {}
+        for key in pages:
+            parts = corpus.split(key)
+            if parts is not None:
+                dirname = key[:key.rindex('/') + 1]
+                self.listings.setdefault(dirname, []).append(key)
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        """Resets the counters."""
+        self.lock.acquire()
+        try:
+            self.requests = 0
+            self.statuses = {}
+            self.methods = {}
+            self.bytes = 0
+            self.downloads = 0
+        finally:
+            self.lock.release()
+
+    def start(self):
+        """Starts the server on a free port of localhost and returns its
+        base URL."""
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.fixture = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='UbuntuMan fixture server')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self.url()
+
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def __delay(self):
+        self.lock.acquire()
+        try:
+            delay = self.latency + self.random.random() * self.jitter
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+    def __listing(self, dirname):
+        L = ['<html><body><h1>Index of %s</h1><ul>' % dirname]
+        for key in sorted(self.listings[dirname]):
+            filename = key[len(dirname):]
+            L.append('<li><a href="%s">%s</a></li>' % (filename, filename))
+        L.append('</ul></body></html>')
+        return '\n'.join(L) + '\n'
+
+    def __gzip(self, path, body):
+        if self.compressed.get(path, (None, ))[0] != body:
+            buf = StringIO()
+            fd = gzip.GzipFile(fileobj=buf, mode='wb')
+            fd.write(body)
+            fd.close()
+            self.compressed[path] = (body, buf.getvalue())
+        return self.compressed[path][1]
+
+    def handle(self, request, withBody):
+        self.__delay()
+        path = urllib.unquote(request.path.split('?', 1)[0])
+        (status, body, etag, location) = (404, 'Not Found\n', None, None)
+        if self.failing:
+            (status, body) = (503, 'Service Unavailable\n')
+        elif request.command == 'HEAD' and not self.allowHead:
+            (status, body) = (405, 'Method Not Allowed\n')
+        elif path in self.redirects:
+            (status, body) = (301, 'Moved Permanently\n')
+            location = self.redirects[path]
+        elif path in self.pages and not injected(path, self.notFound):
+            (status, body) = (200, self.pages[path])
+            etag = '"%08x"' % (zlib.crc32(body) & 0xffffffff)
+            if request.headers.get('if-none-match') == etag:
+                (status, body) = (304, '')
+        elif path in self.listings:
+            (status, body) = (200, self.__listing(path))
+        m = rangeRe.match(request.headers.get('range', ''))
+        if status == 200 and m:
+            (start, end) = (int(m.group(1)), int(m.group(2)))
+            (status, body) = (206, body[start:end + 1])
+        encoding = None
+        acceptEncoding = request.headers.get('accept-encoding', '')
+        if status == 200 and 'gzip' in acceptEncoding:
+            (encoding, body) = ('gzip', self.__gzip(path, body))
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.methods[request.command] = \
+                self.methods.get(request.command, 0) + 1
+            if withBody:
+                self.bytes += len(body)
+                if status == 200 and path in self.pages:
+                    self.downloads += 1
+        finally:
+            self.lock.release()
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/html; charset=UTF-8')
+        request.send_header('Content-Length', str(len(body)))
+        if etag:
+            request.send_header('ETag', etag)
+            request.send_header('Last-Modified', self.modified)
+        if encoding:
+            request.send_header('Content-Encoding', encoding)
+        if location:
+            request.send_header('Location', location)
+        request.end_headers()
+        if withBody and path in self.stalled:
+            request.wfile.write(body[:64])
+            request.wfile.flush()
+            time.sleep(self.stalled[path])
+            request.close_connection = 1
+        elif withBody:
+            request.wfile.write(body)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
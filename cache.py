@@ -0,0 +1,536 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.log as log
+import supybot.utils as utils
+
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import snapshot
+
+class LRUCache:
+    """Dictionary like cache with a time-to-live and a size limit.  When the
+    cache is full the least recently used entry is dropped.  'ttl' and 'size'
+    are callables (usually registry values) so that configuration changes
+    take effect immediately; a value of zero means no limit."""
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the value stored for 'key', or None if there is no such
+        entry or it has expired."""
+        self.lock.acquire()
+        try:
+            try:
+                (stamp, value) = self.entries.pop(key)
+            except KeyError:
+                return None
+            ttl = self.ttl()
+            if ttl and stamp + ttl < time.time():
+                return None
+            self.entries[key] = (stamp, value)
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        """Stores 'value' for 'key' as the most recently used entry."""
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            size = self.size()
+            while size and len(self.entries) > size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def items(self):
+        """Returns a list of (key, (timestamp, value)) tuples, least recently
+        used first."""
+        self.lock.acquire()
+        try:
+            return self.entries.items()
+        finally:
+            self.lock.release()
+
+    def load(self, items):
+        """Restores the entries returned by items(), as less recently used
+        than those stored so far, which are kept.  The ones that have expired
+        meanwhile are restored too, get() just ignores them."""
+        self.lock.acquire()
+        try:
+            entries = OrderedDict([(key, entry) for (key, entry) in items
+                                   if key not in self.entries])
+            entries.update(self.entries)
+            self.entries = entries
+            size = self.size()
+            while size and len(self.entries) > size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+
+# The keywords of a summary that make its body, shared by the identical
+# summaries of different releases and languages.
+BODY = ('name', 'synopsis', 'description')
+
+class Body(object):
+    """The parsed keywords of a summary, stored once for all the records that
+    have the same ones.  Keywords that weren't parsed are None."""
+    __slots__ = ('fields', 'refs')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.refs = 0
+
+    def size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.fields) + \
+               sum([sys.getsizeof(s) for s in self.fields if s is not None])
+
+
+class Record(object):
+    """A cached summary of a lookup: the section and language the page was
+    found in, the Body of its keywords, the validators of the response, when
+    it was fetched and when it was last used.  A URL of the usual form is
+    kept as the base URL only, which all the records share; others are kept
+    whole."""
+    __slots__ = ('section', 'language', 'base', 'url', 'etag', 'modified',
+                 'body', 'stamp', 'used')
+
+    def size(self):
+        """Returns the bytes the record takes besides its body and its
+        interned strings: the record, its key and its entry in the table,
+        the times and the strings of its own."""
+        return RECORD_OVERHEAD + \
+               sum([sys.getsizeof(s) for s in (self.url, self.etag)
+                    if s is not None])
+
+
+# Bytes taken by a record besides its own strings: the Record, its two
+# times, its (release, language, command) key and its slot in the table.
+RECORD_OVERHEAD = sys.getsizeof(Record()) + 2 * sys.getsizeof(0.0) + \
+                  sys.getsizeof((1, 2, 3)) + 3 * 8 * 2
+
+def suffix(release, language, section, command):
+    """Returns the end of the URL of a manual page after the base URL."""
+    return utils.web.urlquote('/%s/%s/man%s/%s.%s.html' % (release, language,
+                              section, command, section))
+
+class SummaryStore:
+    """Compact store of the summaries of the lookups, under (release,
+    language, command).  A summary is kept as a Record with slots instead of
+    a dictionary, the release, language, section and command strings and
+    the base URLs are interned, and the keywords are kept in a Body shared
+    by all the identical summaries, like those of most pages in consecutive
+    releases or of a lookup in a language that found the English page.
+
+    The store is bounded by the bytes its records and bodies take, as
+    estimated with sys.getsizeof, rather than by their number.  When there
+    are more than 'maxBytes', the least recently used records are dropped,
+    a tenth of the bytes at once, so that the records don't need to be kept
+    in order of use.  'ttl' and 'maxBytes' are callables (usually registry
+    values); zero means no limit."""
+
+    def __init__(self, ttl, maxBytes):
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        # (release, language, command) -> Record
+        self.records = {}
+        # the fields tuple -> Body
+        self.bodies = {}
+        self.bytes = 0
+        # counts the uses of the records, to tell the least recent ones;
+        # the restored records count down from zero
+        self.clock = 0
+        self.oldest = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, release, language, command, keys):
+        """Returns a (summary, expired) tuple for a lookup, or None if it
+        isn't stored or the summary lacks some of the needed 'keys'."""
+        key = (release, language, command)
+        self.lock.acquire()
+        try:
+            record = self.records.get(key)
+            if record is None:
+                return None
+            fields = record.body.fields
+            for name in keys:
+                if name in BODY and fields[BODY.index(name)] is None:
+                    return None
+            self.clock += 1
+            record.used = self.clock
+            ttl = self.ttl()
+            expired = bool(ttl and record.stamp + ttl < time.time())
+            return (self.__summary(key, record), expired)
+        finally:
+            self.lock.release()
+
+    def __summary(self, key, record):
+        (release, language, command) = key
+        summary = {'command':command, 'section':record.section,
+                   'language':record.language}
+        if record.url is None:
+            summary['url'] = record.base + suffix(release, record.language,
+                                                  record.section, command)
+        else:
+            summary['url'] = record.url
+        for name in ('etag', 'modified'):
+            value = getattr(record, name)
+            if value is not None:
+                summary[name] = value
+        for (name, value) in zip(BODY, record.body.fields):
+            if value is not None:
+                summary[name] = value
+        return summary
+
+    def set(self, release, language, command, summary, stamp=None):
+        """Stores the summary of a lookup.  'summary' must have the
+        'language' and 'section' keys telling where the page was found."""
+        self.__store(release, language, command, summary, stamp, False)
+
+    def __store(self, release, language, command, summary, stamp, restore):
+        key = (intern(release), intern(language), intern(command))
+        record = Record()
+        record.section = intern(summary['section'])
+        record.language = intern(summary['language'])
+        url = summary['url']
+        end = suffix(release, record.language, record.section, command)
+        if url.endswith(end):
+            (record.base, record.url) = (intern(url[:-len(end)]), None)
+        else:
+            (record.base, record.url) = (None, url)
+        record.etag = summary.get('etag')
+        record.modified = summary.get('modified')
+        if record.modified is not None:
+            # The Last-Modified dates are often the same.
+            record.modified = intern(record.modified)
+        record.stamp = stamp or time.time()
+        fields = tuple([summary.get(name) for name in BODY])
+        self.lock.acquire()
+        try:
+            maxBytes = self.maxBytes()
+            if restore:
+                # A restored record is older than all the others, so it
+                # neither replaces one nor makes room for itself.
+                if key in self.records or \
+                   (maxBytes and self.bytes > maxBytes):
+                    return
+                self.oldest -= 1
+                record.used = self.oldest
+            else:
+                old = self.records.pop(key, None)
+                if old is not None:
+                    self.__drop(old)
+                self.clock += 1
+                record.used = self.clock
+            body = self.bodies.get(fields)
+            if body is None:
+                body = self.bodies[fields] = Body(fields)
+                self.bytes += body.size()
+            body.refs += 1
+            record.body = body
+            self.records[key] = record
+            self.bytes += record.size()
+            if maxBytes and self.bytes > maxBytes:
+                self.__evict(maxBytes - maxBytes // 10)
+        finally:
+            self.lock.release()
+
+    def __drop(self, record):
+        """Takes a record that is no longer stored out of the byte count."""
+        self.bytes -= record.size()
+        body = record.body
+        body.refs -= 1
+        if not body.refs:
+            del self.bodies[body.fields]
+            self.bytes -= body.size()
+
+    def __evict(self, maxBytes):
+        """Drops the least recently used records until there are at most
+        'maxBytes' bytes."""
+        L = [(record.used, key) for (key, record) in self.records.iteritems()]
+        L.sort()
+        for (used, key) in L:
+            if self.bytes <= maxBytes:
+                break
+            self.__drop(self.records.pop(key))
+
+    def delete(self, release, language, command):
+        """Forgets a lookup."""
+        self.lock.acquire()
+        try:
+            record = self.records.pop((release, language, command), None)
+            if record is not None:
+                self.__drop(record)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.records.clear()
+            self.bodies.clear()
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def items(self):
+        """Returns the records as a list of (timestamp, release, language,
+        summary) tuples, most recently used first."""
+        self.lock.acquire()
+        try:
+            L = [(record.used, key, record)
+                 for (key, record) in self.records.iteritems()]
+            L.sort(reverse=True)
+            return [(record.stamp, key[0], key[1],
+                     self.__summary(key, record)) for (used, key, record) in L]
+        finally:
+            self.lock.release()
+
+    def load(self, items):
+        """Restores the records returned by items(), as less recently used
+        than those stored so far.  The lookups stored meanwhile are kept,
+        and the records that don't fit in 'maxBytes' are left out."""
+        for (stamp, release, language, summary) in items:
+            self.__store(release, language, summary['command'], summary,
+                         stamp, True)
+
+    def memory(self):
+        """Returns the (records, bodies, bytes) tuple of the store, where
+        bytes is what all its objects really take: the tables, the records,
+        the bodies and every distinct string once."""
+        self.lock.acquire()
+        try:
+            seen = set()
+            def size(obj):
+                if obj is None or id(obj) in seen:
+                    return 0
+                seen.add(id(obj))
+                return sys.getsizeof(obj)
+            total = size(self.records) + size(self.bodies)
+            for (key, record) in self.records.iteritems():
+                total += size(key) + size(record) + size(record.stamp) + \
+                         size(record.used)
+                for obj in key:
+                    total += size(obj)
+                for obj in (record.section, record.language, record.base,
+                            record.url, record.etag, record.modified):
+                    total += size(obj)
+                body = record.body
+                if id(body) not in seen:
+                    total += size(body) + size(body.fields)
+                    for obj in body.fields:
+                        total += size(obj)
+            return (len(self.records), len(self.bodies), total)
+        finally:
+            self.lock.release()
+
+
+class SummaryCache:
+    """Cache of parsed manual page summaries.  A summary is a dictionary with
+    the parsed keywords (name, synopsis, description) plus the url and the
+    command, stored under the (release, language, command) lookup with the
+    section and the language the page was found in.
+
+    Lookups that found no manual page at all are remembered separately, with
+    their own (usually shorter) time-to-live and size limit, so that repeated
+    misses don't probe the repository again.
+
+    The cache also counts how many times each page has been asked for, so
+    that the most popular ones can be prefetched.
+
+    The summaries are kept in a SummaryStore of at most 'maxBytes' bytes.
+    They, the misses and the counts are written to the snapshot 'filename'
+    by flush() so that they survive bot restarts, the most recently used
+    summaries first; 'dirty' tells whether anything has changed since the
+    snapshot was loaded or written.  With 'background', the snapshot is
+    loaded by a WarmUp thread instead of before the constructor returns, and
+    the summaries can be used as soon as they are loaded."""
+
+    def __init__(self, filename, ttl, maxBytes, missTtl, missSize,
+                 background=False):
+        self.filename = filename
+        self.store = SummaryStore(ttl, maxBytes)
+        self.misses = LRUCache(missTtl, missSize)
+        self.counts = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.warmUp = None
+        if background and os.path.exists(filename):
+            self.warmUp = snapshot.WarmUp('UbuntuMan cache warm-up', filename,
+                                          self.__loadSection)
+        else:
+            self.load()
+
+    def __len__(self):
+        return len(self.store)
+
+    def get(self, release, language, command, keys):
+        """Returns the cached summary for a lookup, or None if the lookup is
+        not cached, has expired or the summary lacks some of the needed
+        'keys'."""
+        entry = self.store.get(release, language, command, keys)
+        if entry is None or entry[1]:
+            return None
+        return entry[0]
+
+    def lookup(self, release, language, command, keys):
+        """Like get(), but returns a (summary, expired) tuple, expired
+        summaries included."""
+        return self.store.get(release, language, command, keys)
+
+    def delete(self, release, language, command):
+        """Forgets where a lookup was resolved to, so that it is looked up
+        again."""
+        self.store.delete(release, language, command)
+        self.dirty = True
+
+    def set(self, release, language, command, summary):
+        """Stores the summary of a lookup.  'summary' must have the
+        'language' and 'section' keys telling where the page was found."""
+        self.store.set(release, language, command, summary)
+        self.dirty = True
+
+    def isMiss(self, release, language, command):
+        """Returns True if the lookup is known to have no manual page."""
+        return self.misses.get((release, language, command)) is not None
+
+    def setMiss(self, release, language, command):
+        """Remembers that the lookup has no manual page."""
+        self.misses.set((release, language, command), True)
+        self.dirty = True
+
+    def clearMisses(self):
+        """Forgets the lookups known to have no manual page."""
+        self.misses.clear()
+        self.dirty = True
+
+    def count(self, release, language, command):
+        """Counts a request for the manual page of a lookup."""
+        key = (release, language, command)
+        self.lock.acquire()
+        try:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+    def top(self, release, language, n):
+        """Returns the 'n' most requested commands of a release and
+        language, the most requested first."""
+        self.lock.acquire()
+        try:
+            L = [(count, command) for ((rel, lang, command), count)
+                                  in self.counts.iteritems()
+                                  if rel == release and lang == language]
+        finally:
+            self.lock.release()
+        L.sort(key=lambda (count, command): (-count, command))
+        return [command for (count, command) in L[:n]]
+
+    def clear(self):
+        self.store.clear()
+        self.misses.clear()
+        self.dirty = True
+
+    def __loadSection(self, name, items):
+        if name == 'summaries':
+            self.store.load(items)
+        elif name == 'misses':
+            self.misses.load(items)
+        elif name == 'counts':
+            self.lock.acquire()
+            try:
+                for (key, count) in items:
+                    self.counts[key] = self.counts.get(key, 0) + count
+            finally:
+                self.lock.release()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            if not snapshot.isSnapshot(self.filename):
+                log.warning('UbuntuMan: %s isn\'t a cache snapshot, starting '
+                            'with an empty cache.', self.filename)
+                return
+            reader = snapshot.Reader(self.filename)
+            try:
+                for (name, items) in reader:
+                    self.__loadSection(name, items)
+            finally:
+                reader.close()
+        except Exception, e:
+            log.warning('UbuntuMan: Couldn\'t load the cache from %s: %s',
+                        self.filename, utils.exnToString(e))
+
+    def flush(self):
+        """Writes the snapshot if anything has changed since it was loaded
+        or last written.  It takes a while with a large cache, so it's meant
+        to be called from a worker thread, and once more on unload.  While
+        the snapshot is still being loaded, nothing is written, since that
+        would lose the rest of it; the changes are written the next time."""
+        if self.warmUp is not None and not self.warmUp.isDone():
+            return
+        if not self.dirty:
+            return
+        fd = utils.file.AtomicFile(self.filename, 'wb')
+        try:
+            self.lock.acquire()
+            try:
+                counts = self.counts.items()
+                self.dirty = False
+            finally:
+                self.lock.release()
+            # The misses and the counts are small and needed first.
+            snapshot.write(fd, [('misses', self.misses.items()),
+                                ('counts', counts),
+                                ('summaries', self.store.items())])
+        except Exception, e:
+            fd.rollback()
+            self.dirty = True
+            log.warning('UbuntuMan: Couldn\'t write the cache to %s: %s',
+                        self.filename, utils.exnToString(e))
+        else:
+            fd.close()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
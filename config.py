@@ -54,6 +54,20 @@ conf.registerGlobalValue(UbuntuMan, 'baseurl',
              """Determines the base URL of the manpage repository.
                 Do not end this variable to slash."""))
 
+class Backend(registry.OnlySomeStrings):
+    """Value must be either 'http' or 'local'."""
+    validStrings = ('http', 'local')
+
+conf.registerGlobalValue(UbuntuMan, 'backend',
+    Backend('http', """Determines where the manual pages are read from:
+        'http' fetches them from the manpage repository at baseurl, 'local'
+        reads the manual pages installed in localPath.  URLs always point to
+        the manpage repository."""))
+
+conf.registerGlobalValue(UbuntuMan, 'localPath',
+    registry.String('/usr/share/man', """Determines the directory of the
+        locally installed manual pages used by the 'local' backend."""))
+
 conf.registerGlobalValue(UbuntuMan, 'release',
     registry.String('karmic',
              """Determines the default release to fetch the manual pages for."""))
@@ -78,4 +92,199 @@ conf.registerGlobalValue(UbuntuMan, 'maxLength',
         supybot.reply.mores.length has a value other than zero this register
         has no effect."""))
 
+conf.registerGlobalValue(UbuntuMan, 'maxCommands',
+    registry.PositiveInteger(5, """Determines how many commands the man and
+        manurl commands look up at once."""))
+
+conf.registerGlobalValue(UbuntuMan, 'suggestions',
+    registry.NonNegativeInteger(3, """Determines how many similarly named
+        commands are suggested when there is no manual page for a command.
+        Zero means none."""))
+
+conf.registerGlobalValue(UbuntuMan, 'timeout',
+    registry.PositiveInteger(10, """Determines how many seconds to wait for
+        the manpage repository before giving up on a manual page."""))
+
+conf.registerGlobalValue(UbuntuMan, 'probeWorkers',
+    registry.PositiveInteger(6, """Determines how many manual page URLs are
+        probed at the same time when looking for the section and language a
+        manual page exists in."""))
+
+conf.registerGlobalValue(UbuntuMan, 'threaded',
+    registry.Boolean(True, """Determines whether the manual pages are looked up
+        in a pool of worker threads, so that a slow manpage repository doesn't
+        block the bot.  The reply is sent when the lookup is finished."""))
+
+conf.registerGlobalValue(UbuntuMan, 'lookupWorkers',
+    registry.PositiveInteger(4, """Determines how many manual pages can be
+        looked up at the same time when
+        supybot.plugins.UbuntuMan.threaded is on."""))
+
+conf.registerGroup(UbuntuMan, 'throttle')
+
+conf.registerGlobalValue(UbuntuMan.throttle, 'user',
+    registry.NonNegativeInteger(10, """Determines how many manual pages a
+        user can fetch from the manpage repository per minute in the long
+        run.  The pages answered from the cache don't count; fetches over the
+        limit wait for their turn, at most supybot.plugins.UbuntuMan.timeout
+        seconds.  Zero means no limit."""))
+
+conf.registerGlobalValue(UbuntuMan.throttle, 'userBurst',
+    registry.PositiveInteger(15, """Determines how many manual pages a user
+        can fetch from the manpage repository in a row before
+        supybot.plugins.UbuntuMan.throttle.user applies."""))
+
+conf.registerGlobalValue(UbuntuMan.throttle, 'channel',
+    registry.NonNegativeInteger(30, """Determines how many manual pages can
+        be fetched from the manpage repository per minute in a channel in the
+        long run.  The pages answered from the cache don't count.  Zero means
+        no limit."""))
+
+conf.registerGlobalValue(UbuntuMan.throttle, 'channelBurst',
+    registry.PositiveInteger(30, """Determines how many manual pages can be
+        fetched from the manpage repository in a row in a channel before
+        supybot.plugins.UbuntuMan.throttle.channel applies."""))
+
+conf.registerGlobalValue(UbuntuMan.throttle, 'upstream',
+    registry.NonNegativeInteger(20, """Determines how many requests per
+        second are sent to the manpage repository at most, by all the
+        lookups together.  Zero means no limit."""))
+
+conf.registerGlobalValue(UbuntuMan.throttle, 'queueDepth',
+    registry.NonNegativeInteger(50, """Determines how many lookups can wait
+        for a free lookup worker.  Lookups past that are refused.  Zero
+        means no limit."""))
+
+conf.registerGroup(UbuntuMan, 'http')
+
+conf.registerGlobalValue(UbuntuMan.http, 'poolSize',
+    registry.PositiveInteger(8, """Determines how many connections to the
+        manpage repository can be open at the same time.  Idle connections
+        are kept open and reused for the next requests."""))
+
+conf.registerGlobalValue(UbuntuMan.http, 'connectTimeout',
+    registry.PositiveInteger(5, """Determines how many seconds to wait for a
+        connection to the manpage repository."""))
+
+conf.registerGlobalValue(UbuntuMan.http, 'compress',
+    registry.Boolean(True, """Determines whether the manual pages are
+        requested with gzip or deflate compression."""))
+
+conf.registerGlobalValue(UbuntuMan.http, 'breakerFailures',
+    registry.PositiveInteger(5, """Determines after how many failed requests
+        in a row no more requests are sent to the manpage repository for
+        supybot.plugins.UbuntuMan.http.breakerCooldown seconds."""))
+
+conf.registerGlobalValue(UbuntuMan.http, 'breakerCooldown',
+    registry.PositiveInteger(60, """Determines for how many seconds no
+        requests are sent to the manpage repository once it has failed
+        supybot.plugins.UbuntuMan.http.breakerFailures times in a row."""))
+
+conf.registerGroup(UbuntuMan, 'index')
+
+conf.registerGlobalValue(UbuntuMan.index, 'enable',
+    registry.Boolean(True, """Determines whether the section index built by
+        the manindex command is used to go straight to the section a manual
+        page is in.  Commands missing from the index are answered without
+        contacting the manpage repository."""))
+
+conf.registerGlobalValue(UbuntuMan.index, 'mirror',
+    registry.String('', """Determines the directory of a local mirror of the
+        manpage repository (laid out as <release>/<language>/man<section>/)
+        the manindex command builds the index from.  If empty, the index is
+        built from the directory listings of the repository."""))
+
+conf.registerGroup(UbuntuMan, 'prefetch')
+
+conf.registerGlobalValue(UbuntuMan.prefetch, 'workers',
+    registry.PositiveInteger(4, """Determines how many manual pages the
+        manprefetch command fetches at the same time."""))
+
+conf.registerGlobalValue(UbuntuMan.prefetch, 'rate',
+    registry.PositiveFloat(2.0, """Determines how many manual pages per
+        second the manprefetch command fetches at most."""))
+
+conf.registerGroup(UbuntuMan, 'cache')
+
+conf.registerGlobalValue(UbuntuMan.cache, 'enable',
+    registry.Boolean(True, """Determines whether the parsed manual pages are
+        cached, so that repeated lookups don't download and parse the page
+        again."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'ttl',
+    registry.NonNegativeInteger(604800, """Determines how many seconds a
+        cached manual page is kept before it is fetched again.  Zero means
+        forever."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'serveStale',
+    registry.Boolean(True, """Determines whether a cached manual page older
+        than supybot.plugins.UbuntuMan.cache.ttl is still answered with,
+        while it is fetched again in the background."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'memory',
+    registry.NonNegativeInteger(32, """Determines how many megabytes the
+        cached manual pages can take.  When the cache is full, the least
+        recently used pages are dropped.  Zero means no limit."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'optionPages',
+    registry.NonNegativeInteger(100, """Determines how many manual pages
+        the options looked up by manopt are kept for, so that the other
+        options of a page are answered without fetching it again.  Zero
+        means no limit."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'negativeTtl',
+    registry.NonNegativeInteger(3600, """Determines how many seconds the
+        commands that have no manual page are remembered, so that repeated
+        lookups for them don't probe the repository again.  Zero means
+        forever."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'negativeSize',
+    registry.NonNegativeInteger(1000, """Determines the maximum number of
+        remembered commands that have no manual page.  Zero means no
+        limit."""))
+
+conf.registerGlobalValue(UbuntuMan.cache, 'snapshotInterval',
+    registry.NonNegativeInteger(900, """Determines every how many seconds
+        the cache and the apropos index are written to disk if they have
+        changed, besides when the plugin is unloaded.  Zero means only
+        then."""))
+
+conf.registerGroup(UbuntuMan, 'apropos')
+
+conf.registerGlobalValue(UbuntuMan.apropos, 'maxResults',
+    registry.PositiveInteger(5, """Determines how many manual pages the
+        manapropos command gives at most."""))
+
+conf.registerGroup(UbuntuMan, 'fallback')
+
+conf.registerGlobalValue(UbuntuMan.fallback, 'releases',
+    registry.SpaceSeparatedListOfStrings([], """Determines the releases,
+        newest first, a command that has no manual page in the release asked
+        for is looked up in, the ones nearest to that release in this list
+        first.  The reply tells which release the page came from.  If empty,
+        no other release is looked in."""))
+
+conf.registerGlobalValue(UbuntuMan.fallback, 'maxLookups',
+    registry.NonNegativeInteger(2, """Determines how many fallback releases
+        a lookup looks in the manpage repository at most.  The releases
+        already known to have the page or not to have it, from the cache,
+        the section index or earlier lookups, don't count."""))
+
+conf.registerGlobalValue(UbuntuMan.fallback, 'mapSize',
+    registry.NonNegativeInteger(10000, """Determines how many commands are
+        remembered as having a manual page in a fallback release or not,
+        for as long as supybot.plugins.UbuntuMan.cache.negativeTtl.  Zero
+        means no limit."""))
+
+conf.registerGroup(UbuntuMan, 'stats')
+
+conf.registerGlobalValue(UbuntuMan.stats, 'enable',
+    registry.Boolean(True, """Determines whether the time spent in each
+        stage of the lookups and the lookup counters are recorded for the
+        manstats command."""))
+
+conf.registerGlobalValue(UbuntuMan.stats, 'logInterval',
+    registry.NonNegativeInteger(0, """Determines every how many seconds the
+        statistics are written to the log.  Zero means never."""))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,156 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+def distance(a, b):
+    """Returns the edit distance between two strings, counting the
+    transposition of two adjacent characters as one edit (the optimal string
+    alignment distance)."""
+    if a == b:
+        return 0
+    (la, lb) = (len(a), len(b))
+    if not la or not lb:
+        return la or lb
+    previous = None
+    row = range(lb + 1)
+    for i in xrange(1, la + 1):
+        (before, previous) = (previous, row)
+        row = [i] + [0] * lb
+        for j in xrange(1, lb + 1):
+            cost = a[i - 1] != b[j - 1]
+            row[j] = min(previous[j] + 1, row[j - 1] + 1,
+                         previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and \
+               a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[lb]
+
+def deletes(word):
+    """Returns the strings made by deleting one character of 'word'."""
+    return set([word[:i] + word[i + 1:] for i in xrange(len(word))])
+
+
+class NameIndex:
+    """Fuzzy index of command names, by symmetric deletion: every name is
+    stored under each of the strings made by deleting one of its characters.
+    The names one edit (a transposition included) away from a word share a
+    deletion with it, so a search only looks up the deletions of the word,
+    and whatever the number of names, it costs a few dictionary lookups.
+
+    The deletions are stored by their hash only, to save memory; the few
+    false matches that gives are weeded out by the final distance check."""
+
+    def __init__(self):
+        self.names = set()
+        self.variants = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add(self, name):
+        if name in self.names:
+            return
+        self.lock.acquire()
+        try:
+            self.names.add(name)
+            for variant in deletes(name):
+                key = hash(variant)
+                names = self.variants.get(key)
+                if names is None:
+                    self.variants[key] = name
+                elif isinstance(names, tuple):
+                    self.variants[key] = names + (name, )
+                else:
+                    self.variants[key] = (names, name)
+        finally:
+            self.lock.release()
+
+    def suggest(self, word, limit=3, maxDistance=2):
+        """Returns the names closest to 'word', at most 'limit' of them,
+        nearest first.  The names one edit away are always found, but of
+        those two edits away only the ones sharing a deletion with 'word',
+        like 'bcde' for 'abcd'."""
+        candidates = set()
+        variants = deletes(word)
+        for variant in variants:
+            # A name with one character less than the word.
+            if variant in self.names:
+                candidates.add(variant)
+        variants.add(word)
+        for variant in variants:
+            names = self.variants.get(hash(variant))
+            if names is None:
+                continue
+            if isinstance(names, tuple):
+                candidates.update(names)
+            else:
+                candidates.add(names)
+        candidates.discard(word)
+        L = []
+        for name in candidates:
+            d = distance(word, name)
+            if d <= maxDistance:
+                L.append((d, name))
+        L.sort()
+        return [name for (d, name) in L[:limit]]
+
+
+class NameIndexes:
+    """The NameIndexes of the commands known in each release.  An index is
+    built the first time it's needed by calling 'build' with the release,
+    which returns the names known so far, and names found later are added to
+    it."""
+
+    def __init__(self, build):
+        self.build = build
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, release):
+        self.lock.acquire()
+        try:
+            if release not in self.indexes:
+                index = NameIndex()
+                for name in self.build(release):
+                    index.add(name)
+                self.indexes[release] = index
+            return self.indexes[release]
+        finally:
+            self.lock.release()
+
+    def add(self, release, name):
+        """Adds a name to the index of a release, if it has been built."""
+        index = self.indexes.get(release)
+        if index is not None:
+            index.add(name)
+
+    def invalidate(self, release):
+        """Drops the index of a release, to be built again when needed."""
+        self.lock.acquire()
+        try:
+            self.indexes.pop(release, None)
+        finally:
+            self.lock.release()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
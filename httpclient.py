@@ -0,0 +1,439 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.log as log
+import supybot.utils as utils
+
+import time
+import zlib
+import socket
+import httplib
+import urlparse
+import threading
+
+# Size of the chunks read from the socket.
+CHUNK = 8192
+
+# When a response is closed before its body has been read to the end, the
+# rest of the body is read and thrown away if it is at most this many bytes,
+# so that the connection can be reused; otherwise the connection is closed.
+DRAIN = 16384
+
+class HTTPError(utils.web.Error):
+    """Raised when the server answers with an HTTP error status."""
+    def __init__(self, url, code, reason):
+        utils.web.Error.__init__(self, 'HTTP Error %s: %s' % (code, reason))
+        self.url = url
+        self.code = code
+
+
+class CircuitBreaker:
+    """Stops the requests to a server that keeps failing.  After 'threshold'
+    failures in a row the breaker opens, and the requests fail right away
+    for 'cooldown' seconds.  Then a single request is let through to try the
+    server again; if it succeeds the breaker closes, otherwise it opens for
+    another cooldown.  'threshold' and 'cooldown' are callables (usually
+    registry values)."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openedAt = None
+        self.trying = False
+        self.lock = threading.Lock()
+
+    def isOpen(self):
+        return self.openedAt is not None
+
+    def allow(self):
+        """Returns whether a request can be sent."""
+        self.lock.acquire()
+        try:
+            if self.openedAt is None:
+                return True
+            if self.trying or time.time() < self.openedAt + self.cooldown():
+                return False
+            self.trying = True
+            return True
+        finally:
+            self.lock.release()
+
+    def succeeded(self):
+        self.lock.acquire()
+        try:
+            if self.openedAt is not None:
+                log.info('UbuntuMan: The manpage repository answers again.')
+            self.failures = 0
+            self.openedAt = None
+            self.trying = False
+        finally:
+            self.lock.release()
+
+    def failed(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.trying or (self.openedAt is None and
+                               self.failures >= self.threshold()):
+                if self.openedAt is None:
+                    log.warning('UbuntuMan: %s requests to the manpage '
+                                'repository failed in a row, stopping them '
+                                'for %s seconds.', self.failures,
+                                self.cooldown())
+                self.openedAt = time.time()
+            self.trying = False
+        finally:
+            self.lock.release()
+
+
+class Response:
+    """File like object for the body of an HTTP response.  Compressed bodies
+    are decompressed on the fly as they are read, so readline() works on a
+    gzipped page without downloading all of it first.  Closing the response
+    gives its connection back to the pool."""
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+        self.bytesRead = 0
+        # Seconds spent waiting for the body, as opposed to decompressing
+        # and parsing it.
+        self.readTime = 0.0
+        self.buffer = ''
+        self.pos = 0
+        self.rawDeflate = None
+        encoding = (response.getheader('content-encoding') or '').lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = zlib.decompressobj()
+            self.rawDeflate = False
+        else:
+            self.decoder = None
+
+    def getheader(self, name, default=None):
+        # The headers are still there once the response is closed.
+        return self.headers.getheader(name, default)
+
+    def __decompress(self, data):
+        try:
+            return self.decoder.decompress(data)
+        except zlib.error:
+            if self.rawDeflate is not False or self.bytesRead != len(data):
+                raise
+            # Some servers send raw deflate data without the zlib header.
+            self.rawDeflate = True
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decoder.decompress(data)
+
+    def __fill(self):
+        """Reads the next chunk of the body into the buffer.  Returns False
+        when the end of the body has been reached."""
+        if self.response is None:
+            return False
+        try:
+            started = time.time()
+            data = self.response.read(CHUNK)
+            self.readTime += time.time() - started
+            self.bytesRead += len(data)
+            if self.decoder is not None:
+                data = self.__decompress(data)
+                if not self.response.fp:
+                    data += self.decoder.flush()
+        except (socket.error, httplib.HTTPException, zlib.error), e:
+            self.__discard()
+            raise utils.web.Error(utils.web.strError(e))
+        if not self.response.fp:
+            # The body has been read to the end.
+            self.__release()
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return bool(data) or self.response is not None
+
+    def readline(self):
+        while True:
+            idx = self.buffer.find('\n', self.pos)
+            if idx > -1:
+                ln = self.buffer[self.pos:idx + 1]
+                self.pos = idx + 1
+                return ln
+            if not self.__fill():
+                ln = self.buffer[self.pos:]
+                self.buffer = ''
+                self.pos = 0
+                return ln
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self.__fill():
+                break
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            ln = self.readline()
+            if not ln:
+                return
+            yield ln
+
+    def __release(self):
+        if self.response is not None:
+            self.response = None
+            self.pool.release(self.key, self.conn)
+
+    def __discard(self):
+        if self.response is not None:
+            self.response = None
+            self.pool.discard(self.conn)
+
+    def close(self):
+        """Closes the response.  If the body hasn't been read to the end, the
+        connection can only be reused when the rest of the body is small."""
+        if self.response is None:
+            return
+        length = self.response.length
+        if length is not None and length <= DRAIN:
+            try:
+                while self.response is not None and \
+                      self.response.read(CHUNK):
+                    pass
+            except (socket.error, httplib.HTTPException):
+                self.__discard()
+                return
+            if self.response is not None and not self.response.fp:
+                self.__release()
+        self.__discard()
+
+
+class ConnectionPool:
+    """A pool of persistent HTTP connections.  Connections are kept open
+    between requests (HTTP keep-alive) and reused, and compressed transfer is
+    negotiated with the server.  'size' limits the number of connections
+    open at the same time.  'size', 'connectTimeout', 'readTimeout' and
+    'compress' are callables (usually registry values).  If a 'limiter'
+    TokenBucket is given, every request takes a token from it, waiting for
+    one at most the read timeout.  If a 'breaker' CircuitBreaker is given,
+    the network errors and the server errors are reported to it, and no
+    request is sent while it is open."""
+
+    def __init__(self, size, connectTimeout, readTimeout, compress,
+                 limiter=None, breaker=None):
+        self.size = size
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.compress = compress
+        self.limiter = limiter
+        self.breaker = breaker
+        self.idle = {}
+        self.open = 0
+        self.cond = threading.Condition()
+
+    def __acquire(self, key):
+        """Returns a (connection, reused) tuple for 'key'."""
+        deadline = time.time() + self.connectTimeout()
+        self.cond.acquire()
+        try:
+            while True:
+                if self.idle.get(key):
+                    return (self.idle[key].pop(), True)
+                if self.open < max(1, self.size()):
+                    self.open += 1
+                    break
+                # Make room by closing an idle connection to another host.
+                for conns in self.idle.itervalues():
+                    if conns:
+                        conns.pop(0).close()
+                        self.open -= 1
+                        break
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise utils.web.Error(utils.web.TIMED_OUT)
+                    self.cond.wait(timeout)
+        finally:
+            self.cond.release()
+        (scheme, host, port, tunnel) = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port,
+                                           timeout=self.connectTimeout())
+        else:
+            conn = httplib.HTTPConnection(host, port,
+                                          timeout=self.connectTimeout())
+        if tunnel:
+            conn.set_tunnel(*tunnel)
+        return (conn, False)
+
+    def release(self, key, conn):
+        """Gives an idle connection back to the pool."""
+        if conn.sock is None:
+            # The server closed the connection after the response.
+            self.discard(conn)
+            return
+        self.cond.acquire()
+        try:
+            self.idle.setdefault(key, []).append(conn)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def discard(self, conn):
+        """Closes a connection that can't be reused."""
+        conn.close()
+        self.cond.acquire()
+        try:
+            self.open -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Closes all the idle connections."""
+        self.cond.acquire()
+        try:
+            for conns in self.idle.itervalues():
+                for conn in conns:
+                    conn.close()
+                    self.open -= 1
+            self.idle.clear()
+        finally:
+            self.cond.release()
+
+    def __route(self, url):
+        """Returns the pool key and the request path for 'url'."""
+        (scheme, loc, path, query, frag) = urlparse.urlsplit(url)
+        if scheme not in ('http', 'https'):
+            raise utils.web.Error('Invalid URL: %s' % url)
+        (host, port) = splitHostPort(loc, scheme)
+        path = urlparse.urlunsplit(('', '', path or '/', query, ''))
+        proxy = force(utils.web.proxy)
+        if not proxy:
+            return ((scheme, host, port, None), path)
+        (proxyHost, proxyPort) = splitHostPort(proxy, 'http')
+        if scheme == 'https':
+            return (('https', proxyHost, proxyPort, (host, port)), path)
+        return (('http', proxyHost, proxyPort, None), url)
+
+    def request(self, url, method='GET', headers=None, redirects=5):
+        """Sends a request and returns the Response.  Redirections are
+        followed; HTTP error statuses raise HTTPError and network errors
+        raise utils.web.Error."""
+        for i in xrange(redirects + 1):
+            response = self.__request(url, method, headers)
+            if response.status in (301, 302, 303, 307) and \
+               response.getheader('location'):
+                response.close()
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                reason = response.response.reason
+                response.close()
+                raise HTTPError(url, response.status, reason)
+            return response
+        raise utils.web.Error('Too many redirections: %s' % url)
+
+    def probe(self, url, redirects=5):
+        """Checks that 'url' exists without downloading it: sends a HEAD
+        request or, if the server doesn't allow them, a GET of the first
+        byte only.  Returns the URL the redirections lead to; HTTP error
+        statuses raise HTTPError and network errors raise utils.web.Error."""
+        try:
+            response = self.request(url, 'HEAD', redirects=redirects)
+        except HTTPError, e:
+            if e.code not in (405, 501):
+                raise
+            response = self.request(url, headers={'Range':'bytes=0-0'},
+                                    redirects=redirects)
+        response.close()
+        return response.url
+
+    def __request(self, url, method, headers):
+        (key, path) = self.__route(url)
+        if self.limiter is not None:
+            delay = self.limiter.reserve(self.readTimeout())
+            if delay is None:
+                raise utils.web.Error('Too many requests to %s' % key[1])
+            if delay:
+                time.sleep(delay)
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            raise utils.web.Error('%s is not answering, not trying again '
+                                  'yet' % key[1])
+        allHeaders = dict(utils.web.defaultHeaders)
+        if self.compress():
+            allHeaders['Accept-Encoding'] = 'gzip, deflate'
+        if headers:
+            allHeaders.update(headers)
+        while True:
+            try:
+                (conn, reused) = self.__acquire(key)
+            except utils.web.Error:
+                # All the connections are busy with a slow server.
+                if breaker is not None:
+                    breaker.failed()
+                raise
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(self.readTimeout())
+                conn.request(method, path, headers=allHeaders)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                self.discard(conn)
+                if reused:
+                    # The server may have closed the idle connection
+                    # meanwhile; try again with a new one.
+                    continue
+                if breaker is not None:
+                    breaker.failed()
+                if isinstance(e, socket.timeout):
+                    raise utils.web.Error(utils.web.TIMED_OUT)
+                raise utils.web.Error(utils.web.strError(e))
+            if breaker is not None:
+                if response.status >= 500:
+                    breaker.failed()
+                else:
+                    breaker.succeeded()
+            return Response(self, key, conn, response, url)
+
+
+def splitHostPort(loc, scheme):
+    """Splits 'host:port', defaulting to the port of 'scheme'."""
+    if '@' in loc:
+        loc = loc.split('@', 1)[1]
+    if ':' in loc and not loc.endswith(']'):
+        (host, port) = loc.rsplit(':', 1)
+        try:
+            return (host, int(port))
+        except ValueError:
+            raise utils.web.Error('Invalid URL: %s' % loc)
+    if scheme == 'https':
+        return (loc, 443)
+    return (loc, 80)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
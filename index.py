@@ -0,0 +1,203 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.utils as utils
+
+import os
+import re
+import gzip
+import mmap
+import threading
+
+# Matches the links to the manual pages in a directory listing of the
+# manpage repository, e.g. href="grep.1.html".
+linkRe = re.compile(r'href="(?:\./)?([^"/?#]+)\.([^."/?#]+)\.html"')
+
+class SectionIndex:
+    """Index of the sections the manual pages of one release and language
+    exist in.  The index is a text file of sorted 'command<TAB>sections'
+    lines, where sections is a comma separated list.  The file is memory
+    mapped and binary searched, so it is shared with the page cache and
+    costs almost no memory of its own."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        fd = open(filename, 'rb')
+        try:
+            if os.fstat(fd.fileno()).st_size:
+                self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''
+        finally:
+            fd.close()
+
+    def __len__(self):
+        (count, pos) = (0, self.data.find('\n'))
+        while pos > -1:
+            count += 1
+            pos = self.data.find('\n', pos + 1)
+        return count
+
+    def lookup(self, command):
+        """Returns the list of sections 'command' has a manual page in, or
+        None if there is no manual page for it."""
+        data = self.data
+        (lo, hi) = (0, len(data))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind('\n', 0, mid) + 1
+            end = data.find('\n', start)
+            (name, sections) = data[start:end].split('\t', 1)
+            if name < command:
+                lo = end + 1
+            elif name > command:
+                hi = start
+            else:
+                return sections.split(',')
+        return None
+
+    def __iter__(self):
+        """Iterates over the (command, sections) pairs in the index."""
+        start = 0
+        while start < len(self.data):
+            end = self.data.find('\n', start)
+            (name, sections) = self.data[start:end].split('\t', 1)
+            yield (name, sections.split(','))
+            start = end + 1
+
+    def close(self):
+        if not isinstance(self.data, str):
+            self.data.close()
+        self.data = ''
+
+    def write(cls, filename, pages):
+        """Writes an index file.  'pages' maps each command to the list of
+        sections it has a manual page in."""
+        fd = utils.file.AtomicFile(filename, 'wb')
+        try:
+            for command in sorted(pages):
+                fd.write('%s\t%s\n' % (command, ','.join(pages[command])))
+        except:
+            fd.rollback()
+            raise
+        fd.close()
+    write = classmethod(write)
+
+
+class SectionIndexes:
+    """The section indexes of all the releases and languages, stored as
+    '<release>.<language>' files in a directory and opened on demand."""
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def filename(self, release, language):
+        return os.path.join(self.dirname, '%s.%s' % (release, language))
+
+    def get(self, release, language):
+        """Returns the SectionIndex of a release and language, or None if it
+        hasn't been built."""
+        key = (release, language)
+        self.lock.acquire()
+        try:
+            if key not in self.indexes:
+                filename = self.filename(release, language)
+                if os.path.exists(filename):
+                    self.indexes[key] = SectionIndex(filename)
+                else:
+                    self.indexes[key] = None
+            return self.indexes[key]
+        finally:
+            self.lock.release()
+
+    def languages(self, release):
+        """Returns the languages of a release that have been indexed."""
+        if not os.path.isdir(self.dirname):
+            return []
+        prefix = release + '.'
+        return [filename[len(prefix):] for filename in os.listdir(self.dirname)
+                if filename.startswith(prefix)]
+
+    def store(self, release, language, pages):
+        """Writes a new index for the release and language and starts using
+        it.  Returns the new SectionIndex."""
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        filename = self.filename(release, language)
+        SectionIndex.write(filename, pages)
+        self.lock.acquire()
+        try:
+            old = self.indexes.get((release, language))
+            self.indexes[(release, language)] = SectionIndex(filename)
+        finally:
+            self.lock.release()
+        if old is not None:
+            old.close()
+        return self.indexes[(release, language)]
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for index in self.indexes.itervalues():
+                if index is not None:
+                    index.close()
+            self.indexes.clear()
+        finally:
+            self.lock.release()
+
+
+def parseListing(html, section):
+    """Returns the commands linked from the directory listing of a section
+    in the manpage repository."""
+    commands = []
+    for (command, sec) in linkRe.findall(html):
+        if sec == section:
+            commands.append(command)
+    return commands
+
+def scanMirror(dirname, section):
+    """Returns the commands of a section in a directory of a local mirror
+    of the manpage repository."""
+    commands = []
+    if not os.path.isdir(dirname):
+        return commands
+    suffix = '.%s.html' % section
+    for filename in os.listdir(dirname):
+        if filename.endswith('.gz'):
+            filename = filename[:-3]
+        if filename.endswith(suffix):
+            commands.append(filename[:-len(suffix)])
+    return commands
+
+def openMirrorPage(filename):
+    """Opens a manual page of a local mirror, which may be gzipped."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename)
+
+def addPages(pages, commands, section):
+    """Adds the commands of a section to a command -> sections mapping."""
+    for command in commands:
+        sections = pages.setdefault(command, [])
+        if section not in sections:
+            sections.append(section)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,218 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.log as log
+
+import os
+import re
+import gzip
+
+# Named characters, as in \(em or \[em], that have a plain text equivalent.
+# The rest are dropped.
+namedChars = {
+    'aq':"'", 'dq':'"', 'lq':'"', 'rq':'"', 'oq':"'", 'cq':"'", 'ga':'`',
+    'em':'-', 'en':'-', 'hy':'-', 'mi':'-', 'bu':'*', 'ti':'~', 'ha':'^',
+    'sl':'/', 'rs':'\\', 'ba':'|', 'at':'@', 'lB':'[', 'rB':']',
+    'co':'(C)', 'rg':'(R)', 'tm':'(TM)',
+}
+
+# Simple escapes and what they stand for.
+simpleEscapes = {
+    '-':'-', 'e':'\\', '\\':'\\', "'":"'", '`':'`', '.':'.', ' ':' ',
+    '~':' ', '0':' ',
+}
+
+escapeRe = re.compile(r'\\(\(..|\[[^\]]*\]|[fFn*](?:\(..|\[[^\]]*\]|.)|'
+                      r's[-+]?\d+|.)')
+
+# Macros that print their arguments alternating between two fonts, without
+# spaces in between.
+alternatingMacros = ('BR', 'BI', 'IB', 'IR', 'RB', 'RI')
+
+# Macros that print their arguments in one font.
+fontMacros = ('B', 'I', 'SM', 'SB')
+
+# Macros that break the text into a new line or paragraph.
+breakMacros = ('br', 'sp', 'PP', 'LP', 'P', 'TP', 'IP', 'HP', 'SS', 'RS',
+               'RE', 'nf', 'fi', 'TQ', 'EX', 'EE', 'in', 'ti')
+
+def _replaceEscape(m):
+    escape = m.group(1)
+    if escape.startswith('('):
+        return namedChars.get(escape[1:], '')
+    if escape.startswith('['):
+        return namedChars.get(escape[1:-1], '')
+    if escape[0] == '*' and escape[1:] in ('(lq', '(rq', '[lq]', '[rq]'):
+        return '"'
+    return simpleEscapes.get(escape, '')
+
+def troffToText(s):
+    """Converts a line of troff text to plain text, dropping comments and
+    font changes and replacing the escapes by the characters they mean."""
+    idx = s.find('\\"')
+    if idx > -1:
+        s = s[:idx]
+    return escapeRe.sub(_replaceEscape, s)
+
+def splitArgs(s):
+    """Splits the arguments of a troff macro, honouring double quotes."""
+    args = []
+    for (quoted, plain) in re.findall(r'"((?:[^"]|"")*)"?|(\S+)', s):
+        if plain:
+            args.append(plain)
+        else:
+            args.append(quoted.replace('""', '"'))
+    return args
+
+def iterSections(fd):
+    """Reads a troff manual page and yields a (heading, lines) tuple for
+    each section, where lines is the text of the section as plain text lines
+    and an empty string marks a break.  The page is read lazily, so the
+    caller can stop as soon as it has the sections it needs."""
+    (heading, lines) = (None, [])
+    while True:
+        ln = fd.readline()
+        if not ln:
+            break
+        ln = ln.rstrip('\r\n')
+        while ln.endswith('\\') and not ln.endswith('\\\\'):
+            # An escaped newline continues the line.
+            ln = ln[:-1] + fd.readline().rstrip('\r\n')
+        if not ln.startswith('.') and not ln.startswith("'"):
+            text = troffToText(ln).strip()
+            if text:
+                lines.append(text)
+            elif lines and lines[-1]:
+                lines.append('')
+            continue
+        macro = ln[1:].lstrip()
+        if macro.startswith('\\"'):
+            continue
+        parts = macro.split(None, 1)
+        if not parts:
+            continue
+        (name, rest) = (parts[0], len(parts) > 1 and parts[1] or '')
+        if name in ('SH', 'Sh'):
+            if heading is not None:
+                yield (heading, lines)
+            heading = troffToText(' '.join(splitArgs(rest))).strip()
+            lines = []
+        elif name in alternatingMacros:
+            text = ''.join([troffToText(arg) for arg in splitArgs(rest)])
+            if text.strip():
+                lines.append(text.strip())
+        elif name in fontMacros:
+            text = ' '.join([troffToText(arg) for arg in splitArgs(rest)])
+            if text.strip():
+                lines.append(text.strip())
+        elif name in breakMacros:
+            if lines and lines[-1]:
+                lines.append('')
+            if name == 'IP' and rest:
+                text = troffToText(splitArgs(rest)[0]).strip()
+                if text:
+                    lines.append(text)
+    if heading is not None:
+        yield (heading, lines)
+
+
+class LocalPages:
+    """Index of the manual pages installed in a local man directory such as
+    /usr/share/man, where the English pages are in man<section>/ and the
+    translations in <language>/man<section>/.  The directories are scanned
+    once, so finding a page is a dictionary lookup."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.scan()
+
+    def scan(self):
+        pages = {}
+        if os.path.isdir(self.path):
+            for entry in sorted(os.listdir(self.path)):
+                dirname = os.path.join(self.path, entry)
+                if entry.startswith('man'):
+                    self.__scanSection(pages, 'en', dirname, entry[3:])
+                elif os.path.isdir(dirname):
+                    # Directories like de, pt_BR or fr.UTF-8.
+                    language = entry.split('.')[0]
+                    for subentry in sorted(os.listdir(dirname)):
+                        if subentry.startswith('man'):
+                            self.__scanSection(pages, language,
+                                os.path.join(dirname, subentry),
+                                subentry[3:])
+        else:
+            log.warning('UbuntuMan: %s is not a directory.', self.path)
+        self.pages = pages
+
+    def __scanSection(self, pages, language, dirname, section):
+        if not os.path.isdir(dirname):
+            return
+        for filename in os.listdir(dirname):
+            name = filename
+            if name.endswith('.gz'):
+                name = name[:-3]
+            # The extension is the section, possibly with a suffix like
+            # 1ssl or 3pm.
+            (command, dot, ext) = name.rpartition('.')
+            if not dot or not command or not ext.startswith(section):
+                continue
+            sections = pages.setdefault((language, command), {})
+            # A page of the plain section wins over one with a suffix, e.g.
+            # passwd.1 over passwd.1ssl.
+            if ext == section or section not in sections:
+                sections[section] = os.path.join(dirname, filename)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def find(self, language, command, section):
+        """Returns the filename of the manual page, or None if it is not
+        installed."""
+        return self.pages.get((language, command), {}).get(section)
+
+    def commands(self, language):
+        """Returns the list of the commands installed for a language."""
+        return [command for (lang, command) in self.pages
+                        if lang == language]
+
+    def open(self, filename, redirects=3):
+        """Opens an installed manual page, following the '.so' requests
+        pages that are just links to other pages consist of."""
+        if filename.endswith('.gz'):
+            fd = gzip.open(filename)
+        else:
+            fd = open(filename)
+        ln = fd.readline()
+        if not ln.startswith('.so ') or not redirects:
+            fd.seek(0)
+            return fd
+        fd.close()
+        # The link is relative to the root of the man directory of the
+        # language, i.e. the parent of the man<section> directory.
+        root = os.path.dirname(os.path.dirname(filename))
+        target = os.path.join(root, ln[4:].strip())
+        for candidate in (target, target + '.gz'):
+            if os.path.exists(candidate):
+                return self.open(candidate, redirects - 1)
+        raise IOError('Broken manual page link %s in %s' %
+                      (ln[4:].strip(), filename))
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
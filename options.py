@@ -0,0 +1,108 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.utils as utils
+
+import re
+
+import template
+
+# The options a term introduces, as in '-A NUM, --after-context=NUM' or
+# '-r, -R, --recursive': a dash or two starting the term or following a
+# space, a comma, a bracket or a bar.
+optionRe = re.compile(r'(?:^|(?<=[\s,\[|]))(--?[A-Za-z0-9?#@][\w?#@+.-]*)')
+
+def names(term):
+    """Returns the options the term of an entry introduces."""
+    return [m.group(1).rstrip('.') for m in optionRe.finditer(term)]
+
+def normalize(option):
+    """Returns the options an option as asked for may be: '--color=auto'
+    is '--color', and 'r' and 'recursive' without their dashes are '-r' and
+    '--recursive'."""
+    option = option.split('=', 1)[0].split('[', 1)[0]
+    if option.startswith('-'):
+        return [option]
+    if len(option) == 1:
+        return ['-' + option, '--' + option]
+    return ['--' + option, '-' + option]
+
+
+class OptionIndex:
+    """The options of a manual page.  Every option maps to the entry that
+    describes it: the term introducing it, like '-A NUM,
+    --after-context=NUM', and the start of the description."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, term, description):
+        for name in names(term):
+            # The first entry of an option is the one a reader would find.
+            self.entries.setdefault(name, (term, description))
+
+    def lookup(self, option):
+        """Returns the (term, description) entry of an option, or None."""
+        for name in normalize(option):
+            if name in self.entries:
+                return self.entries[name]
+        return None
+
+
+class Collector:
+    """Builds an OptionIndex from the entries of a manual page, given a line
+    at a time: term() starts an entry, text() adds a line to its
+    description and end() ends it.  Descriptions are kept up to 'limit'
+    characters."""
+
+    def __init__(self, limit=400):
+        self.limit = limit
+        self.index = OptionIndex()
+        self.current = None
+        self.lines = []
+
+    def term(self, term):
+        self.end()
+        self.current = utils.str.normalizeWhitespace(term).strip()
+
+    def text(self, ln):
+        if self.current is not None:
+            self.lines.append(ln.strip())
+
+    def end(self):
+        if self.current is None:
+            return
+        description = ''
+        for ln in self.lines:
+            if len(description) > self.limit:
+                break
+            if ln.endswith('\xe2\x80\x90'):
+                # A word hyphenated across lines.
+                description += ln[:-3]
+            else:
+                description = '%s%s ' % (description, ln)
+        description = utils.str.normalizeWhitespace(description).strip()
+        self.index.add(self.current, template.cut(description, self.limit))
+        self.current = None
+        self.lines = []
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
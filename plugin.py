@@ -17,13 +17,30 @@
 import supybot.log as log
 import supybot.conf as conf
 import supybot.utils as utils
+import supybot.schedule as schedule
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
 import supybot.registry as registry
 import supybot.callbacks as callbacks
 
-import sys
+import os
+import re
+import math
+import time
+import threading
+
+import cache
+import pool
+import httpclient
+import index
+import local
+import stats
+import apropos
+import fuzzy
+import template
+import throttle
+import options
 
 class UbuntuManError(Exception):
     """Ubuntu manual page exception.  Raised when an expected section is
@@ -31,11 +48,23 @@ class UbuntuManError(Exception):
     encountered."""
     pass
 
-def cut(s, limit):
-    """Function for cutting a string nicely at the end of a word."""
-    idx = s[:limit - 3].rfind(' ')
-    s = '%s ...' % s[:idx]
-    return s
+def getManCommand(irc, msg, args, state):
+    # The commands end where the options begin, so that the options can
+    # follow any number of commands.
+    if args[0].startswith('--'):
+        raise callbacks.ArgumentError
+    state.args.append(args.pop(0))
+
+addConverter('manCommand', getManCommand)
+
+def shorten(description):
+    """Shortens a description to the first sentences that fit a 150 char
+    limit, or cuts it at the end of a word if there is no such sentence."""
+    description = utils.str.normalizeWhitespace(description)
+    idx = description[:150].rfind('.')
+    if idx < 1:
+        return template.cut(description, 150)
+    return description[:idx + 1]
 
 class KeywordsParser:
     """Class for check which sections of the manpage are needed."""
@@ -49,9 +78,12 @@ class KeywordsParser:
             setattr(self, key, False)
 
     def checkKeywords(self, format):
+        # The keywords are the slots of the compiled format, so that $name
+        # and ${name} are both parsed, just as they are both rendered.
+        slots = template.Template(format, self.keys).slots
         L = list()
         for key in self.keys:
-            if ('$' + key) in format:
+            if key in slots:
                 setattr(self, key, True)
                 L.append(key)
             else:
@@ -60,74 +92,163 @@ class KeywordsParser:
 
 
 class UbuntuManParser:
-    """Ubunutu manual page parser."""
+    """Ubunutu manual page parser.  The page is read in a single pass: every
+    line is matched against all the section headings of the language at
+    once, only the sections needed by the format are extracted, and reading
+    stops as soon as the last of them has been parsed."""
+
+    # Section headings for each keyword in the language of the parser, in
+    # the order they are reported when missing, and for the options.  The
+    # parsers for other languages override this table.
+    headings = {
+        'name': ('NAME', ),
+        'synopsis': ('SYNOPSIS', ),
+        'description': ('DESCRIPTION', ),
+        'options': ('OPTIONS', ),
+    }
+
+    # Headings that are matched anywhere in a line instead of only in
+    # '<h4><b>HEADING</b></h4>', for pages that aren't formated right.
+    looseHeadings = {}
+
+    _matchers = {}
 
     def __init__(self):
         self.keywords = KeywordsParser()
         for key in self.keywords.keys:
             setattr(self, key, '')
+        # The whole NAME line, for apropos.
+        self.whatis = ''
 
-    def skipToSection(self, fd, section):
-        """Skips lines until '<h3>SECTION</h3>' is found and returns the
-        rest of the line as a string with whitespaces normalized and HTML
-        tags removed.  'section' can be a string or a tuple of strings."""
-        if section.__class__ == str: # check if section is a string
-            section = (section, )
-        while True:
-            ln = fd.readline()
-            if not ln:
-                raise UbuntuManError('Section %s not found.' % \
-                        ', '.join(section))
-            for s in section:
-                tag = '<h4><b>%s</b></h4>' % s
-                idx = ln.find(tag)
-                if idx > -1:
-                    ln = fd.readline()
-                    ln = utils.web.htmlToText(ln, tagReplace='')
-                    ln = utils.str.normalizeWhitespace(ln)
-                    return ln
-
-    def parseName(self, fd, section='NAME'):
+    def getMatcher(self):
+        """Returns a (regexp, sections) tuple, where regexp matches any of
+        the headings of the parser and sections maps the matched heading to
+        its keyword.  The matcher is compiled once per parser class."""
+        cls = self.__class__
+        if cls not in self._matchers:
+            sections = {}
+            for table in (self.headings, self.looseHeadings):
+                for (key, headings) in table.iteritems():
+                    for heading in headings:
+                        sections[heading] = key
+            def alternatives(table):
+                L = [heading for headings in table.itervalues()
+                             for heading in headings]
+                # Longest first, so that a heading is not shadowed by its
+                # prefix.
+                L.sort(key=len, reverse=True)
+                return '|'.join(map(re.escape, L)) or '(?!)'
+            regexp = re.compile('<h4><b>(%s)</b></h4>|(%s)' %
+                                (alternatives(self.headings),
+                                 alternatives(self.looseHeadings)))
+            self._matchers[cls] = (regexp, sections)
+        return self._matchers[cls]
+
+    def readText(self, fd):
+        """Reads the next line and returns it as a string with whitespaces
+        normalized and HTML tags removed."""
+        ln = fd.readline()
+        ln = utils.web.htmlToText(ln, tagReplace='')
+        return utils.str.normalizeWhitespace(ln)
+
+    def parseName(self, fd):
         """Parse the NAME section."""
-        #log.debug('UbuntuManParser.parseName() parsing ...')
-        self.name = self.skipToSection(fd, section).split()[0]
+        self.whatis = self.readText(fd)
+        words = self.whatis.split()
+        if not words:
+            raise UbuntuManError('Section %s is empty.' %
+                                 self.headings['name'][0])
+        self.name = words[0]
 
-    def parseSynopsis(self, fd, section='SYNOPSIS'):
+    def parseSynopsis(self, fd):
         """Parse the SYNOPSIS section.  Only the first line is read."""
-        #log.debug('UbuntuManParser.parseSynopsis() parsing ...')
-        self.synopsis = self.skipToSection(fd, section)
+        self.synopsis = self.readText(fd)
 
-    def parseDesc(self, fd, section='DESCRIPTION'):
+    def parseDesc(self, fd):
         """Parse the DESCRIPTION section.  Only the first sentences that fit a
         150 char limit are read."""
-        #log.debug('UbuntuManParser.parseDesc() parsing ...')
-        description = self.skipToSection(fd, section)
+        description = ''
         while len(description) < 300:
             ln = fd.readline()
-            if not ln or ln.startswith(' </pre>') or len(ln) == 0:
+            if not ln or ln.startswith(' </pre>'):
                 break
             if ln.endswith('\xe2\x80\x90\x0a'):
-                description += ln[:len(ln) - 4]
+                # A word hyphenated across lines.
+                description += ln[:len(ln) - 4].lstrip()
             else:
-                description = '%s%s ' %(description, ln.strip())
+                description = '%s%s ' % (description, ln.strip())
         description = utils.web.htmlToText(description, tagReplace='')
-        description = utils.web.normalizeWhitespace(description)
-        idx = description[:150].rfind('.')
-        if idx < 1:
-            description = cut(description, 150)
-        else:
-            description = description[:idx + 1]
-        self.description = description
+        self.description = shorten(description)
+
+    def missingSections(self, keys):
+        """Returns the UbuntuManError for the sections of 'keys' that were
+        not found."""
+        missing = [heading for key in self.keywords.keys if key in keys
+                           for heading in self.headings[key]]
+        return UbuntuManError('Section %s not found.' % ', '.join(missing))
 
     def parse(self, fd, command, format):
-        """Parse the HTML manual page from the given file descriptor."""
+        """Parse the HTML manual page from the given file descriptor.  Only
+        the sections needed by 'format' are parsed, and the file is not read
+        any further once they have been found."""
         self.command = command
         self.keywords.checkKeywords(format)
-        for x in range(43):
-            fd.readline()
-        self.keywords.name and self.parseName(fd)
-        self.keywords.synopsis and self.parseSynopsis(fd)
-        self.keywords.description and self.parseDesc(fd)
+        (regexp, sections) = self.getMatcher()
+        parsers = {
+                   'name':self.parseName,
+                   'synopsis':self.parseSynopsis,
+                   'description':self.parseDesc,
+                  }
+        needed = set(self.keywords.keysParsed)
+        while needed:
+            ln = fd.readline()
+            if not ln:
+                raise self.missingSections(needed)
+            m = regexp.search(ln)
+            if m is None:
+                continue
+            key = sections[m.group(1) or m.group(2)]
+            if key in needed:
+                needed.remove(key)
+                parsers[key](fd)
+
+    def parseOptions(self, fd):
+        """Parse the options described in the DESCRIPTION and OPTIONS
+        sections, where the pages have them, and return them as an
+        options.OptionIndex.  An entry starts with a line beginning with a
+        dash at the indentation of the paragraphs, and its description is
+        indented deeper, or follows the term on its line after a gap."""
+        (regexp, sections) = self.getMatcher()
+        collector = options.Collector()
+        inside = False
+        for ln in fd:
+            m = regexp.search(ln)
+            if m is not None or ln.startswith('<h4>'):
+                collector.end()
+                inside = m is not None and \
+                    sections[m.group(1) or m.group(2)] in ('description',
+                                                           'options')
+                continue
+            if not inside:
+                continue
+            stripped = ln.strip()
+            text = utils.web.htmlToText(stripped, tagReplace='')
+            if not text:
+                # Blank lines separate the paragraphs of an entry.
+                continue
+            indent = len(ln) - len(ln.lstrip(' '))
+            if indent <= 7 and text.startswith('-'):
+                parts = re.split(r'\s{2,}', stripped, 1)
+                collector.term(utils.web.htmlToText(parts[0], tagReplace=''))
+                if len(parts) > 1:
+                    collector.text(utils.web.htmlToText(parts[1],
+                                                        tagReplace=''))
+            elif indent > 7:
+                collector.text(text)
+            else:
+                collector.end()
+        collector.end()
+        return collector.index
 
 class UbuntuManParser_en(UbuntuManParser):
     """Ubuntu manual page parser for English."""
@@ -135,81 +256,139 @@ class UbuntuManParser_en(UbuntuManParser):
 
 class UbuntuManParser_es(UbuntuManParser):
     """Ubuntu manual page parser for Spanish."""
-
-    def parseName(self, fd):
-        UbuntuManParser.parseName(self,fd, ('NOMBRE', 'NAME'))
-
-    def parseSynopsis(self, fd):
-        UbuntuManParser.parseSynopsis(self, fd, ('SINOPSIS', 'SINTAXIS',
-            'SYNOPSIS'))
-
-    def parseDesc(self, fd):
+    headings = {
+        'name': ('NOMBRE', 'NAME'),
+        'synopsis': ('SINOPSIS', 'SINTAXIS', 'SYNOPSIS'),
         # Should be just DESCRIPCIÓN, but meh :/
-        UbuntuManParser.parseDesc(self, fd,
-                                  ('DESCRIPCI   N',
-                                   'DESCRIPCI?N',
-                                   'DESCRIPCION',
-                                   'DESCRIPTION',
-                                   'DESCRIPCIÓN'))
+        'description': ('DESCRIPCI   N', 'DESCRIPCI?N', 'DESCRIPCION',
+                        'DESCRIPTION', 'DESCRIPCIÓN'),
+        'options': ('OPCIONES', 'OPTIONS'),
+    }
 
 class UbuntuManParser_de(UbuntuManParser):
     """Ubunutu manual page parser for German."""
-
-    def parseName(self, fd):
-        UbuntuManParser.parseName(self, fd, ('BEZEICHNUNG', 'NAME'))
-
-    def parseSynopsis(self, fd):
-        # German synopsis sections aren't formated right, taking that into
-        # account..
-        section = 'BERSICHT'
-        while True:
-            ln = fd.readline()
-            if not ln:
-                raise UbuntuManError('Section %s not found.' % section)
-            tag = section
-            offs = ln.find(tag)
-            if offs == -1:
-                continue
-            ln = fd.readline()
-            ln = utils.web.htmlToText(ln, tagReplace='')
-            ln = utils.str.normalizeWhitespace(ln)
-            break
-        self.synopsis = ln
-
-    def parseDesc(self, fd):
-        UbuntuManParser.parseDesc(self, fd, section='BESCHREIBUNG')
+    headings = {
+        'name': ('BEZEICHNUNG', 'NAME'),
+        'synopsis': ('ÜBERSICHT', ),
+        'description': ('BESCHREIBUNG', ),
+        'options': ('OPTIONEN', 'OPTIONS'),
+    }
+    # German synopsis sections aren't formated right, taking that into
+    # account..
+    looseHeadings = {
+        'synopsis': ('BERSICHT', ),
+    }
 
 class UbuntuManParser_fi(UbuntuManParser):
     """Ubuntu manual page parser for Finnish."""
-
-    def parseName(self, fd):
-        UbuntuManParser.parseName(self, fd, ('NAME', 'NIMI'))
-
-    def parseSynopsis(self, fd):
-        # FIXME aptitude manpage fails
-        UbuntuManParser.parseSynopsis(self, fd, ('SYNOPSIS', 'YLEISKATSAUS'))
-
-    def parseDesc(self, fd):
-        UbuntuManParser.parseDesc(self, fd, 'KUVAUS')
+    # FIXME aptitude manpage fails
+    headings = {
+        'name': ('NAME', 'NIMI'),
+        'synopsis': ('SYNOPSIS', 'YLEISKATSAUS'),
+        'description': ('KUVAUS', ),
+        'options': ('VALITSIMET', 'OPTIONS'),
+    }
 
 class UbuntuManParser_it(UbuntuManParser):
     """Ubuntu manual page parser for Italian."""
+    headings = {
+        'name': ('NOME', 'NAME'),
+        'synopsis': ('SINTASSI', 'SYNOPSIS'),
+        'description': ('DESCRIZIONE', 'DESCRIPTION'),
+        'options': ('OPZIONI', 'OPTIONS'),
+    }
 
-    def parseName(self, fd):
-        UbuntuManParser.parseName(self, fd, ('NOME', 'NAME'))
 
-    def parseSynopsis(self, fd):
-        UbuntuManParser.parseSynopsis(self, fd, ('SINTASSI', 'SYNOPSIS'))
+class UbuntuManParser_fr(UbuntuManParser):
+    """Ubuntu manual page parser for French."""
+    headings = {
+        'name': ('NOM', 'NAME'),
+        'synopsis': ('SYNOPSIS', ),
+        'description': ('DESCRIPTION', ),
+        'options': ('OPTIONS', ),
+    }
 
-    def parseDesc(self, fd):
-        UbuntuManParser.parseDesc(self, fd, ('DESCRIZIONE', 'DESCRIPTION'))
+class UbuntuManTroffParser(UbuntuManParser):
+    """Parser for the troff source of the manual pages installed locally.
+    It extracts the same sections as the HTML parser of the language of the
+    page, using its table of section headings."""
 
+    def __init__(self, parserClass):
+        UbuntuManParser.__init__(self)
+        self.headings = parserClass.headings
+        self.looseHeadings = parserClass.looseHeadings
 
-class UbuntuManParser_fr(UbuntuManParser):
-    """Ubuntu manual page parser for French."""
+    def getKey(self, heading):
+        """Returns the keyword of a section heading, or None."""
+        for (key, headings) in self.headings.iteritems():
+            if heading in headings:
+                return key
+        for (key, headings) in self.looseHeadings.iteritems():
+            for loose in headings:
+                if loose in heading:
+                    return key
+        return None
 
-    def parseName(self, fd):
-        UbuntuManParser.parseName(self, fd, ('NOM', 'NAME'))
+    def parse(self, fd, command, format):
+        """Parse the troff manual page from the given file descriptor."""
+        self.command = command
+        self.keywords.checkKeywords(format)
+        needed = set(self.keywords.keysParsed)
+        for (heading, lines) in local.iterSections(fd):
+            key = self.getKey(heading)
+            if key not in needed:
+                continue
+            needed.remove(key)
+            text = [ln for ln in lines if ln]
+            if not text:
+                raise UbuntuManError('Section %s is empty.' % heading)
+            if key == 'name':
+                self.whatis = ' '.join(text)
+                self.name = text[0].split()[0]
+            elif key == 'synopsis':
+                # The synopsis runs until the first break.
+                synopsis = []
+                for ln in lines:
+                    if not ln:
+                        if synopsis:
+                            break
+                        continue
+                    synopsis.append(ln)
+                self.synopsis = ' '.join(synopsis)
+            else:
+                description = ''
+                for ln in text:
+                    if len(description) >= 300:
+                        break
+                    description = '%s%s ' % (description, ln)
+                self.description = shorten(description)
+            if not needed:
+                return
+        if needed:
+            raise self.missingSections(needed)
+
+    def parseOptions(self, fd):
+        """Parse the options described in the DESCRIPTION and OPTIONS
+        sections of the troff manual page.  An entry starts with a line
+        beginning with a dash right after a break, like the tag of a .TP
+        paragraph, and its description runs until the next break."""
+        collector = options.Collector()
+        for (heading, lines) in local.iterSections(fd):
+            if self.getKey(heading) not in ('description', 'options'):
+                continue
+            broken = True
+            for ln in lines:
+                if not ln:
+                    collector.end()
+                    broken = True
+                    continue
+                if broken and ln.startswith('-'):
+                    collector.term(ln)
+                else:
+                    collector.text(ln)
+                broken = False
+            collector.end()
+        return collector.index
 
 
 class UbuntuMan(callbacks.Plugin):
@@ -219,23 +398,197 @@ class UbuntuMan(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(UbuntuMan, self)
         self.__parent.__init__(irc)
-        self.currentParser = None
+        self.cache = cache.SummaryCache(
+            conf.supybot.directories.data.dirize('UbuntuMan.cache'),
+            self.registryValue('cache.ttl', value=False),
+            lambda: self.registryValue('cache.memory') * 1024 * 1024,
+            self.registryValue('cache.negativeTtl', value=False),
+            self.registryValue('cache.negativeSize', value=False),
+            background=True)
+        self.availability = cache.LRUCache(
+            self.registryValue('cache.negativeTtl', value=False),
+            self.registryValue('fallback.mapSize', value=False))
+        self.optionIndexes = cache.LRUCache(
+            self.registryValue('cache.ttl', value=False),
+            self.registryValue('cache.optionPages', value=False))
+        self.aproposIndex = apropos.AproposIndex(
+            conf.supybot.directories.data.dirize('UbuntuMan.apropos'),
+            background=True)
+        self.probes = pool.WorkerPool('UbuntuMan probe',
+            self.registryValue('probeWorkers', value=False))
+        self.lookups = pool.FairPool('UbuntuMan lookup',
+            self.registryValue('lookupWorkers', value=False),
+            self.registryValue('throttle.queueDepth', value=False))
+        self.batches = pool.WorkerPool('UbuntuMan batch',
+            self.registryValue('lookupWorkers', value=False))
+        self.inflight = pool.Coalescer()
+        self.refreshes = pool.WorkerPool('UbuntuMan refresh',
+            self.registryValue('prefetch.workers', value=False))
+        self.refreshing = set()
+        self.refreshLock = threading.Lock()
+        self.snapshotLock = threading.Lock()
+        upstream = self.registryValue('throttle.upstream', value=False)
+        self.http = httpclient.ConnectionPool(
+            self.registryValue('http.poolSize', value=False),
+            self.registryValue('http.connectTimeout', value=False),
+            self.registryValue('timeout', value=False),
+            self.registryValue('http.compress', value=False),
+            throttle.TokenBucket(upstream, upstream),
+            httpclient.CircuitBreaker(
+                self.registryValue('http.breakerFailures', value=False),
+                self.registryValue('http.breakerCooldown', value=False)))
+        self.userThrottle = throttle.Throttle(
+            lambda: self.registryValue('throttle.user') / 60.0,
+            self.registryValue('throttle.userBurst', value=False))
+        self.channelThrottle = throttle.Throttle(
+            lambda: self.registryValue('throttle.channel') / 60.0,
+            self.registryValue('throttle.channelBurst', value=False))
+        # The buckets the fetches of the lookup running in a thread are
+        # charged to.
+        self.requester = threading.local()
+        self.indexes = index.SectionIndexes(
+            conf.supybot.directories.data.dirize('UbuntuMan.index'))
+        self.localPages = None
+        if self.registryValue('backend') == 'local':
+            self.__getLocalPages()
+        self.names = fuzzy.NameIndexes(self.__getKnownCommands)
+        self.template = None
+        self.stats = stats.Stats(
+            self.registryValue('stats.enable', value=False))
+        self.__scheduleStatsLog()
+        self.__scheduleSnapshot()
+
+    def die(self):
+        for name in ('UbuntuMan stats', 'UbuntuMan snapshot'):
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+        self.probes.stop()
+        self.lookups.stop()
+        self.batches.stop()
+        self.refreshes.stop()
+        # The last snapshot; a worker may still be writing the one before.
+        # If the snapshots are still being loaded, they are left as they
+        # are instead of waiting for them.
+        self.__writeSnapshot()
+        for warmUp in (self.cache.warmUp, self.aproposIndex.warmUp):
+            if warmUp is not None:
+                warmUp.stop()
+        self.http.close()
+        self.indexes.close()
+        self.__parent.die()
+
+    def __scheduleStatsLog(self):
+        # While stats.logInterval is zero, the event just checks again a
+        # minute later whether it has been set.
+        interval = self.registryValue('stats.logInterval') or 60
+        schedule.addEvent(self.__logStats, time.time() + interval,
+                          'UbuntuMan stats')
 
-    def __setParser(self, language):
-        parserClass  = 'UbuntuManParser_' + language
-        if parserClass == self.currentParser:
-            # Don't initialise the parser again if it isn't needed.
+    def __logStats(self):
+        if self.registryValue('stats.logInterval') and \
+           self.registryValue('stats.enable'):
+            self.log.info('UbuntuMan: %s', self.stats.summary())
+        self.__scheduleStatsLog()
+
+    def __scheduleSnapshot(self):
+        interval = self.registryValue('cache.snapshotInterval') or 60
+        schedule.addEvent(self.__snapshot, time.time() + interval,
+                          'UbuntuMan snapshot')
+
+    def __snapshot(self):
+        if self.registryValue('cache.snapshotInterval'):
+            # Written by a worker, so that the bot isn't held up meanwhile.
+            self.refreshes.submit(self.__writeSnapshot)
+        self.__scheduleSnapshot()
+
+    def __writeSnapshot(self):
+        self.snapshotLock.acquire()
+        try:
+            self.cache.flush()
+            self.aproposIndex.flush()
+        finally:
+            self.snapshotLock.release()
+
+    def __getParserClass(self, language):
+        # Looks for the parser class that matchs the language, or defaults to
+        # UbuntuManParser_en.
+        return globals().get('UbuntuManParser_' + language,
+                             UbuntuManParser_en)
+
+    def __getParser(self, language):
+        """Returns a new parser for the given language.  Every lookup gets
+        its own parser, so concurrent lookups don't share any state."""
+        if self.registryValue('backend') == 'local':
+            return UbuntuManTroffParser(self.__getParserClass(language))
+        return self.__getParserClass(language)()
+
+    def __getLocalPages(self):
+        """Returns the index of the locally installed manual pages, scanning
+        the directory the first time and whenever localPath changes."""
+        path = self.registryValue('localPath')
+        pages = self.localPages
+        if pages is None or pages.path != path:
+            pages = local.LocalPages(path)
+            self.log.info('UbuntuMan: Found %s manual pages in %s.',
+                          len(pages), path)
+            self.localPages = pages
+        return pages
+
+    def __runLookup(self, irc, msg, f, *args):
+        """Runs the lookup f(irc, *args) in the lookup worker pool, so that a
+        slow manpage repository doesn't block the bot, and f replies when it
+        is done.  The channels (and the users asking in private) take turns
+        in the pool, so one of them can't hold back the others.  Nested
+        commands need their reply right away, so they are run directly.
+        The pages fetched from the repository are charged to the user and
+        the channel of 'msg'."""
+        buckets = [self.userThrottle.get(msg.prefix)]
+        if ircutils.isChannel(msg.args[0]):
+            buckets.append(self.channelThrottle.get(msg.args[0]))
+        if not self.registryValue('threaded') or irc.nested:
+            self.__runAs(buckets, f, irc, *args)
             return
-        if "UbuntuMan.plugin" in sys.modules:
-            module = sys.modules["UbuntuMan.plugin"]
+        def run():
+            try:
+                self.__runAs(buckets, f, irc, *args)
+            except Exception, e:
+                self.log.exception('UbuntuMan: Uncaught exception in a '
+                                   'lookup:')
+                irc.errorPossibleBug(utils.exnToString(e))
+        if ircutils.isChannel(msg.args[0]):
+            key = msg.args[0]
         else:
-            module = sys.modules['ubuntuman.plugin']
-        # Looks for the parser class that matchs the language set in the
-        # config, or defaults to UbuntuManParser_en.
-        self.parser = hasattr(module , parserClass) \
-            and getattr(module,parserClass)() \
-            or UbuntuManParser_en()
-        self.currentParser = parserClass
+            key = msg.prefix
+        if self.lookups.submit(key, run) is None:
+            irc.error('Too many manual pages are being looked up, try again '
+                      'later.')
+
+    def __runAs(self, buckets, f, *args):
+        """Calls f(*args) as a lookup whose fetches from the repository are
+        charged to 'buckets'."""
+        self.requester.buckets = buckets
+        try:
+            return f(*args)
+        finally:
+            self.requester.buckets = ()
+
+    def __chargeFetch(self):
+        """Charges a fetch from the repository to the user and the channel
+        of the lookup running in this thread.  If they have looked up too
+        many pages lately, the fetch waits for its turn, at most the timeout;
+        past that, throttle.Throttled is raised.  The pages answered from the
+        cache are never charged."""
+        buckets = getattr(self.requester, 'buckets', ())
+        if not buckets:
+            return
+        delay = max([bucket.wait() for bucket in buckets])
+        if delay > self.registryValue('timeout'):
+            raise throttle.Throttled(delay)
+        delay = max([bucket.reserve() for bucket in buckets])
+        if delay:
+            time.sleep(delay)
 
     def __buildUrl(self, release, section, command, language):
         """Build URL to a manual page."""
@@ -248,65 +601,574 @@ class UbuntuMan(callbacks.Plugin):
 
     def __tryUrl(self, url):
         """Try to open the given URL.  If succeeds, returns it's file
-        descriptor; otherwise returns None."""
+        descriptor; returns None if the page doesn't exist and False if the
+        repository couldn't be reached."""
         try:
-            return utils.web.getUrlFd(url)
-        except utils.web.Error:
+            return self.http.request(url)
+        except utils.web.Error, e:
+            if isinstance(e, httpclient.HTTPError) and e.code == 404:
+                return None
+            self.log.debug('UbuntuMan: Failed to open %s: %s', url, e)
+            return False
+
+    def __probeUrl(self, url):
+        """Like __tryUrl, but only checks that the page exists, without
+        downloading it.  Returns the URL the redirections lead to if it
+        does."""
+        try:
+            return self.http.probe(url)
+        except utils.web.Error, e:
+            if isinstance(e, httpclient.HTTPError) and e.code == 404:
+                return None
+            self.log.debug('UbuntuMan: Failed to probe %s: %s', url, e)
+            return False
+
+    def __getIndexedSections(self, release, language, command):
+        """Returns the list of sections the command has a manual page in
+        according to the section index, or None if the release and language
+        have not been indexed."""
+        if not self.registryValue('index.enable'):
             return None
+        sections = self.indexes.get(release, language)
+        if sections is None:
+            return None
+        return sections.lookup(command) or []
 
-    def __getManPageFd(self, release, command, language):
+    def __buildIndex(self, release, language):
+        """Builds the section index of a release and language from the
+        directory listings of the manpage repository, or from the local
+        mirror if one is configured.  Returns the number of pages."""
+        pages = {}
+        mirror = self.registryValue('index.mirror')
+        for section in self.registryValue('sections'):
+            if mirror:
+                dirname = os.path.join(mirror, release, language,
+                                       'man' + section)
+                commands = index.scanMirror(dirname, section)
+            else:
+                url = '/%s/%s/man%s/' % (release, language, section)
+                url = self.registryValue('baseurl') + utils.web.urlquote(url)
+                try:
+                    fd = self.http.request(url)
+                except httpclient.HTTPError, e:
+                    if e.code == 404:
+                        continue
+                    raise
+                try:
+                    commands = index.parseListing(fd.read(), section)
+                finally:
+                    fd.close()
+            index.addPages(pages, commands, section)
+        self.indexes.store(release, language, pages)
+        return len(pages)
+
+    def __buildApropos(self, release, language):
+        """Adds the NAME lines of all the manual pages of a release and
+        language to the apropos index, reading them from the locally
+        installed pages with the local backend or else from the local mirror
+        of the repository.  Returns the number of pages, or None if there is
+        neither."""
+        pages = []
+        if self.registryValue('backend') == 'local':
+            localPages = self.__getLocalPages()
+            for command in localPages.commands(language):
+                for section in self.registryValue('sections'):
+                    filename = localPages.find(language, command, section)
+                    if filename:
+                        pages.append((command, section, filename))
+                        break
+            openPage = localPages.open
+        else:
+            mirror = self.registryValue('index.mirror')
+            if not mirror:
+                return None
+            for section in self.registryValue('sections'):
+                dirname = os.path.join(mirror, release, language,
+                                       'man' + section)
+                for command in index.scanMirror(dirname, section):
+                    filename = os.path.join(dirname, '%s.%s.html' %
+                                            (command, section))
+                    if not os.path.exists(filename):
+                        filename += '.gz'
+                    pages.append((command, section, filename))
+            openPage = index.openMirrorPage
+        count = 0
+        for (command, section, filename) in pages:
+            parser = self.__getParser(language)
+            try:
+                fd = openPage(filename)
+                try:
+                    parser.parse(fd, command, '$name')
+                finally:
+                    fd.close()
+            except (EnvironmentError, UbuntuManError), e:
+                self.log.debug('UbuntuMan: Failed to read the NAME line of '
+                               '%s: %s', filename, utils.exnToString(e))
+                continue
+            self.aproposIndex.add(release, language, command, section,
+                                  parser.whatis)
+            count += 1
+        return count
+
+    def __getKnownCommands(self, release):
+        """Returns the set of the commands known to have a manual page in a
+        release: those in its section indexes and in the apropos index,
+        those looked up so far and the locally installed ones."""
+        commands = self.aproposIndex.commands(release)
+        for language in self.indexes.languages(release):
+            sections = self.indexes.get(release, language)
+            if sections is not None:
+                commands.update([command for (command, L) in sections])
+        for (rel, language, command) in self.cache.counts.keys():
+            if rel == release:
+                commands.add(command)
+        if self.localPages is not None:
+            commands.update([command for (language, command)
+                                     in self.localPages.pages])
+        return commands
+
+    def __notFound(self, release, command):
+        """Returns the reply for a command that has no manual page, with the
+        known commands closest to it as suggestions."""
+        s = 'No manual page for \'%s\'' % command
+        limit = self.registryValue('suggestions')
+        if limit:
+            names = self.names.get(release).suggest(command, limit)
+            if names:
+                s += '; did you mean %s?' % \
+                     utils.str.commaAndify(names, And='or')
+        return s
+
+    def __fallbackReleases(self, release):
+        """Returns the releases of fallback.releases other than 'release',
+        the nearest to it in the list first, and of two as near the one
+        listed first."""
+        chain = self.registryValue('fallback.releases')
+        releases = [rel for rel in chain if rel != release]
+        if release in chain:
+            pos = chain.index(release)
+            releases.sort(key=lambda rel: (abs(chain.index(rel) - pos),
+                                           chain.index(rel)))
+        return releases
+
+    def __isAvailable(self, release, command, language):
+        """Tells from what is already known whether a release has a manual
+        page for a command: from the availability map of the fallbacks, the
+        cache and the section indexes.  Returns None if it isn't known."""
+        known = self.availability.get((release, language, command))
+        if known is not None:
+            return known
+        if self.registryValue('cache.enable'):
+            if self.cache.lookup(release, language, command, []) is not None:
+                return True
+            if self.cache.isMiss(release, language, command):
+                return False
+        indexed = [self.__getIndexedSections(release, lang, command)
+                   for lang in set((language, 'en'))]
+        if [sections for sections in indexed if sections]:
+            return True
+        if None not in indexed:
+            return False
+        return None
+
+    def __fallback(self, release, command, language, lookup):
+        """Looks a command that has no manual page in 'release' up in the
+        fallback releases, the nearest first, with lookup(release), which
+        returns None if there is no manual page and False if the repository
+        can't be reached.  The releases known not to have the page are
+        skipped without a request, and at most fallback.maxLookups of those
+        not known either way are looked up, so a command missing everywhere
+        costs a bounded number of lookups.  Returns a (release, result)
+        tuple, or None if no release has the page."""
+        lookups = self.registryValue('fallback.maxLookups')
+        for other in self.__fallbackReleases(release):
+            known = self.__isAvailable(other, command, language)
+            if known is False:
+                continue
+            if known is None:
+                if not lookups:
+                    continue
+                lookups -= 1
+            result = lookup(other)
+            if result is False:
+                # The other releases can't be reached either.
+                return None
+            self.availability.set((other, language, command),
+                                  result is not None)
+            if result is not None:
+                self.stats.count(('fallback', ))
+                return (other, result)
+        return None
+
+    def __fallbackNote(self, release):
+        return ' [from %s]' % release
+
+    def __throttled(self, command, delay):
+        return format('Too many manual pages have been looked up lately, no '
+                      'manual page for \'%s\' for now; try again in %n.',
+                      command, (int(math.ceil(delay)), 'second'))
+
+    def __unreachable(self, command):
+        return 'The Ubuntu Manpage Repository can\'t be reached, no manual ' \
+               'page for \'%s\' for now' % command
+
+    def __closeFd(self, fd):
+        if fd and not isinstance(fd, basestring):
+            fd.close()
+
+    def __getLocalManPageFd(self, release, command, language, languages):
+        """Like __getManPageFd, but opens the manual page from the locally
+        installed ones.  The parser gets the repository URL all the same."""
+        pages = self.__getLocalPages()
+        for section in self.registryValue('sections'):
+            for lang in languages:
+                filename = pages.find(lang, command, section)
+                if not filename:
+                    continue
+                try:
+                    fd = pages.open(filename)
+                except EnvironmentError, e:
+                    self.log.info('UbuntuMan: Failed to open %s: %s',
+                                  filename, utils.exnToString(e))
+                    continue
+                self.stats.count(('hit', section, lang))
+                parser = self.__getParser(lang)
+                parser.url = self.__buildUrl(release, section, command, lang)
+                parser.command = command
+                parser.section = section
+                parser.language = lang
+                return (fd, parser)
+        if self.registryValue('cache.enable'):
+            self.cache.setMiss(release, language, command)
+        return (None, None)
+
+    def __getManPageFd(self, release, command, language, fetch=True):
         """Get a file descriptor to the manual page in the Ubuntu Manpage
-        Repository."""
-        if language == 'en':
-            language = (language, )
+        Repository.  Returns a (fd, parser) tuple, where parser is a new
+        parser for the language the page was found in, or (None, None) if
+        there is no manual page.  Without 'fetch', the page is only found
+        and not downloaded, and fd is the URL it was found at, after the
+        redirections."""
+        useCache = self.registryValue('cache.enable')
+        if useCache and self.cache.isMiss(release, language, command):
+            return (None, None)
+        languages = language
+        if languages == 'en':
+            languages = (languages, )
         else:
-            language = (language, 'en')
+            languages = (languages, 'en')
+        if self.registryValue('backend') == 'local':
+            (fd, parser) = self.__getLocalManPageFd(release, command,
+                                                    language, languages)
+            if fd and not fetch:
+                fd.close()
+                fd = parser.url
+            return (fd, parser)
+        # Where the section index knows the sections of the command, only
+        # those are tried; if none of them has the page, it's a miss without
+        # a single request.
+        indexed = {}
+        for lang in languages:
+            indexed[lang] = self.__getIndexedSections(release, lang, command)
+        candidates = []
         for section in self.registryValue('sections'):
-            for lang in language:
+            for lang in languages:
+                if indexed[lang] is not None and \
+                   section not in indexed[lang]:
+                    continue
                 url = self.__buildUrl(release, section, command, lang)
-                #self.log.debug('UbuntuMan: Trying url %s' % url)
+                candidates.append((section, lang, url))
+        if candidates:
+            self.__chargeFetch()
+        # All the candidate URLs are probed at once, but the results are
+        # examined in priority order: the first section wins, and the
+        # requested language wins over English.  When the page is needed,
+        # the first candidate is downloaded right away, since it wins if it
+        # exists; the others are only checked for existence, and the one
+        # that wins, if any, is downloaded afterwards.
+        probed = []
+        first = candidates and candidates[0][2]
+        def probe(url):
+            # Probes cancelled before they start make no request.
+            probed.append(url)
+            if fetch and url == first:
+                return self.__tryUrl(url)
+            return self.__probeUrl(url)
+        jobs = self.probes.map(probe,
+                               [url for (section, lang, url) in candidates])
+        missing = True
+        for (i, (section, lang, url)) in enumerate(candidates):
+            fd = jobs[i].get()
+            if fetch and isinstance(fd, basestring):
                 fd = self.__tryUrl(url)
-                if fd:
-                    #self.log.debug('UbuntuMan: Success')
-                    self.__setParser(lang)
-                    self.parser.url = url
-                    self.parser.command = command
-                    return fd
-        return None
+            if fd is False:
+                missing = False
+            elif fd is None:
+                self.stats.count(('miss', section, lang))
+            else:
+                #self.log.debug('UbuntuMan: Success %s' % url)
+                for job in jobs[i + 1:]:
+                    job.cancel(discard=self.__closeFd)
+                self.stats.count(('hit', section, lang))
+                self.stats.recordProbes(len(probed))
+                parser = self.__getParser(lang)
+                parser.url = url
+                parser.command = command
+                parser.section = section
+                parser.language = lang
+                return (fd, parser)
+        self.stats.recordProbes(len(probed))
+        if not missing:
+            # Network errors are not cached; the page may well exist.
+            return (False, None)
+        if useCache:
+            # Only remember the miss if the repository really answered that
+            # there is no such page.
+            self.cache.setMiss(release, language, command)
+        return (None, None)
 
-    def __formatReply(self):
-        """Format the data for the IRC reply."""
-        format = self.registryValue('format')
-        vars = {
-                'url':self.parser.url,
-                'command':self.parser.command,
-                'name':self.parser.name,
-                'synopsis':self.parser.synopsis,
-                'description':self.parser.description,
-               }
-        replace = lambda : utils.str.perlVariableSubstitute(vars, format)
-        msg = replace()
+    def __getUrl(self, release, command, language):
+        """Get the URL to the manual page, where the redirections lead to,
+        or None if there is no manual page.  The page isn't downloaded, only
+        found."""
+        (fd, parser) = self.__getManPageFd(release, command, language,
+                                           fetch=False)
+        return fd
+
+    def __getSummary(self, release, command, language, format):
+        """Get the summary of a manual page as a dictionary with the url,
+        the command and the keywords needed by 'format'.  The summary is
+        taken from the cache if possible, even an expired one, which is then
+        refreshed in the background; otherwise the manual page is fetched
+        and parsed.  Returns None if there is no manual page and False if
+        the repository couldn't be reached."""
+        keywords = KeywordsParser()
+        keywords.checkKeywords(format)
+        useCache = self.registryValue('cache.enable')
+        if useCache:
+            entry = self.cache.lookup(release, language, command,
+                                      keywords.keysParsed)
+            if entry is not None:
+                (summary, expired) = entry
+                if not expired:
+                    self.stats.count(('cache', 'hit'))
+                    return summary
+                if self.registryValue('cache.serveStale'):
+                    self.stats.count(('cache', 'stale'))
+                    self.__refresh(release, command, language, summary)
+                    return summary
+            self.stats.count(('cache', 'miss'))
+        started = self.stats.start()
+        (fd, parser) = self.__getManPageFd(release, command, language)
+        self.stats.record('probe', started)
+        if not fd:
+            return fd
+        summary = self.__parseSummary(release, command, fd, parser, format)
+        if useCache:
+            self.cache.set(release, language, command, summary)
+        return summary
+
+    def __parseSummary(self, release, command, fd, parser, format):
+        """Parses the manual page opened by __getManPageFd and returns its
+        summary.  The validators of the response are kept in the summary, so
+        that it can be refreshed with a conditional request."""
+        keywords = KeywordsParser()
+        keywords.checkKeywords(format)
+        started = self.stats.start()
+        try:
+            parser.parse(fd, command, format)
+        except UbuntuManError:
+            self.log.info(
+                'plugins.UbuntuMan: Failed to parse the manpage in \'%s\'. ' \
+                'Report it to the plugin maintainer.' % parser.url)
+            self.stats.count(('failure', parser.language))
+            fd.close()
+            raise
+        fd.close()
+        if started is not None:
+            # The page is downloaded while it is parsed; the time spent
+            # waiting for the network is told apart by the response.
+            elapsed = time.time() - started
+            readTime = getattr(fd, 'readTime', 0.0)
+            self.stats.record('download', started, readTime)
+            self.stats.record('parse', started, elapsed - readTime)
+            self.stats.count(('bytes', ), getattr(fd, 'bytesRead', 0))
+        summary = {
+                   'url':parser.url,
+                   'command':command,
+                   'section':parser.section,
+                   'language':parser.language,
+                  }
+        for key in keywords.keysParsed:
+            summary[key] = getattr(parser, key)
+        if hasattr(fd, 'getheader'):
+            for (key, header) in (('etag', 'etag'),
+                                  ('modified', 'last-modified')):
+                value = fd.getheader(header)
+                if value:
+                    summary[key] = value
+        if parser.whatis:
+            self.aproposIndex.add(release, parser.language, command,
+                                  parser.section, parser.whatis)
+        return summary
+
+    def __refresh(self, release, command, language, summary):
+        """Refreshes an expired summary in the background, unless it is
+        already being refreshed."""
+        key = (release, language, command)
+        self.refreshLock.acquire()
+        try:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        finally:
+            self.refreshLock.release()
+        self.refreshes.submit(self.__revalidate, release, command, language,
+                              summary)
+
+    def __revalidate(self, release, command, language, summary):
+        """Fetches the manual page of an expired summary again, with a
+        conditional request: if the page hasn't changed, the repository
+        answers 304 and the summary is just kept for another ttl.  The page
+        is parsed for the keywords the summary has, since the page may well
+        lack the others.  If the repository can't be reached, the expired
+        summary stays; if the page can't be parsed any more, it is kept for
+        another ttl, so that it isn't fetched again at every lookup."""
+        keywords = KeywordsParser()
+        format = ' '.join(['$' + key for key in keywords.keys
+                           if key in summary])
+        try:
+            if self.registryValue('backend') == 'local':
+                (fd, parser) = self.__getManPageFd(release, command,
+                                                   language)
+            else:
+                headers = {}
+                if 'etag' in summary:
+                    headers['If-None-Match'] = summary['etag']
+                if 'modified' in summary:
+                    headers['If-Modified-Since'] = summary['modified']
+                try:
+                    fd = self.http.request(summary['url'], headers=headers)
+                except httpclient.HTTPError, e:
+                    if e.code != 404:
+                        raise
+                    fd = None
+                if fd is not None and fd.status == 304:
+                    fd.close()
+                    self.stats.count(('cache', 'unchanged'))
+                    self.cache.set(release, language, command, summary)
+                    return
+                parser = self.__getParser(summary['language'])
+                parser.url = summary['url']
+                parser.command = command
+                parser.section = summary['section']
+                parser.language = summary['language']
+            if not fd:
+                # The page is gone; it's looked up again the next time.
+                self.cache.delete(release, language, command)
+                return
+            self.cache.set(release, language, command,
+                           self.__parseSummary(release, command, fd, parser,
+                                               format))
+        except UbuntuManError, e:
+            self.log.info('UbuntuMan: Failed to refresh %s: %s',
+                          summary['url'], utils.exnToString(e))
+            self.cache.set(release, language, command, summary)
+        except utils.web.Error, e:
+            self.log.debug('UbuntuMan: Failed to refresh %s: %s',
+                           summary['url'], utils.exnToString(e))
+        finally:
+            self.refreshLock.acquire()
+            self.refreshing.discard((release, language, command))
+            self.refreshLock.release()
+
+    def __getReplyLength(self):
         length = conf.supybot.reply.mores.length()
         if not length:
             length = self.registryValue('maxLength')
-        if len(msg) > length:
-            # if we exceed in length lest try to cut one of the vars
-            # without ruining the format.
-            for var in self.parser.keywords.keysParsed:
-                cutLength = len(msg) - length
-                vars[var] = cut(vars[var], - cutLength)
-                msg = replace()
-                break
-            if len(msg) > length:
-                # alright, length is really just too short
-                msg = '%s ...' %(msg[:length - 4])
-        return msg
+        return length
+
+    def __lookupAll(self, f, release, commands, language, *args):
+        """Calls f(release, command, language, *args) for each of the
+        commands at the same time and returns the results in order.  The
+        first command is looked up in the calling thread, so the whole batch
+        takes about as long as its slowest lookup."""
+        buckets = getattr(self.requester, 'buckets', ())
+        jobs = [self.batches.submit(self.__runAs, buckets, f, release,
+                                    command, language, *args)
+                for command in commands[1:]]
+        results = [f(release, commands[0], language, *args)]
+        for job in jobs:
+            results.append(job.get())
+        return results
 
-    def man(self, irc, msg, args, command, optlist):
-        """<command> [--rel <release>] [--lang <language>]
+    def __replyAll(self, irc, replies):
+        """Replies with the replies of a batch packed into as few lines as
+        the reply length allows."""
+        replies = [reply for reply in replies if reply]
+        if not replies:
+            return
+        if irc.nested:
+            irc.reply(' || '.join(replies))
+            return
+        length = self.__getReplyLength()
+        lines = []
+        for reply in replies:
+            if lines and len(lines[-1]) + len(reply) + 4 <= length:
+                lines[-1] = '%s || %s' % (lines[-1], reply)
+            else:
+                lines.append(reply)
+        for ln in lines:
+            irc.reply(ln)
 
-        Displays a manual page from the Ubuntu Manpage Repository."""
-        release = None
+    def __getCommands(self, irc, msg, commands):
+        """Returns the commands of a batch without duplicates, or None after
+        replying with an error if there are too many of them."""
+        L = []
+        for command in commands:
+            if command not in L:
+                L.append(command)
+        maxCommands = self.registryValue('maxCommands')
+        if len(L) > maxCommands:
+            irc.error(format('You can look up at most %n at once.',
+                             (maxCommands, 'command')))
+            return None
+        return L
+
+    def __getTemplate(self, format):
+        """Returns the compiled format, compiling it again if the format
+        has been changed."""
+        compiled = self.template
+        if compiled is None or compiled.format != format:
+            compiled = template.Template(format,
+                ('url', 'command') + KeywordsParser().keys,
+                KeywordsParser().keys)
+            self.template = compiled
+        return compiled
+
+    def __formatReply(self, summary, format, note=''):
+        """Format the data for the IRC reply.  If it's too long, the
+        manpage sections in it are cut to fit, the longest the most.  The
+        'note' is appended to the reply."""
+        vars = {
+                'url':summary['url'],
+                'command':summary['command'],
+                'name':summary.get('name', ''),
+                'synopsis':summary.get('synopsis', ''),
+                'description':summary.get('description', ''),
+               }
+        compiled = self.__getTemplate(format)
+        length = self.__getReplyLength()
+        if note and length:
+            return compiled.render(vars, max(1, length - len(note))) + note
+        return compiled.render(vars, length)
+
+    def man(self, irc, msg, args, commands, optlist):
+        """<command> [<command> ...] [--rel <release>] [--lang <language>]
+
+        Displays a manual page from the Ubuntu Manpage Repository.  Several
+        commands are looked up at once."""
+        release = self.registryValue('release')
         language = self.registryValue('language')
         format = self.registryValue('format')
         for (opt, arg) in optlist:
@@ -314,53 +1176,386 @@ class UbuntuMan(callbacks.Plugin):
                 release = arg
             elif opt == 'lang':
                 language = arg
+        commands = self.__getCommands(irc, msg, commands)
+        if commands:
+            self.__runLookup(irc, msg, self.__man, release, commands, language,
+                             format)
+
+    man = wrap(man, [many('manCommand', continueOnError=True),
+                     getopts({'rel':'something', 'lang':'something'})])
+
+    def __man(self, irc, release, commands, language, format):
+        self.__replyAll(irc, self.__lookupAll(self.__manReply, release,
+                                              commands, language, format))
+
+    def __manReply(self, release, command, language, format):
+        started = self.stats.start()
         try:
-            fd = self.__getManPageFd(release, command, language)
-            if not fd:
-                irc.reply('No manual page for \'%s\'' % command)
-                return
-            self.parser.parse(fd, command, format)
-            #for var in self.parser.keywords.keysParsed:
-            #    log.debug('UbuntuMan.man() %s=\'%s\'' % (var,
-            #        getattr(self.parser, var)))
-            fd.close()
-            msg = self.__formatReply()
-            irc.reply(msg)
+            # Identical lookups made while this one is in flight wait for it
+            # instead of fetching and parsing the page again.
+            def lookup(release):
+                return self.inflight.call((release, language, command,
+                                           format), self.__getSummary,
+                                          release, command, language, format)
+            summary = lookup(release)
+            if summary is False:
+                return self.__unreachable(command)
+            note = ''
+            if summary is None:
+                found = self.__fallback(release, command, language, lookup)
+                if found is None:
+                    return self.__notFound(release, command)
+                (release, summary) = found
+                note = self.__fallbackNote(release)
+            self.cache.count(release, language, command)
+            self.names.add(release, command)
+            formatStarted = self.stats.start()
+            msg = self.__formatReply(summary, format, note)
+            self.stats.record('format', formatStarted)
+            return msg
         except UbuntuManError, e:
-            irc.reply('Failed to parse the manpage for \'%s\': %s' % (command,
-                e.message))
-            self.log.info(
-                'plugins.UbuntuMan: Failed to parse the manpage in \'%s\'. ' \
-                'Report it to the plugin maintainer.' % self.parser.url)
+            return 'Failed to parse the manpage for \'%s\': %s' % (command,
+                e.message)
+        except utils.web.Error, e:
+            # The connection failed while the page was being read.
+            self.log.debug('UbuntuMan: Failed to read the manual page of '
+                           '%s: %s', command, e)
+            return self.__unreachable(command)
+        except throttle.Throttled, e:
+            return self.__throttled(command, e.delay)
+        finally:
+            self.stats.record('lookup', started)
+
+    def manopt(self, irc, msg, args, command, option, optlist):
+        """<command> <option> [--rel <release>] [--lang <language>]
+
+        Tells what an option of a command does, as in "manopt grep -r",
+        from its manual page in the Ubuntu Manpage Repository."""
+        release = self.registryValue('release')
+        language = self.registryValue('language')
+        for (opt, arg) in optlist:
+            if opt == 'rel':
+                release = arg
+            elif opt == 'lang':
+                language = arg
+        if self.__getCommands(irc, msg, [command]):
+            self.__runLookup(irc, msg, self.__manopt, release, command,
+                             option, language)
+
+    manopt = wrap(manopt, ['manCommand', 'something',
+                           getopts({'rel':'something', 'lang':'something'})])
+
+    def __manopt(self, irc, release, command, option, language):
+        irc.reply(self.__manoptReply(release, command, option, language))
 
-    man = wrap(man, ['something', getopts({'rel':'something',
-                                           'lang':'something'})])
+    def __manoptReply(self, release, command, option, language):
+        try:
+            def lookup(release):
+                return self.inflight.call(('options', release, language,
+                                           command), self.__getOptions,
+                                          release, command, language)
+            index = lookup(release)
+            if index is False:
+                return self.__unreachable(command)
+            note = ''
+            if index is None:
+                found = self.__fallback(release, command, language, lookup)
+                if found is None:
+                    return self.__notFound(release, command)
+                (release, index) = found
+                note = self.__fallbackNote(release)
+        except utils.web.Error, e:
+            # The connection failed while the page was being read.
+            self.log.debug('UbuntuMan: Failed to read the manual page of '
+                           '%s: %s', command, e)
+            return self.__unreachable(command)
+        except throttle.Throttled, e:
+            return self.__throttled(command, e.delay)
+        self.names.add(release, command)
+        entry = index.lookup(option)
+        if entry is None:
+            return 'The manual page for \'%s\' has no option %s%s' % \
+                   (command, option, note)
+        return template.cut('%s %s: %s' % ((command, ) + entry),
+                            self.__getReplyLength() - len(note)) + note
+
+    def __getOptions(self, release, command, language):
+        """Returns the options.OptionIndex of a manual page.  The page is
+        fetched and its options parsed once, and the index is cached for the
+        next options asked for.  Returns None if there is no manual page and
+        False if the repository couldn't be reached."""
+        useCache = self.registryValue('cache.enable')
+        key = (release, language, command)
+        if useCache:
+            index = self.optionIndexes.get(key)
+            if index is not None:
+                return index
+        (fd, parser) = self.__getManPageFd(release, command, language)
+        if not fd:
+            return fd
+        started = self.stats.start()
+        try:
+            index = parser.parseOptions(fd)
+        finally:
+            fd.close()
+        if started is not None:
+            elapsed = time.time() - started
+            readTime = getattr(fd, 'readTime', 0.0)
+            self.stats.record('download', started, readTime)
+            self.stats.record('parse', started, elapsed - readTime)
+        if useCache:
+            self.optionIndexes.set(key, index)
+        return index
 
-    def manurl(self, irc, msg, args, command, optlist):
-        """<command> [--rel <release>] [--lang <language>]
+    def manurl(self, irc, msg, args, commands, optlist):
+        """<command> [<command> ...] [--rel <release>] [--lang <language>]
 
         Gives the URL to the full manual page in the Ubuntu Manpage
-        Repository."""
-        release = None
+        Repository.  Several commands are looked up at once."""
+        release = self.registryValue('release')
         language = self.registryValue('language')
         for (opt, arg) in optlist:
             if opt == 'rel':
                 release = arg
             elif opt == 'lang':
                 language = arg
+        commands = self.__getCommands(irc, msg, commands)
+        if commands:
+            self.__runLookup(irc, msg, self.__manurl, release, commands,
+                             language)
+
+    manurl = wrap(manurl, [many('manCommand', continueOnError=True),
+                           getopts({'rel':'something', 'lang':'something'})])
+
+    def __manurl(self, irc, release, commands, language):
+        self.__replyAll(irc, self.__lookupAll(self.__manurlReply, release,
+                                              commands, language))
+
+    def __manurlReply(self, release, command, language):
         try:
-            fd = self.__getManPageFd(release, command, language)
-            if not fd:
-                irc.reply('No manual page for \'%s\'' % command)
+            def lookup(release):
+                return self.inflight.call((release, language, command, None),
+                                          self.__getUrl, release, command,
+                                          language)
+            url = lookup(release)
+            if url is False:
+                return self.__unreachable(command)
+            note = ''
+            if url is None:
+                found = self.__fallback(release, command, language, lookup)
+                if found is None:
+                    return self.__notFound(release, command)
+                (release, url) = found
+                note = self.__fallbackNote(release)
+            self.names.add(release, command)
+            return url + note
+        except utils.web.Error, e:
+            self.log.debug('UbuntuMan: Failed to find the manual page of '
+                           '%s: %s', command, e)
+            return self.__unreachable(command)
+        except throttle.Throttled, e:
+            return self.__throttled(command, e.delay)
+
+    def manprefetch(self, irc, msg, args, optlist, what):
+        """[--rel <release>] [--lang <language>] {<listfile>|top <n>}
+
+        Fetches and caches the manual pages of the commands listed in
+        <listfile>, one per line, or of the <n> most requested commands, so
+        that they are answered without contacting the Ubuntu Manpage
+        Repository."""
+        release = self.registryValue('release')
+        language = self.registryValue('language')
+        for (opt, arg) in optlist:
+            if opt == 'rel':
+                release = arg
+            elif opt == 'lang':
+                language = arg
+        if not self.registryValue('cache.enable'):
+            irc.error('The cache is disabled.')
+            return
+        if len(what) == 2 and what[0] == 'top':
+            try:
+                n = int(what[1])
+            except ValueError:
+                n = 0
+            if n <= 0:
+                irc.errorInvalid('number of commands', what[1])
                 return
-            irc.reply(fd.url)
-            fd.close()
-        except:
-            pass
+            commands = self.cache.top(release, language, n)
+        elif len(what) == 1:
+            try:
+                fd = open(what[0])
+                try:
+                    commands = [ln.strip() for ln in fd
+                                if ln.strip() and not ln.startswith('#')]
+                finally:
+                    fd.close()
+            except EnvironmentError, e:
+                irc.error('Failed to read %s: %s' % (what[0],
+                                                     utils.exnToString(e)))
+                return
+        else:
+            raise callbacks.ArgumentError
+        if not commands:
+            irc.error('There are no commands to prefetch.')
+            return
+        self.__runLookup(irc, msg, self.__manprefetch, release, language,
+                         commands)
+
+    manprefetch = wrap(manprefetch, ['owner', getopts({'rel':'something',
+                                                       'lang':'something'}),
+                                     many('something')])
+
+    def __manprefetch(self, irc, release, language, commands):
+        # The summaries are prefetched with all the keywords, so that they
+        # serve any format.
+        keywords = KeywordsParser()
+        fullFormat = ' '.join(['$' + key for key in keywords.keys])
+        interval = 1.0 / self.registryValue('prefetch.rate')
+        slot = [time.time()]
+        lock = threading.Lock()
+        def prefetch(command):
+            summary = self.cache.get(release, language, command,
+                                     keywords.keys)
+            if summary is not None:
+                return summary
+            # Only pages that aren't cached yet are rate limited.
+            lock.acquire()
+            try:
+                now = time.time()
+                delay = slot[0] - now
+                slot[0] = max(slot[0], now) + interval
+            finally:
+                lock.release()
+            if delay > 0:
+                time.sleep(delay)
+            return self.inflight.call((release, language, command,
+                                       fullFormat), self.__getSummary,
+                                      release, command, language, fullFormat)
+        irc.reply(format('Prefetching %n for %s/%s.',
+                         (len(commands), 'manual page'), release, language))
+        started = lastReport = time.time()
+        (found, missing, failed) = (0, 0, 0)
+        workers = pool.WorkerPool('UbuntuMan prefetch',
+            self.registryValue('prefetch.workers', value=False))
+        try:
+            for job in workers.map(prefetch, commands):
+                try:
+                    summary = job.get()
+                    if summary:
+                        found += 1
+                    elif summary is None:
+                        missing += 1
+                    else:
+                        failed += 1
+                except Exception, e:
+                    self.log.info('UbuntuMan: Failed to prefetch: %s',
+                                  utils.exnToString(e))
+                    failed += 1
+                if time.time() - lastReport >= 30:
+                    lastReport = time.time()
+                    irc.reply('Prefetched %s of %s manual pages so far.' %
+                              (found + missing + failed, len(commands)))
+        finally:
+            workers.stop()
+        irc.reply(format('Prefetched %n in %.1f seconds; %i had no manual '
+                         'page and %i failed.', (found, 'manual page'),
+                         time.time() - started, missing, failed))
 
-    manurl = wrap(manurl, ['something', getopts({'rel':'something',
+    def manindex(self, irc, msg, args, optlist):
+        """[--rel <release>] [--lang <language>]
+
+        Rebuilds the index of the sections the manual pages exist in, for the
+        given release and language and for English, which is used as a
+        fallback.  The index is built from the directory listings of the
+        Ubuntu Manpage Repository, or from the local mirror in
+        supybot.plugins.UbuntuMan.index.mirror if it is set."""
+        release = self.registryValue('release')
+        language = self.registryValue('language')
+        for (opt, arg) in optlist:
+            if opt == 'rel':
+                release = arg
+            elif opt == 'lang':
+                language = arg
+        languages = [language]
+        if language != 'en':
+            languages.append('en')
+        self.__runLookup(irc, msg, self.__manindex, release, languages)
+
+    manindex = wrap(manindex, ['admin', getopts({'rel':'something',
                                                  'lang':'something'})])
 
+    def __manindex(self, irc, release, languages):
+        L = []
+        for language in languages:
+            try:
+                count = self.__buildIndex(release, language)
+            except utils.web.Error, e:
+                irc.error('Failed to index %s/%s: %s' % (release, language, e))
+                return
+            text = format('%n in %s/%s', (count, 'manual page'), release,
+                          language)
+            count = self.__buildApropos(release, language)
+            if count is not None:
+                text += format(' (%n for apropos)', (count, 'NAME line'))
+            L.append(text)
+        # Misses remembered before the index may not be misses any more.
+        self.cache.clearMisses()
+        self.names.invalidate(release)
+        irc.reply('Indexed %s.' % utils.str.commaAndify(L))
+
+    def manapropos(self, irc, msg, args, words, optlist):
+        """<words> [--rel <release>] [--lang <language>]
+
+        Searches the one line descriptions of the manual pages for the
+        words, like apropos(1) does.  Only the manual pages that have been
+        looked up, or indexed by manindex, are searched."""
+        release = self.registryValue('release')
+        language = self.registryValue('language')
+        for (opt, arg) in optlist:
+            if opt == 'rel':
+                release = arg
+            elif opt == 'lang':
+                language = arg
+        query = ' '.join(words)
+        limit = self.registryValue('apropos.maxResults')
+        results = self.aproposIndex.search(release, language, query, limit)
+        if language != 'en' and len(results) < limit:
+            # Pages missing in the language were looked up in English.
+            found = set([result[0] for result in results])
+            for result in self.aproposIndex.search(release, 'en', query,
+                                                   limit):
+                if len(results) < limit and result[0] not in found:
+                    results.append(result)
+        if not results:
+            irc.reply('%s: nothing appropriate.' % query)
+            return
+        self.__replyAll(irc, ['%s(%s) - %s' % result for result in results])
+
+    manapropos = wrap(manapropos, [many('manCommand', continueOnError=True),
+                                   getopts({'rel':'something',
+                                            'lang':'something'})])
+
+    def manstats(self, irc, msg, args, optlist):
+        """[--reset]
+
+        Shows how long the stages of the lookups have taken and how many
+        requests, cache hits and parse failures there have been since the
+        plugin was loaded.  With --reset, the statistics are started over
+        after they are shown."""
+        if not self.registryValue('stats.enable'):
+            irc.error('The statistics are disabled.')
+            return
+        (records, bodies, size) = self.cache.store.memory()
+        irc.reply(format('%s; cached: %n (%n of text) in %.1f MB',
+                         self.stats.summary(), (records, 'manual page'),
+                         (bodies, 'distinct'), size / 1024.0 / 1024))
+        for (opt, arg) in optlist:
+            if opt == 'reset':
+                self.stats.reset()
+
+    manstats = wrap(manstats, ['owner', getopts({'reset':''})])
+
 
 Class = UbuntuMan
 
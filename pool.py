@@ -0,0 +1,282 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.log as log
+import supybot.world as world
+
+import sys
+import Queue
+import threading
+import collections
+
+class Job:
+    """A call queued to a WorkerPool.  The caller can wait for its result or
+    cancel it.  A cancelled job is not started if it is still queued; if it
+    is already running, its result is passed to the 'discard' function given
+    to cancel() as soon as it finishes."""
+
+    def __init__(self, f, args, kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.excInfo = None
+        self.cancelled = False
+        self.discard = None
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        if self.cancelled:
+            self.finished.set()
+            return
+        try:
+            self.result = self.f(*self.args, **self.kwargs)
+        except Exception:
+            self.excInfo = sys.exc_info()
+        self.lock.acquire()
+        try:
+            self.finished.set()
+            discard = self.cancelled and self.discard
+        finally:
+            self.lock.release()
+        if discard and self.excInfo is None:
+            discard(self.result)
+
+    def cancel(self, discard=None):
+        """Cancels the job.  'discard' is called with the result of the job if
+        it has been or will be computed anyway."""
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            self.discard = discard
+            done = self.finished.isSet()
+        finally:
+            self.lock.release()
+        if done and discard and self.excInfo is None:
+            discard(self.result)
+
+    def wait(self, timeout=None):
+        """Waits until the job is finished.  Returns False if the timeout
+        expired first."""
+        self.finished.wait(timeout)
+        return self.finished.isSet()
+
+    def get(self, timeout=None):
+        """Waits for the job and returns its result, or raises the exception
+        raised by the job."""
+        self.wait(timeout)
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.result
+
+
+class WorkerPool:
+    """A bounded pool of threads running queued jobs.  'size' is a callable
+    (usually a registry value) giving the maximum number of threads; the
+    threads are started lazily as jobs are submitted."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.idle = 0
+        self.lock = threading.Lock()
+
+    def submit(self, f, *args, **kwargs):
+        """Queues f(*args, **kwargs) and returns its Job."""
+        job = Job(f, args, kwargs)
+        self.lock.acquire()
+        try:
+            if self.queue.qsize() >= self.idle and \
+               len(self.threads) < max(1, self.size()):
+                thread = world.SupyThread(target=self.__work,
+                    name='%s #%s' % (self.name, len(self.threads) + 1))
+                thread.setDaemon(True)
+                self.threads.append(thread)
+                self.idle += 1
+                thread.start()
+            self.queue.put(job)
+        finally:
+            self.lock.release()
+        return job
+
+    def map(self, f, iterable):
+        """Like map(), but the calls are run in the pool.  Returns the list
+        of Jobs in the same order."""
+        return [self.submit(f, x) for x in iterable]
+
+    def stop(self):
+        """Stops the threads once they have run the jobs already queued."""
+        self.lock.acquire()
+        try:
+            for thread in self.threads:
+                self.queue.put(None)
+            self.threads = []
+            self.idle = 0
+        finally:
+            self.lock.release()
+
+    def __work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.lock.acquire()
+            self.idle -= 1
+            self.lock.release()
+            try:
+                job.run()
+            except Exception:
+                log.exception('UbuntuMan: Uncaught exception in %s:',
+                              self.name)
+            self.lock.acquire()
+            self.idle += 1
+            self.lock.release()
+
+
+class FairPool:
+    """A bounded pool of threads running jobs queued under keys, such as the
+    channels they were asked for in.  The jobs of each key are run in the
+    order they were queued, and the keys take turns, so that a key with many
+    queued jobs doesn't hold back the others.  'size' and 'depth' are
+    callables (usually registry values) giving the maximum number of threads
+    and of queued jobs; zero depth means no limit."""
+
+    def __init__(self, name, size, depth):
+        self.name = name
+        self.size = size
+        self.depth = depth
+        # key -> deque of Jobs, and the keys having queued jobs in the order
+        # they get their turn.
+        self.queues = {}
+        self.turns = collections.deque()
+        self.queued = 0
+        self.threads = []
+        self.idle = 0
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def submit(self, key, f, *args, **kwargs):
+        """Queues f(*args, **kwargs) under 'key' and returns its Job, or None
+        if the queue is full."""
+        self.cond.acquire()
+        try:
+            depth = self.depth()
+            if depth and self.queued >= depth:
+                return None
+            job = Job(f, args, kwargs)
+            if key not in self.queues:
+                self.queues[key] = collections.deque()
+                self.turns.append(key)
+            self.queues[key].append(job)
+            self.queued += 1
+            if self.queued > self.idle and \
+               len(self.threads) < max(1, self.size()):
+                thread = world.SupyThread(target=self.__work,
+                    name='%s #%s' % (self.name, len(self.threads) + 1))
+                thread.setDaemon(True)
+                self.threads.append(thread)
+                self.idle += 1
+                thread.start()
+            self.cond.notify()
+            return job
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        """Stops the threads once they have run the jobs already queued."""
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.threads = []
+            self.idle = 0
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def __next(self):
+        """Returns the next job to run, or None when stopping with nothing
+        left to run."""
+        self.cond.acquire()
+        try:
+            while not self.turns:
+                if self.stopping:
+                    return None
+                self.cond.wait()
+            key = self.turns.popleft()
+            queue = self.queues[key]
+            job = queue.popleft()
+            if queue:
+                self.turns.append(key)
+            else:
+                del self.queues[key]
+            self.queued -= 1
+            self.idle -= 1
+            return job
+        finally:
+            self.cond.release()
+
+    def __work(self):
+        while True:
+            job = self.__next()
+            if job is None:
+                return
+            try:
+                job.run()
+            except Exception:
+                log.exception('UbuntuMan: Uncaught exception in %s:',
+                              self.name)
+            self.cond.acquire()
+            self.idle += 1
+            self.cond.release()
+
+
+class Coalescer:
+    """Coalesces identical calls made at the same time.  While a call for a
+    key is in flight, further calls for the same key don't run again but wait
+    for it and get the same result, or the same exception."""
+
+    def __init__(self):
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def call(self, key, f, *args, **kwargs):
+        """Returns f(*args, **kwargs), or the result of the identical call
+        already in flight for 'key'."""
+        self.lock.acquire()
+        try:
+            job = self.inflight.get(key)
+            owner = job is None
+            if owner:
+                job = Job(f, args, kwargs)
+                self.inflight[key] = job
+        finally:
+            self.lock.release()
+        if owner:
+            try:
+                job.run()
+            finally:
+                self.lock.acquire()
+                del self.inflight[key]
+                self.lock.release()
+        return job.get()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
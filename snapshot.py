@@ -0,0 +1,136 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import supybot.log as log
+import supybot.utils as utils
+
+import os
+import mmap
+import struct
+import threading
+import cPickle as pickle
+
+# The first line of a snapshot file.  A cache or apropos file without it is
+# in an older format: it is ignored with a warning, and the plugin starts with
+# an empty cache or index.
+MAGIC = 'UbuntuMan snapshot 1\n'
+
+# The length of a chunk, before its pickle.
+header = struct.Struct('!I')
+
+def write(fd, sections, chunkSize=1000):
+    """Writes a snapshot of 'sections', a list of (name, items) pairs, to the
+    file object 'fd'.  The items are pickled in chunks of 'chunkSize', each
+    preceded by its length, so that the snapshot can be loaded a chunk at a
+    time in the order it was written, the most useful items first."""
+    fd.write(MAGIC)
+    for (name, items) in sections:
+        for i in xrange(0, len(items), chunkSize):
+            data = pickle.dumps((name, items[i:i + chunkSize]),
+                                pickle.HIGHEST_PROTOCOL)
+            fd.write(header.pack(len(data)))
+            fd.write(data)
+
+def isSnapshot(filename):
+    fd = open(filename, 'rb')
+    try:
+        return fd.read(len(MAGIC)) == MAGIC
+    finally:
+        fd.close()
+
+
+class Reader:
+    """Iterates over the (name, items) chunks of a snapshot file.  The file
+    is memory mapped and a chunk is only unpickled when it's reached, so
+    opening a snapshot costs nothing whatever its size."""
+
+    def __init__(self, filename):
+        fd = open(filename, 'rb')
+        try:
+            if os.fstat(fd.fileno()).st_size:
+                self.data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''
+        finally:
+            fd.close()
+
+    def __iter__(self):
+        data = self.data
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a snapshot file.')
+        pos = len(MAGIC)
+        while pos < len(data):
+            (size, ) = header.unpack(data[pos:pos + header.size])
+            pos += header.size
+            if pos + size > len(data):
+                raise ValueError('Truncated snapshot file.')
+            yield pickle.loads(data[pos:pos + size])
+            pos += size
+
+    def close(self):
+        if not isinstance(self.data, str):
+            self.data.close()
+        self.data = ''
+
+
+class WarmUp:
+    """Loads a snapshot file in a background thread, a chunk at a time, by
+    calling 'load' with the name and the items of each chunk.  What has been
+    loaded can be used at once, while the rest is still being read."""
+
+    def __init__(self, name, filename, load):
+        self.filename = filename
+        self.load = load
+        self.stopped = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            try:
+                reader = Reader(self.filename)
+                try:
+                    for (name, items) in reader:
+                        if self.stopped:
+                            break
+                        self.load(name, items)
+                finally:
+                    reader.close()
+            except Exception, e:
+                log.warning('UbuntuMan: Couldn\'t load the snapshot %s: %s',
+                            self.filename, utils.exnToString(e))
+        finally:
+            self.done.set()
+
+    def isDone(self):
+        return self.done.isSet()
+
+    def wait(self, timeout=None):
+        """Waits until the snapshot has been loaded."""
+        self.done.wait(timeout)
+        return self.done.isSet()
+
+    def stop(self):
+        """Stops loading the snapshot after the current chunk."""
+        self.stopped = True
+        self.done.wait()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
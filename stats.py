@@ -0,0 +1,178 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+# The stages of a lookup, in the order they are reported: the whole lookup,
+# finding the manual page, downloading it, parsing it and formatting the
+# reply.
+STAGES = ('lookup', 'probe', 'download', 'parse', 'format')
+
+# Upper bounds of the buckets of the latency histograms, in milliseconds.
+MILLISECONDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Upper bounds of the buckets of the probes per lookup histogram.
+PROBES = (0, 1, 2, 3, 4, 6, 8, 12, 16)
+
+class Histogram:
+    """Histogram of values in fixed buckets.  The buckets are given by their
+    upper bounds; values above the last bound go to an overflow bucket."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return 0
+        return self.total / float(self.count)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket the p-th percentile falls
+        in, or the largest value if it is in the overflow bucket."""
+        rank = p / 100.0 * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+
+class Stats:
+    """Per-stage latency histograms and counters of the lookups.  'enabled'
+    is a callable (usually a registry value); while it is false, start()
+    returns None and nothing is recorded, so the instrumentation costs a
+    function call per stage."""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.since = time.time()
+            self.stages = {}
+            self.probes = Histogram(PROBES)
+            self.counters = {}
+        finally:
+            self.lock.release()
+
+    def start(self):
+        """Returns the time a stage starts, to be given to record()."""
+        if not self.enabled():
+            return None
+        return time.time()
+
+    def record(self, stage, started, seconds=None):
+        """Records the latency of a stage started at 'started', or lasting
+        'seconds' if given."""
+        if started is None:
+            return
+        if seconds is None:
+            seconds = time.time() - started
+        self.lock.acquire()
+        try:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(MILLISECONDS)
+            self.stages[stage].add(seconds * 1000)
+        finally:
+            self.lock.release()
+
+    def recordProbes(self, count):
+        """Records the number of requests made to find a manual page."""
+        if not self.enabled():
+            return
+        self.lock.acquire()
+        try:
+            self.probes.add(count)
+        finally:
+            self.lock.release()
+
+    def count(self, key, n=1):
+        """Adds n to a counter.  The keys are tuples, like ('hit', '1',
+        'en')."""
+        if not self.enabled():
+            return
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + n
+        finally:
+            self.lock.release()
+
+    def __counters(self, kind):
+        L = [('/'.join(key[1:]), n) for (key, n) in self.counters.iteritems()
+             if key[0] == kind]
+        L.sort(key=lambda x: (-x[1], x[0]))
+        return ', '.join(['%s %s' % x for x in L]) or 'none'
+
+    def summary(self):
+        """Returns the statistics as a line of text."""
+        self.lock.acquire()
+        try:
+            L = []
+            for stage in STAGES:
+                h = self.stages.get(stage)
+                if h is None or not h.count:
+                    continue
+                L.append('%s: %s, mean %.0fms, p50 %.0fms, p90 %.0fms, '
+                         'max %.0fms' % (stage, h.count, h.mean(),
+                         h.percentile(50), h.percentile(90), h.max))
+            if self.probes.count:
+                L.append('probes per lookup: mean %.1f, p90 %s, max %s' %
+                         (self.probes.mean(), self.probes.percentile(90),
+                          self.probes.max))
+            L.append('cache: %s hits, %s misses, %s stale (%s unchanged)' %
+                     (self.counters.get(('cache', 'hit'), 0),
+                      self.counters.get(('cache', 'miss'), 0),
+                      self.counters.get(('cache', 'stale'), 0),
+                      self.counters.get(('cache', 'unchanged'), 0)))
+            L.append('bytes read: %s' % self.counters.get(('bytes', ), 0))
+            L.append('found: %s' % self.__counters('hit'))
+            L.append('not found: %s' % self.__counters('miss'))
+            L.append('found in a fallback release: %s' %
+                     self.counters.get(('fallback', ), 0))
+            L.append('parse failures: %s' % self.__counters('failure'))
+            L.append('since %s' % time.strftime('%Y-%m-%d %H:%M:%S',
+                                                time.localtime(self.since)))
+            return '; '.join(L)
+        finally:
+            self.lock.release()
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
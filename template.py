@@ -0,0 +1,111 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+# The variables of a format, as utils.str.perlVariableSubstitute finds them:
+# $name or ${name}.
+varRe = re.compile(r'\$\{([^}]+)\}|\$([a-zA-Z][a-zA-Z0-9]*)')
+
+def cut(s, limit):
+    """Cuts a string nicely at the end of a word, so that it's at most
+    'limit' characters long with the ' ...' added.  A string without a
+    space to cut at is cut in the middle of the word."""
+    if len(s) <= limit:
+        return s
+    if limit < 4:
+        return ''
+    idx = s.rfind(' ', 0, limit - 3)
+    if idx < 1:
+        idx = limit - 4
+    return '%s ...' % s[:idx]
+
+def allocate(lengths, budget):
+    """Shares 'budget' characters between values of the given lengths
+    fairly: the values shorter than an equal share keep their length and
+    what they leave is shared between the longer ones.  Returns the length
+    allowed for each value."""
+    allowed = list(lengths)
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    left = len(order)
+    for i in order:
+        share = budget // left
+        if lengths[i] > share:
+            allowed[i] = share
+        budget -= allowed[i]
+        left -= 1
+    return allowed
+
+
+class Template:
+    """A reply format compiled into its literal text and its variable slots,
+    so that a reply is made by a single join, and one that is too long is
+    fitted to the length in a single pass.  The variables of 'format' not in
+    'names' are kept as they are, like perlVariableSubstitute does; those in
+    'cuttable' are the ones that may be cut to fit the length."""
+
+    def __init__(self, format, names, cuttable=()):
+        self.format = format
+        # The parts of the reply: the literal text at the even indexes and
+        # the slots at the odd ones.
+        self.parts = []
+        self.slots = []
+        literal = []
+        pos = 0
+        for m in varRe.finditer(format):
+            literal.append(format[pos:m.start()])
+            pos = m.end()
+            name = m.group(1) or m.group(2)
+            if name not in names:
+                literal.append(m.group(0))
+                continue
+            self.parts.append(''.join(literal))
+            self.parts.append(None)
+            self.slots.append(name)
+            literal = []
+        literal.append(format[pos:])
+        self.parts.append(''.join(literal))
+        self.width = sum([len(self.parts[i])
+                          for i in xrange(0, len(self.parts), 2)])
+        self.cuttable = [i for (i, name) in enumerate(self.slots)
+                         if name in cuttable]
+
+    def render(self, vars, length=0):
+        """Returns the reply with the slots filled from 'vars'.  If it's
+        longer than 'length' (and 'length' isn't zero), the cuttable values
+        share the room the rest of the reply leaves them, and if that isn't
+        enough, the whole reply is cut."""
+        values = [vars[name] for name in self.slots]
+        total = self.width + sum(map(len, values))
+        if length and total > length and self.cuttable:
+            lengths = [len(values[i]) for i in self.cuttable]
+            budget = length - (total - sum(lengths))
+            if budget > 0:
+                allowed = allocate(lengths, budget)
+                for (i, limit) in zip(self.cuttable, allowed):
+                    values[i] = cut(values[i], limit)
+        parts = self.parts[:]
+        parts[1::2] = values
+        msg = ''.join(parts)
+        if length and len(msg) > length:
+            # alright, length is really just too short
+            msg = '%s ...' % msg[:length - 4]
+        return msg
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -18,9 +18,19 @@
 
 from supybot.test import *
 
+import os
+import re
+import time
+import tempfile
+import threading
+from cStringIO import StringIO
+
 UbuntuMan = plugin.loadPluginModule('UbuntuMan')
+UMPlugin = UbuntuMan.plugin
 UMConf = conf.supybot.plugins.UbuntuMan
 
+from UbuntuMan.benchmarks import corpus, server
+
 class UbuntuManTestCase(PluginTestCase):
     plugins = ('UbuntuMan',)
 
@@ -70,4 +80,926 @@ class UbuntuManTestCase(PluginTestCase):
         finally:
             conf.supybot.plugins.UbuntuMan.format.setValue(confbak)
 
+class UbuntuManOfflineTestCase(PluginTestCase):
+    plugins = ('UbuntuMan', 'Utilities')
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.baseurl = UMConf.baseurl()
+        self.fixture = server.FixtureServer(corpus.generate())
+        UMConf.baseurl.setValue(self.fixture.start())
+
+    def tearDown(self):
+        UMConf.baseurl.setValue(self.baseurl)
+        self.fixture.stop()
+        PluginTestCase.tearDown(self)
+
+    def testMan(self):
+        self.assertRegexp('man grep', r'^grep \| grep \[OPTION\]')
+        self.assertRegexp('man nosuchcommand', '^No manual page for')
+        for language in corpus.LANGUAGES:
+            self.assertNotRegexp('man grep --lang %s' % language,
+                                 '^Failed to parse')
+
+    def testThreaded(self):
+        self.fixture.stalled['/karmic/en/man1/tar.1.html'] = 2
+        # the slow lookup doesn't hold back the other channel
+        started = time.time()
+        self.feedMsg('%s: man tar' % self.nick, to='#slow')
+        m = self.getMsg('%s: man grep' % self.nick, to='#fast')
+        self.assertEqual(m.args[0], '#fast')
+        self.assertTrue(re.search(r'grep \| grep \[OPTION\]', m.args[1]))
+        self.assertTrue(time.time() - started < 1)
+        m = self.waitMsg()
+        self.assertEqual(m.args[0], '#slow')
+        # nested commands get their reply right away
+        self.assertRegexp('echo [man grep] (nested)',
+                          r'^grep \| grep \[OPTION\].* \(nested\)$')
+
+    def testBracedFormat(self):
+        format = UMConf.format()
+        UMConf.format.setValue('${name} -- ${synopsis}')
+        try:
+            self.assertRegexp('man grep', r'^grep -- grep \[OPTION\]')
+        finally:
+            UMConf.format.setValue(format)
+
+    def testManurl(self):
+        self.assertResponse('manurl fstab', '%s/karmic/en/man5/fstab.5.html' %
+                            self.fixture.url())
+        # the enabled sections are probed at once, but the probes still
+        # queued when the page is found are cancelled
+        self.assertTrue(self.fixture.requests <= len(UMConf.sections()))
+        self.assertEqual(self.fixture.statuses[200], 1)
+
+    def testProbe(self):
+        url = '%s/karmic/en/man5/fstab.5.html' % self.fixture.url()
+        # manurl only checks that the page exists
+        self.assertResponse('manurl fstab', url)
+        self.assertEqual(self.fixture.methods.keys(), ['HEAD'])
+        self.assertEqual(self.fixture.downloads, 0)
+        # man downloads the page that was found, and no other
+        self.fixture.reset()
+        self.assertRegexp('man fstab', '^fstab')
+        self.assertEqual(self.fixture.downloads, 1)
+        # without HEAD, the first byte of the page is asked for
+        self.fixture.reset()
+        self.fixture.allowHead = False
+        self.assertResponse('manurl fstab', url)
+        self.assertEqual(self.fixture.statuses[206], 1)
+
+    def testManurlRedirect(self):
+        page = self.fixture.pages['/karmic/en/man1/grep.1.html']
+        self.fixture.pages['/new/karmic/en/man1/moved.1.html'] = \
+            page.replace('grep', 'moved')
+        self.fixture.redirects['/karmic/en/man1/moved.1.html'] = \
+            '/new/karmic/en/man1/moved.1.html'
+        # the URL given is where the page has moved to
+        url = '%s/new/karmic/en/man1/moved.1.html' % self.fixture.url()
+        self.assertResponse('manurl moved', url)
+        self.assertRegexp('man moved', '^moved')
+
+    def testManopt(self):
+        page = self.fixture.pages['/karmic/en/man1/grep.1.html']
+        m = re.search(r'<b>-(\w)</b>, <b>--([\w-]+)</b>\n +(\w+)', page)
+        (short, long, word) = m.groups()
+        self.assertRegexp('manopt grep -%s' % short,
+                          r'^grep -%s, --%s: %s ' % (short, long, word))
+        requests = self.fixture.requests
+        self.assertRegexp('manopt grep --%s' % long, '^grep -%s' % short)
+        self.assertRegexp('manopt grep -Z', '^The manual page for \'grep\' '
+                          'has no option -Z')
+        # the options of the page are known
+        self.assertEqual(self.fixture.requests, requests)
+        self.assertRegexp('manopt nosuchcommand -r', '^No manual page for')
+
+    def testManoptUnreachable(self):
+        self.fixture.stalled['/karmic/en/man1/grep.1.html'] = 2
+        timeout = UMConf.timeout()
+        UMConf.timeout.setValue(1)
+        try:
+            self.assertResponse('manopt grep -r', 'The Ubuntu Manpage '
+                                'Repository can\'t be reached, no manual '
+                                'page for \'grep\' for now')
+        finally:
+            UMConf.timeout.setValue(timeout)
+
+    def testFallback(self):
+        page = self.fixture.pages['/karmic/en/man1/grep.1.html']
+        self.fixture.pages['/hardy/en/man1/oldcmd.1.html'] = \
+            page.replace('grep', 'oldcmd')
+        self.assertRegexp('man oldcmd', '^No manual page for')
+        releases = UMConf.fallback.releases()
+        UMConf.fallback.releases.setValue(['karmic', 'jaunty', 'hardy'])
+        try:
+            self.assertRegexp('man oldcmd', r'^oldcmd.*\[from hardy\]$')
+            requests = self.fixture.requests
+            self.assertRegexp('man oldcmd', r'\[from hardy\]$')
+            # jaunty is known not to have the page and hardy to have it
+            self.assertEqual(self.fixture.requests, requests)
+            self.assertResponse('manurl oldcmd',
+                                '%s/hardy/en/man1/oldcmd.1.html [from hardy]'
+                                % self.fixture.url())
+            requests = self.fixture.requests
+            maxLookups = UMConf.fallback.maxLookups()
+            UMConf.fallback.maxLookups.setValue(0)
+            try:
+                self.assertRegexp('man nosuchcommand', '^No manual page for')
+                # only the sections of karmic are looked in
+                self.assertEqual(self.fixture.requests - requests,
+                                 len(UMConf.sections()))
+            finally:
+                UMConf.fallback.maxLookups.setValue(maxLookups)
+        finally:
+            UMConf.fallback.releases.setValue(releases)
+
+    def testNotFound(self):
+        self.fixture.notFound = 1.0
+        self.assertRegexp('man grep', '^No manual page for')
+
+    def testBatch(self):
+        self.fixture.latency = 0.3
+        format = UMConf.format()
+        UMConf.format.setValue('$command')
+        try:
+            started = time.time()
+            self.assertResponse('man tar gzip xz --lang en',
+                                'tar || gzip || xz')
+            # the commands are looked up at the same time
+            self.assertTrue(time.time() - started < 0.75)
+        finally:
+            UMConf.format.setValue(format)
+        self.assertResponse('manurl fstab nosuchcommand',
+                            '%s/karmic/en/man5/fstab.5.html || '
+                            'No manual page for \'nosuchcommand\'' %
+                            self.fixture.url())
+        self.assertError('man a b c d e f')
+
+    def testBatchUnreachable(self):
+        self.fixture.stalled['/karmic/en/man1/gzip.1.html'] = 2
+        format = UMConf.format()
+        timeout = UMConf.timeout()
+        UMConf.format.setValue('$command: $name')
+        UMConf.timeout.setValue(1)
+        try:
+            # the page that times out doesn't take the others with it
+            self.assertRegexp('man tar gzip xz --lang en',
+                              r'^tar: .* \|\| The Ubuntu Manpage Repository '
+                              r'can\'t be reached, no manual page for '
+                              r'\'gzip\' for now \|\| xz: ')
+        finally:
+            UMConf.format.setValue(format)
+            UMConf.timeout.setValue(timeout)
+
+    def testSuggestions(self):
+        self.assertNotError('man grep')
+        self.assertResponse('man grpe', 'No manual page for \'grpe\'; '
+                            'did you mean grep?')
+        self.assertResponse('manurl gerp', 'No manual page for \'gerp\'; '
+                            'did you mean grep?')
+        self.assertResponse('man nosuchcommand',
+                            'No manual page for \'nosuchcommand\'')
+
+    def testThrottle(self):
+        rate = UMConf.throttle.user()
+        burst = UMConf.throttle.userBurst()
+        timeout = UMConf.timeout()
+        UMConf.throttle.userBurst.setValue(2)
+        UMConf.timeout.setValue(1)
+        try:
+            self.assertNotError('man grep')
+            # The pages answered from the cache aren't charged.
+            requests = self.fixture.requests
+            for i in range(5):
+                self.assertRegexp('man grep', r'^grep \|')
+            self.assertEqual(self.fixture.requests, requests)
+            self.assertRegexp('man tar', r'^tar \|')
+            self.assertRegexp('man gzip', 'try again in 6 seconds')
+            self.assertRegexp('man tar gzip', r'^tar \|.*try again in 6 '
+                              'seconds')
+            self.assertRegexp('man gzip', r'^gzip \|',
+                              frm='other!user@host.domain.tld')
+            # A fetch that has to wait less than the timeout waits for its
+            # turn.
+            UMConf.throttle.user.setValue(120)
+            started = time.time()
+            self.assertRegexp('man xz', r'^xz \|')
+            self.assertTrue(time.time() - started > 0.2)
+        finally:
+            UMConf.throttle.user.setValue(rate)
+            UMConf.throttle.userBurst.setValue(burst)
+            UMConf.timeout.setValue(timeout)
+
+    def expire(self):
+        cache = self.irc.getCallback('UbuntuMan').cache
+        for record in cache.store.records.itervalues():
+            record.stamp = 0
+
+    def waitMsg(self, timeout=5):
+        started = time.time()
+        m = self.irc.takeMsg()
+        while m is None and time.time() - started < timeout:
+            time.sleep(0.1)
+            drivers.run()
+            m = self.irc.takeMsg()
+        return m
+
+    def waitRefresh(self):
+        cb = self.irc.getCallback('UbuntuMan')
+        started = time.time()
+        while cb.refreshing and time.time() - started < 5:
+            time.sleep(0.01)
+
+    def testStale(self):
+        self.assertRegexp('man grep', '^grep')
+        self.expire()
+        # the repository is down, but the expired page is still answered
+        self.fixture.failing = True
+        self.assertRegexp('man grep', '^grep')
+        self.waitRefresh()
+        self.fixture.failing = False
+        self.expire()
+        self.assertRegexp('man grep', '^grep')
+        self.waitRefresh()
+        self.assertEqual(self.fixture.statuses[304], 1)
+        self.assertRegexp('manstats', r'cache: 0 hits, 1 misses, 2 stale '
+                                      r'\(1 unchanged\)')
+        # a changed page is downloaded again
+        path = '/karmic/en/man1/grep.1.html'
+        self.fixture.pages[path] = self.fixture.pages[path].replace(
+            '<u>OPTION</u>', '<u>CHANGED</u>')
+        self.expire()
+        self.assertNotRegexp('man grep', 'CHANGED')
+        self.waitRefresh()
+        self.assertRegexp('man grep', r'^grep \| grep \[CHANGED\]')
+
+    def testStaleNarrowFormat(self):
+        page = self.fixture.pages['/karmic/en/man1/grep.1.html']
+        path = '/karmic/en/man1/nosyn.1.html'
+        self.fixture.pages[path] = page.replace('grep', 'nosyn').replace(
+            '<b>SYNOPSIS</b>', '<b>USAGE</b>')
+        format = UMConf.format()
+        UMConf.format.setValue('$description')
+        try:
+            self.assertRegexp('man nosyn', '^Default is')
+            # the page is parsed again for the description only
+            self.fixture.pages[path] = self.fixture.pages[path].replace(
+                'Default is', 'Changed is')
+            self.expire()
+            self.assertRegexp('man nosyn', '^Default is')
+            self.waitRefresh()
+            self.assertRegexp('man nosyn', '^Changed is')
+            # a page that can't be parsed any more isn't fetched again at
+            # every lookup
+            self.fixture.pages[path] = self.fixture.pages[path].replace(
+                '<b>DESCRIPTION</b>', '<b>NOTES</b>')
+            self.expire()
+            self.assertRegexp('man nosyn', '^Changed is')
+            self.waitRefresh()
+            requests = self.fixture.requests
+            self.assertRegexp('man nosyn', '^Changed is')
+            self.assertEqual(self.fixture.requests, requests)
+        finally:
+            UMConf.format.setValue(format)
+
+    def testManprefetch(self):
+        cache = self.irc.getCallback('UbuntuMan').cache
+        (release, language) = (UMConf.release(), UMConf.language())
+        for command in ['gzip', 'gzip', 'xz', 'xz', 'tar']:
+            cache.count(release, language, command)
+        self.assertResponse('manprefetch top 2',
+                            'Prefetching 2 manual pages for %s/%s.' %
+                            (release, language))
+        self.assertTrue(re.match(r'Prefetched 2 manual pages in [\d.]+ '
+                                 r'seconds; 0 had no manual page and 0 '
+                                 r'failed\.$', self.waitMsg().args[1]))
+        (fd, filename) = tempfile.mkstemp()
+        try:
+            os.write(fd, '# prefetched\ngrep\n\nfstab\nnosuchcommand\n')
+            os.close(fd)
+            self.assertResponse('manprefetch %s' % filename,
+                                'Prefetching 3 manual pages for %s/%s.' %
+                                (release, language))
+            self.assertTrue(re.match(r'Prefetched 2 manual pages in '
+                                     r'[\d.]+ seconds; 1 had no manual '
+                                     r'page and 0 failed\.$',
+                                     self.waitMsg().args[1]))
+        finally:
+            os.remove(filename)
+        # the prefetched pages are answered from the cache
+        self.fixture.reset()
+        for command in ['gzip', 'xz', 'grep', 'fstab']:
+            self.assertRegexp('man %s' % command, '^%s' % command)
+        self.assertRegexp('man nosuchcommand', '^No manual page for')
+        self.assertEqual(self.fixture.requests, 0)
+        self.assertRegexp('man tar', '^tar')
+        self.assertNotEqual(self.fixture.requests, 0)
+
+    def testBreaker(self):
+        self.fixture.failing = True
+        self.assertRegexp('man tar', 'can\'t be reached')
+        self.assertRegexp('man gzip', 'can\'t be reached')
+        requests = self.fixture.requests
+        self.assertTrue(requests <= 6)
+        self.assertRegexp('manurl xz', 'can\'t be reached')
+        self.assertEqual(self.fixture.requests, requests)
+
+    def testApropos(self):
+        self.assertRegexp('manapropos gzip', 'nothing appropriate')
+        self.assertNotError('man gzip')
+        self.assertRegexp('manapropos gzip', r'^gzip\(1\) - ')
+        dirname = conf.supybot.directories.data.dirize('mirror')
+        corpus.write(self.fixture.pages, dirname)
+        UMConf.index.mirror.setValue(dirname)
+        try:
+            self.assertRegexp('manindex', r'\(\d+ NAME lines for apropos\)')
+        finally:
+            UMConf.index.mirror.setValue('')
+        self.assertRegexp('manapropos fstab --lang de', r'^fstab\(5\) - ')
+
+    def testManstats(self):
+        self.assertNotError('man grep')
+        self.assertNotError('man grep')
+        self.assertRegexp('manstats', r'^lookup: 2, .*probes per lookup: '
+                          r'.*cache: 1 hits, 1 misses.*found: 1/en 1; '
+                          r'not found: none;')
+        self.assertNotError('manstats --reset')
+        self.assertRegexp('manstats', '^cache: 0 hits')
+
+
+class UbuntuManParserTestCase(SupyTestCase):
+    page = '\n'.join(['<html>'] + ['<meta>'] * 40 + [
+        '<pre>',
+        '<h4><b>%s</b></h4>', '       grep, egrep - print lines', '',
+        '<h4><b>%s</b></h4>', '       <b>grep</b> [<u>OPTIONS</u>] PATTERN',
+        '',
+        '<h4><b>%s</b></h4>', '       <b>grep</b> searches the input',
+        '       files.  It prints the matching lines.', ' </pre>'] +
+        ['<p>options</p>'] * 200 + ['</html>', ''])
+
+    def parse(self, parser, headings, format):
+        fd = StringIO(self.page % headings)
+        parser.parse(fd, 'grep', format)
+        return fd
+
+    def testParse(self):
+        parser = UMPlugin.UbuntuManParser_en()
+        fd = self.parse(parser, ('NAME', 'SYNOPSIS', 'DESCRIPTION'),
+                        '$name | $synopsis | $description')
+        self.assertEqual(parser.name, 'grep,')
+        self.assertEqual(parser.synopsis, 'grep [OPTIONS] PATTERN')
+        self.assertEqual(parser.description,
+                'grep searches the input files. It prints the matching lines.')
+        # the rest of the page is not read
+        self.assertTrue(fd.tell() < len(self.page) / 2)
+
+    def testParseOnlyNeeded(self):
+        parser = UMPlugin.UbuntuManParser_en()
+        fd = self.parse(parser, ('NAME', 'SYNOPSIS', 'DESCRIPTION'),
+                        '$synopsis')
+        self.assertEqual(parser.name, '')
+        self.assertEqual(parser.synopsis, 'grep [OPTIONS] PATTERN')
+        self.assertEqual(parser.description, '')
+
+    def testParseLanguages(self):
+        for (parser, headings) in (
+                (UMPlugin.UbuntuManParser_es(),
+                 ('NOMBRE', 'SINOPSIS', 'DESCRIPCI\xc3\x93N')),
+                (UMPlugin.UbuntuManParser_de(),
+                 ('BEZEICHNUNG', '&Uuml;BERSICHT', 'BESCHREIBUNG')),
+                (UMPlugin.UbuntuManParser_fi(),
+                 ('NIMI', 'SYNOPSIS', 'KUVAUS')),
+                (UMPlugin.UbuntuManParser_it(),
+                 ('NOME', 'SINTASSI', 'DESCRIZIONE')),
+                (UMPlugin.UbuntuManParser_fr(),
+                 ('NOM', 'SYNOPSIS', 'DESCRIPTION'))):
+            self.parse(parser, headings, '$name | $synopsis | $description')
+            self.assertEqual(parser.name, 'grep,')
+            self.assertEqual(parser.synopsis, 'grep [OPTIONS] PATTERN')
+
+    def testMissingSection(self):
+        parser = UMPlugin.UbuntuManParser_en()
+        self.assertRaises(UMPlugin.UbuntuManError, self.parse, parser,
+                          ('NAME', 'SYNOPSIS', 'BUGS'), '$description')
+
+    def testParseOptions(self):
+        page = '\n'.join(['<pre>',
+            '<h4><b>DESCRIPTION</b></h4>',
+            '       <b>grep</b> searches the input files.', '',
+            '       <b>-a</b>, <b>--text</b>',
+            '              Process a binary file as if it were text.', '',
+            '</pre>', '<pre>', '<h4><b>OPTIONS</b></h4>',
+            '       <b>-A</b> <u>NUM</u>, <b>--after-context=</b><u>NUM</u>',
+            '              Print <u>NUM</u> lines of trailing con\xe2\x80\x90',
+            '              text.', '',
+            '              Places a line between groups.', '',
+            '       <b>-i</b>     Ignore case.',
+            '       Regular expressions follow.',
+            '       <b>-a</b>     Not the first one.',
+            '<h4><b>SEE ALSO</b></h4>',
+            '       <b>-z</b>     Not an option.', ''])
+        index = UMPlugin.UbuntuManParser_en().parseOptions(StringIO(page))
+        self.assertEqual(index.lookup('--after-context=5'),
+                         ('-A NUM, --after-context=NUM',
+                          'Print NUM lines of trailing context. Places a line '
+                          'between groups.'))
+        self.assertEqual(index.lookup('-i'), ('-i', 'Ignore case.'))
+        self.assertEqual(index.lookup('text'),
+                         ('-a, --text',
+                          'Process a binary file as if it were text.'))
+        self.assertEqual(index.lookup('a'), index.lookup('--text'))
+        self.assertEqual(index.lookup('-z'), None)
+        self.assertEqual(len(index), 5)
+        index = UMPlugin.UbuntuManParser_es().parseOptions(
+            StringIO(page.replace('OPTIONS', 'OPCIONES')))
+        self.assertEqual(index.lookup('-i'), ('-i', 'Ignore case.'))
+
+
+class UbuntuManTroffParserTestCase(SupyTestCase):
+    page = '\n'.join([
+        '.\\" Comment',
+        '.TH GREP 1',
+        '.SH NAME',
+        'grep, egrep \\- print lines matching a pattern',
+        '.SH "%s"',
+        '.B grep',
+        '.RI [ OPTIONS ]',
+        '.I PATTERN',
+        '.RI [ FILE .\\|.\\|.]',
+        '.br',
+        '.B grep',
+        '.RI [ OPTIONS ]',
+        '.SH %s',
+        '.PP',
+        '\\fBgrep\\fP searches the named input',
+        '.IR FILE s',
+        'for lines containing a match.  It prints them.',
+        '.SH OPTIONS',
+        ''])
+
+    def testParse(self):
+        parser = UMPlugin.UbuntuManTroffParser(UMPlugin.UbuntuManParser_en)
+        parser.parse(StringIO(self.page % ('SYNOPSIS', 'DESCRIPTION')),
+                     'grep', '$name | $synopsis | $description')
+        self.assertEqual(parser.name, 'grep,')
+        self.assertEqual(parser.synopsis, 'grep [OPTIONS] PATTERN [FILE...]')
+        self.assertEqual(parser.description, 'grep searches the named input '
+                         'FILEs for lines containing a match. It prints them.')
+
+    def testParseOptions(self):
+        page = self.page % ('SYNOPSIS', 'DESCRIPTION') + '\n'.join([
+            '.TP',
+            '.BR \\-r ", " \\-\\^\\-recursive',
+            'Read all files under each directory.',
+            '.TP',
+            '.BI \\-e " PATTERN"',
+            'Use',
+            '.I PATTERN',
+            'as the pattern.',
+            '.PP',
+            'Not about an option.',
+            ''])
+        parser = UMPlugin.UbuntuManTroffParser(UMPlugin.UbuntuManParser_en)
+        index = parser.parseOptions(StringIO(page))
+        self.assertEqual(index.lookup('--recursive'),
+                         ('-r, --recursive',
+                          'Read all files under each directory.'))
+        self.assertEqual(index.lookup('-e'),
+                         ('-e PATTERN', 'Use PATTERN as the pattern.'))
+        self.assertEqual(len(index), 3)
+
+    def testParseLanguage(self):
+        parser = UMPlugin.UbuntuManTroffParser(UMPlugin.UbuntuManParser_de)
+        page = self.page % ('\xc3\x9cBERSICHT', 'BESCHREIBUNG')
+        parser.parse(StringIO(page), 'grep', '$synopsis | $description')
+        self.assertEqual(parser.synopsis, 'grep [OPTIONS] PATTERN [FILE...]')
+        parser = UMPlugin.UbuntuManTroffParser(UMPlugin.UbuntuManParser_de)
+        self.assertRaises(UMPlugin.UbuntuManError, parser.parse,
+                          StringIO(self.page % ('SYNOPSIS', 'DESCRIPTION')),
+                          'grep', '$description')
+
+
+class UbuntuManCacheTestCase(SupyTestCase):
+    def testLRUCache(self):
+        c = UbuntuMan.cache.LRUCache(lambda: 0, lambda: 2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        c = UbuntuMan.cache.LRUCache(lambda: -1, lambda: 0)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), None)
+
+    def testSummaryCache(self):
+        filename = conf.supybot.directories.data.dirize('UbuntuManTest.cache')
+        c = UbuntuMan.cache.SummaryCache(filename, lambda: 0, lambda: 0,
+                                         lambda: 0, lambda: 0)
+        summary = {'url':'url', 'command':'ls', 'section':'1',
+                   'language':'en', 'name':'ls,'}
+        c.set('karmic', 'es', 'ls', summary)
+        self.assertEqual(c.get('karmic', 'es', 'ls', ['name']), summary)
+        self.assertEqual(c.get('karmic', 'es', 'ls', ['synopsis']), None)
+        self.assertEqual(c.get('karmic', 'en', 'ls', ['name']), None)
+        self.assertTrue(c.dirty)
+        c.flush()
+        self.assertFalse(c.dirty)
+        c = UbuntuMan.cache.SummaryCache(filename, lambda: 0, lambda: 0,
+                                         lambda: 0, lambda: 0)
+        self.assertEqual(c.get('karmic', 'es', 'ls', ['name']), summary)
+        # a cache just loaded isn't written again
+        self.assertFalse(c.dirty)
+        self.assertFalse(c.isMiss('karmic', 'en', 'asdasd'))
+        c.setMiss('karmic', 'en', 'asdasd')
+        self.assertTrue(c.isMiss('karmic', 'en', 'asdasd'))
+        self.assertFalse(c.isMiss('karmic', 'es', 'asdasd'))
+        for command in ('ls', 'grep', 'ls', 'cat', 'ls', 'grep'):
+            c.count('karmic', 'en', command)
+        c.count('lucid', 'en', 'tar')
+        self.assertEqual(c.top('karmic', 'en', 2), ['ls', 'grep'])
+        self.assertEqual(c.top('lucid', 'en', 5), ['tar'])
+
+    def testSummaryStore(self):
+        store = UbuntuMan.cache.SummaryStore(lambda: 0, lambda: 0)
+        summary = {'url':'url', 'command':'ls', 'section':'1',
+                   'language':'en', 'name':'ls - list', 'synopsis':'ls'}
+        for release in ('hardy', 'karmic', 'lucid'):
+            store.set(release, 'en', 'ls', dict(summary, url=release))
+        store.set('lucid', 'es', 'ls', dict(summary, url='lucid'))
+        # the releases and languages share the text of the page
+        self.assertEqual((len(store), len(store.bodies)), (4, 1))
+        (hardy, expired) = store.get('hardy', 'en', 'ls', ['name'])
+        self.failIf(expired)
+        self.assertEqual(hardy, dict(summary, url='hardy'))
+        self.assertEqual(store.get('lucid', 'es', 'ls', [])[0]['url'],
+                         'lucid')
+        self.assertEqual(store.get('karmic', 'en', 'ls', ['description']),
+                         None)
+        store.set('karmic', 'en', 'ls', dict(summary, name='ls - changed'))
+        self.assertEqual((len(store), len(store.bodies)), (4, 2))
+        (records, bodies, size) = store.memory()
+        self.assertEqual((records, bodies), (4, 2))
+        self.assertTrue(store.bytes <= size <= store.bytes * 2)
+        # the least recently used records are dropped to fit the bytes
+        limit = store.bytes - 1
+        store.maxBytes = lambda: limit
+        store.get('hardy', 'en', 'ls', [])
+        store.set('dapper', 'en', 'ls', summary)
+        self.assertEqual(store.get('lucid', 'es', 'ls', []), None)
+        self.assertEqual(sorted([key[0] for key in store.records]),
+                         ['dapper', 'hardy', 'karmic'])
+        self.assertEqual(len(store.bodies), 2)
+        self.assertTrue(store.bytes <= store.maxBytes())
+        # restored records don't replace the newer ones
+        store.load([(5, 'hardy', 'en', dict(summary, name='ls - old'))])
+        self.assertEqual(store.get('hardy', 'en', 'ls', [])[0]['name'],
+                         'ls - list')
+
+    def testSnapshot(self):
+        filename = conf.supybot.directories.data.dirize('UbuntuManTest.snap')
+        fd = open(filename, 'wb')
+        UbuntuMan.snapshot.write(fd, [('a', range(5)), ('b', []),
+                                      ('c', ['x'])], 2)
+        fd.close()
+        reader = UbuntuMan.snapshot.Reader(filename)
+        self.assertEqual(list(reader), [('a', [0, 1]), ('a', [2, 3]),
+                                        ('a', [4]), ('c', ['x'])])
+        reader.close()
+        c = UbuntuMan.cache.SummaryCache(filename, lambda: 0, lambda: 0,
+                                         lambda: 0, lambda: 0)
+        summary = {'url':'url', 'command':'ls', 'section':'1',
+                   'language':'en', 'name':'ls,'}
+        for release in ('hardy', 'karmic', 'lucid'):
+            c.set(release, 'en', 'ls', summary)
+        c.setMiss('karmic', 'en', 'asdasd')
+        c.count('karmic', 'en', 'ls')
+        c.flush()
+        c = UbuntuMan.cache.SummaryCache(filename, lambda: 0, lambda: 0,
+                                         lambda: 0, lambda: 0, background=True)
+        c.count('karmic', 'en', 'ls')
+        self.assertTrue(c.warmUp.wait(5))
+        self.assertEqual(len(c), 3)
+        self.assertEqual(c.get('hardy', 'en', 'ls', ['name']), summary)
+        self.assertTrue(c.isMiss('karmic', 'en', 'asdasd'))
+        self.assertEqual(c.counts, {('karmic', 'en', 'ls'):2})
+        # the most recently used summaries are loaded first
+        self.assertEqual([item[1] for item in c.store.items()],
+                         ['hardy', 'lucid', 'karmic'])
+        # nothing is written while the snapshot is being loaded
+        gate = threading.Event()
+        c.warmUp = UbuntuMan.snapshot.WarmUp('UbuntuMan test warm-up',
+                                             filename,
+                                             lambda name, items: gate.wait())
+        c.set('dapper', 'en', 'ls', summary)
+        c.flush()
+        self.assertTrue(c.dirty)
+        gate.set()
+        self.assertTrue(c.warmUp.wait(5))
+        # a failed write is tried again
+        items = c.store.items
+        c.store.items = lambda: 1 / 0
+        c.flush()
+        self.assertTrue(c.dirty)
+        c.store.items = items
+        c.flush()
+        self.assertFalse(c.dirty)
+        c = UbuntuMan.cache.SummaryCache(filename, lambda: 0, lambda: 0,
+                                         lambda: 0, lambda: 0)
+        self.assertEqual(len(c), 4)
+        fd = open(filename, 'wb')
+        fd.write('garbage')
+        fd.close()
+        c = UbuntuMan.cache.SummaryCache(filename, lambda: 0, lambda: 0,
+                                         lambda: 0, lambda: 0, background=True)
+        self.assertTrue(c.warmUp.wait(5))
+        self.assertEqual(len(c), 0)
+
+class UbuntuManStatsTestCase(SupyTestCase):
+    def testHistogram(self):
+        h = UbuntuMan.stats.Histogram((1, 2, 5, 10))
+        for value in (0.5, 1.5, 1.5, 3, 20):
+            h.add(value)
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.mean(), 26.5 / 5)
+        self.assertEqual(h.percentile(50), 2)
+        self.assertEqual(h.percentile(80), 5)
+        self.assertEqual(h.percentile(100), 20)
+
+    def testDisabled(self):
+        enabled = [False]
+        stats = UbuntuMan.stats.Stats(lambda: enabled[0])
+        stats.record('parse', stats.start())
+        stats.count(('cache', 'hit'))
+        stats.recordProbes(3)
+        self.assertEqual((stats.stages, stats.counters, stats.probes.count),
+                         ({}, {}, 0))
+        enabled[0] = True
+        stats.record('parse', stats.start())
+        stats.count(('hit', '1', 'en'))
+        self.assertEqual(stats.stages['parse'].count, 1)
+        self.assertEqual(stats.counters, {('hit', '1', 'en'): 1})
+
+
+class UbuntuManAproposTestCase(SupyTestCase):
+    def testTokenize(self):
+        self.assertEqual(UbuntuMan.apropos.tokenize(
+                         'Which command compresses files?'),
+                         set(['compress', 'file']))
+        self.assertEqual(UbuntuMan.apropos.stem('directories'), 'directory')
+        self.assertEqual(UbuntuMan.apropos.stem('copying'), 'copy')
+
+    def testSearch(self):
+        filename = conf.supybot.directories.data.dirize('apropos.test')
+        index = UbuntuMan.apropos.AproposIndex(filename)
+        for (command, whatis) in (
+                ('gzip', 'gzip, gunzip, zcat - compress or expand files'),
+                ('xz', 'xz, unxz - Compress or decompress .xz and .lzma '
+                       'files'),
+                ('ls', 'ls - list directory contents'),
+                ('cp', 'cp - copy files and directories')):
+            index.add('karmic', 'en', command, '1', whatis)
+        self.assertEqual(index.search('karmic', 'en', 'compresses files'),
+                [('gzip', '1', 'compress or expand files'),
+                 ('xz', '1', 'Compress or decompress .xz and .lzma files'),
+                 ('cp', '1', 'copy files and directories')])
+        self.assertEqual(index.search('karmic', 'en', 'zcat', 1),
+                         [('gzip', '1', 'compress or expand files')])
+        self.assertEqual(index.search('karmic', 'es', 'zcat'), [])
+        index.add('karmic', 'en', 'ls', '1', 'ls - list files')
+        self.assertEqual([r[0] for r in index.search('karmic', 'en',
+                                                     'directory')], ['cp'])
+        index.flush()
+        index = UbuntuMan.apropos.AproposIndex(filename)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.search('karmic', 'en', 'list')[0][0], 'ls')
+        index = UbuntuMan.apropos.AproposIndex(filename, background=True)
+        self.assertTrue(index.warmUp.wait(5))
+        self.assertEqual(len(index), 4)
+        self.assertFalse(index.dirty)
+
+
+class UbuntuManTemplateTestCase(SupyTestCase):
+    def testCut(self):
+        cut = UbuntuMan.template.cut
+        self.assertEqual(cut('foo bar baz', 11), 'foo bar baz')
+        self.assertEqual(cut('foo bar baz', 10), 'foo ...')
+        self.assertEqual(cut('foobarbaz', 8), 'foob ...')
+        self.assertEqual(cut('foo bar', 3), '')
+
+    def testAllocate(self):
+        allocate = UbuntuMan.template.allocate
+        self.assertEqual(allocate([10, 50, 100], 90), [10, 40, 40])
+        self.assertEqual(allocate([10, 20], 100), [10, 20])
+        self.assertEqual(allocate([30, 30, 30], 31), [10, 10, 11])
+
+    def testRender(self):
+        keys = ('name', 'synopsis', 'description')
+        template = UbuntuMan.template.Template(
+            '$name | ${synopsis} | $description | $url | $nosuchvar',
+            ('url', 'command') + keys, keys)
+        self.assertEqual(template.slots,
+                         ['name', 'synopsis', 'description', 'url'])
+        self.assertEqual(template.width, len(' |  |  |  | $nosuchvar'))
+        vars = {'name':'grep - print lines matching a pattern',
+                'synopsis':'grep [OPTIONS] PATTERN [FILE...] ' * 4,
+                'description':'grep searches the named input FILEs. ' * 8,
+                'url':'http://x/grep.1.html', 'command':'grep'}
+        msg = template.render(vars)
+        self.assertEqual(msg,
+                         utils.str.perlVariableSubstitute(vars,
+                                                          template.format))
+        msg = template.render(vars, 200)
+        self.assertTrue(len(msg) <= 200)
+        # both long sections are cut, not only the first one
+        (name, synopsis, description, url, rest) = msg.split(' | ')
+        self.assertEqual(name, vars['name'])
+        self.assertTrue(synopsis.endswith(' ...'))
+        self.assertTrue(description.endswith(' ...'))
+        self.assertEqual(url, vars['url'])
+        self.assertEqual(template.render(vars, 20), msg[:16] + ' ...')
+
+
+class UbuntuManFuzzyTestCase(SupyTestCase):
+    def testDistance(self):
+        distance = UbuntuMan.fuzzy.distance
+        self.assertEqual(distance('grep', 'grep'), 0)
+        self.assertEqual(distance('grpe', 'grep'), 1)
+        self.assertEqual(distance('gre', 'grep'), 1)
+        self.assertEqual(distance('', 'ls'), 2)
+        self.assertEqual(distance('kitten', 'sitting'), 3)
+
+    def testSuggest(self):
+        names = UbuntuMan.fuzzy.NameIndex()
+        for name in ('grep', 'egrep', 'fgrep', 'gzip', 'ls', 'lsof', 'sl'):
+            names.add(name)
+        self.assertEqual(len(names), 7)
+        self.assertEqual(names.suggest('grpe'), ['grep'])
+        self.assertEqual(names.suggest('gre'), ['grep'])
+        self.assertEqual(names.suggest('lsf'), ['ls', 'lsof'])
+        self.assertEqual(names.suggest('gzipg', 1), ['gzip'])
+        self.assertEqual(names.suggest('fgre'), ['fgrep', 'grep'])
+        self.assertEqual(names.suggest('grep'), ['egrep', 'fgrep'])
+        self.assertEqual(names.suggest('xyzzy'), [])
+
+    def testNameIndexes(self):
+        built = []
+        def build(release):
+            built.append(release)
+            return ['grep']
+        indexes = UbuntuMan.fuzzy.NameIndexes(build)
+        indexes.add('karmic', 'gzip')
+        self.assertEqual(indexes.get('karmic').suggest('gzpi'), [])
+        indexes.add('karmic', 'gzip')
+        self.assertEqual(indexes.get('karmic').suggest('gzpi'), ['gzip'])
+        indexes.invalidate('karmic')
+        self.assertEqual(indexes.get('karmic').suggest('gzpi'), [])
+        self.assertEqual(built, ['karmic', 'karmic'])
+
+
+class UbuntuManIndexTestCase(SupyTestCase):
+    def testSectionIndex(self):
+        pages = {}
+        UbuntuMan.index.addPages(pages, UbuntuMan.index.parseListing(
+            '<a href="grep.1.html">grep</a> <a href="ld.so.8.html">ld.so</a>'
+            '<a href="mount.8.html">mount</a>', '8'), '8')
+        UbuntuMan.index.addPages(pages, ['mount', 'ls', 'cat'], '1')
+        self.assertEqual(pages, {'ld.so':['8'], 'mount':['8', '1'],
+                                 'ls':['1'], 'cat':['1']})
+        dirname = conf.supybot.directories.data.dirize('UbuntuManTest.index')
+        indexes = UbuntuMan.index.SectionIndexes(dirname)
+        self.assertEqual(indexes.get('karmic', 'en'), None)
+        sections = indexes.store('karmic', 'en', pages)
+        self.assertEqual(len(sections), 4)
+        for command in pages:
+            self.assertEqual(sections.lookup(command), pages[command])
+        for command in ('a', 'd', 'grep', 'zzz', 'mount.8'):
+            self.assertEqual(sections.lookup(command), None)
+        self.assertEqual(sorted(sections), sorted(pages.items()))
+        indexes.close()
+        indexes = UbuntuMan.index.SectionIndexes(dirname)
+        self.assertEqual(indexes.get('karmic', 'en').lookup('ls'), ['1'])
+        indexes.close()
+
+
+class UbuntuManHTTPTestCase(SupyTestCase):
+    def testCircuitBreaker(self):
+        cooldown = [60]
+        breaker = UbuntuMan.httpclient.CircuitBreaker(lambda: 2,
+                                                      lambda: cooldown[0])
+        breaker.failed()
+        self.failUnless(breaker.allow())
+        breaker.failed()
+        self.failIf(breaker.allow())
+        cooldown[0] = 0
+        # a single request tries the server again
+        self.failUnless(breaker.allow())
+        self.failIf(breaker.allow())
+        breaker.failed()
+        self.failUnless(breaker.isOpen())
+        self.failUnless(breaker.allow())
+        breaker.succeeded()
+        self.failIf(breaker.isOpen())
+        self.failUnless(breaker.allow())
+        self.failUnless(breaker.allow())
+
+
+class UbuntuManPoolTestCase(SupyTestCase):
+    def testWorkerPool(self):
+        workers = UbuntuMan.pool.WorkerPool('test', lambda: 3)
+        try:
+            jobs = workers.map(lambda x: x * 2, range(10))
+            self.assertEqual([job.get() for job in jobs], range(0, 20, 2))
+            job = workers.submit(lambda: 1 / 0)
+            self.assertRaises(ZeroDivisionError, job.get)
+            discarded = []
+            job = workers.submit(lambda: 'fd')
+            job.wait()
+            job.cancel(discard=discarded.append)
+            self.assertEqual(discarded, ['fd'])
+        finally:
+            workers.stop()
+
+    def testCoalescer(self):
+        inflight = UbuntuMan.pool.Coalescer()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        def lookup():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'summary'
+        results = []
+        def call():
+            results.append(inflight.call('key', lookup))
+        owner = threading.Thread(target=call)
+        owner.start()
+        started.wait()
+        waiters = [threading.Thread(target=call) for i in range(4)]
+        for thread in waiters:
+            thread.start()
+        time.sleep(0.2) # let the waiters join the call in flight
+        release.set()
+        for thread in [owner] + waiters:
+            thread.join()
+        self.assertEqual(results, ['summary'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def testFairPool(self):
+        workers = UbuntuMan.pool.FairPool('test', lambda: 1, lambda: 5)
+        try:
+            started = threading.Event()
+            release = threading.Event()
+            def block():
+                started.set()
+                release.wait()
+            workers.submit('#a', block)
+            started.wait()
+            order = []
+            jobs = [workers.submit(key, order.append, name)
+                    for (key, name) in (('#a', 'a1'), ('#a', 'a2'),
+                                        ('#a', 'a3'), ('#b', 'b1'),
+                                        ('#c', 'c1'))]
+            self.assertEqual(workers.submit('#d', order.append, 'd1'), None)
+            release.set()
+            for job in jobs:
+                job.get()
+            # the channels take turns, each one's jobs in order
+            self.assertEqual(order, ['a1', 'b1', 'c1', 'a2', 'a3'])
+        finally:
+            workers.stop()
+
+
+class UbuntuManThrottleTestCase(SupyTestCase):
+    def testTokenBucket(self):
+        rate = [10.0]
+        bucket = UbuntuMan.throttle.TokenBucket(lambda: rate[0], lambda: 2)
+        self.assertEqual(bucket.wait(2), 0)
+        bucket.take(2)
+        self.assertTrue(0 < bucket.wait() <= 0.1)
+        self.failIf(bucket.isFull())
+        time.sleep(0.2)
+        self.assertEqual(bucket.wait(5), 0)
+        self.failUnless(bucket.isFull())
+        # reservations go into debt, spacing the requests out
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertTrue(0 < bucket.reserve() <= 0.1)
+        self.assertEqual(bucket.reserve(0.1), None)
+        rate[0] = 0
+        self.assertEqual(bucket.wait(100), 0)
+        self.assertEqual(bucket.reserve(), 0)
+
+    def testThrottle(self):
+        throttle = UbuntuMan.throttle.Throttle(lambda: 1.0, lambda: 1, 2)
+        throttle.take('a')
+        throttle.take('b')
+        self.failUnless(throttle.wait('a'))
+        self.failIf(throttle.wait('c'))
+        # the full bucket of c is dropped to make room
+        throttle.get('d')
+        self.assertEqual(sorted(throttle.buckets), ['a', 'b', 'd'])
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
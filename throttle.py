@@ -0,0 +1,141 @@
+# -*- Encoding: UTF-8 -*-
+# Copyright (c) 2008 Henri Häkkinen
+#
+# This file is part of the UbuntuMan Supybot IRC plugin.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import threading
+
+class Throttled(Exception):
+    """Raised when a lookup would have to wait 'delay' seconds for its
+    turn, longer than it may."""
+    def __init__(self, delay):
+        Exception.__init__(self, 'Throttled for %.0f seconds' % delay)
+        self.delay = delay
+
+
+class TokenBucket:
+    """A token bucket: it holds at most 'burst' tokens and gets 'rate' new
+    ones per second.  'rate' and 'burst' are callables (usually registry
+    values); while the rate is zero, there is no limit."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = None
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def __refill(self, rate):
+        now = time.time()
+        burst = max(1, self.burst())
+        if self.tokens is None:
+            self.tokens = float(burst)
+        else:
+            self.tokens = min(burst, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        return burst
+
+    def wait(self, n=1):
+        """Returns how many seconds it takes until there are 'n' tokens, or
+        0 if there are already.  More tokens than the bucket holds count as
+        a full bucket."""
+        rate = self.rate()
+        if not rate:
+            return 0
+        self.lock.acquire()
+        try:
+            n = min(n, self.__refill(rate))
+            return max(0, (n - self.tokens) / rate)
+        finally:
+            self.lock.release()
+
+    def take(self, n=1):
+        """Takes 'n' tokens, as many as there are if there are less."""
+        rate = self.rate()
+        if not rate:
+            return
+        self.lock.acquire()
+        try:
+            self.__refill(rate)
+            self.tokens = max(0, self.tokens - n)
+        finally:
+            self.lock.release()
+
+    def reserve(self, maxDelay=None):
+        """Takes a token, the one of a coming second if there are none left.
+        Returns how many seconds the caller has to wait before using it, or
+        None without taking it if that's longer than 'maxDelay'."""
+        rate = self.rate()
+        if not rate:
+            return 0
+        self.lock.acquire()
+        try:
+            self.__refill(rate)
+            delay = max(0, (1 - self.tokens) / rate)
+            if maxDelay is not None and delay > maxDelay:
+                return None
+            self.tokens -= 1
+            return delay
+        finally:
+            self.lock.release()
+
+    def isFull(self):
+        rate = self.rate()
+        if not rate or self.tokens is None:
+            return True
+        self.lock.acquire()
+        try:
+            return self.tokens >= self.__refill(rate)
+        finally:
+            self.lock.release()
+
+
+class Throttle:
+    """A TokenBucket for each key, such as a channel or a hostmask.  The
+    buckets that have filled up again are the same as new ones, so they are
+    dropped when there are more than 'maxKeys' of them."""
+
+    def __init__(self, rate, burst, maxKeys=1000):
+        self.rate = rate
+        self.burst = burst
+        self.maxKeys = maxKeys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.maxKeys:
+                    for (k, b) in self.buckets.items():
+                        if b.isFull():
+                            del self.buckets[k]
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[key] = bucket
+            return bucket
+        finally:
+            self.lock.release()
+
+    def wait(self, key, n=1):
+        return self.get(key).wait(n)
+
+    def take(self, key, n=1):
+        self.get(key).take(n)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: